@@ -2,14 +2,17 @@ import eventlet
 eventlet.monkey_patch()
 
 from flask import Flask
-from flask_session import Session
 import os
+import json
 import logging
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
 import jinja2
 from app.models.db import init_db
+from app.services.session_store import init_session
+from app.services.serializers import init_serializers
 from app.socketio_events import init_socketio
+from app.cli import init_cli
 
 # Gunicorn用のアプリケーションオブジェクト
 application = None
@@ -26,33 +29,102 @@ def create_app(test_config=None):
         pass
     
     # 環境変数から設定を読み込み
-    # 環境変数DATABASE_URLが設定されていればPostgresを使用、なければSQLiteを使用
+    # 環境変数DATABASE_URLが設定されていればそのデータベース（Postgres等）を使用、なければSQLiteを使用
+    # （RenderのPostgresQLURLは'postgres://'で始まるが、init_db で'postgresql://'に揃える）
     database_url = os.environ.get('DATABASE_URL')
-    if database_url and database_url.startswith("postgres:"):
-        # RenderのPostgresQLURLは'postgres://'で始まるが、SQLAlchemyは'postgresql://'を期待する
-        database_url = database_url.replace("postgres:", "postgresql:", 1)
-    else:
+    if not database_url:
         # デフォルトはSQLite
         database_url = f"sqlite:///{os.path.join(app.instance_path, 'golf_ai_strategist.sqlite')}"
     
     app.config.update(
         SECRET_KEY=os.environ.get('SECRET_KEY', 'dev'),
         PERPLEXITY_API_KEY=os.environ.get('PERPLEXITY_API_KEY', ''),
-        SESSION_TYPE='filesystem',
+        # サーバーサイドセッションの保存先（'sql' / 'redis' / 'memory'）とワーカー内キャッシュ
+        SESSION_BACKEND=os.environ.get('SESSION_BACKEND', 'sql'),
+        SESSION_REDIS_URL=os.environ.get('SESSION_REDIS_URL', None),
+        SESSION_CACHE_SIZE=int(os.environ.get('SESSION_CACHE_SIZE', '1024')),
+        SESSION_CACHE_TTL=int(os.environ.get('SESSION_CACHE_TTL', '5')),
+        SESSION_SWEEP_INTERVAL=int(os.environ.get('SESSION_SWEEP_INTERVAL', '600')),
         SESSION_PERMANENT=False,
-        PERMANENT_SESSION_LIFETIME=1800,  # 30分
+        PERMANENT_SESSION_LIFETIME=1800,  # 30分（サーバー側のセッションの有効期限）
         MAX_CONTENT_LENGTH=16 * 1024 * 1024,  # 最大16MB (PDFファイル対応のため増加)
         SQLALCHEMY_DATABASE_URI=database_url,
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        # リードレプリカ（カンマ区切りのURL）と、読み込みに使うレプリカの最大遅延・遅延の確認間隔（秒）
+        SQLALCHEMY_REPLICA_URIS=os.environ.get('DATABASE_REPLICA_URLS', ''),
+        DATABASE_REPLICA_MAX_LAG=float(os.environ.get('DATABASE_REPLICA_MAX_LAG', '5')),
+        DATABASE_REPLICA_CHECK_INTERVAL=float(os.environ.get('DATABASE_REPLICA_CHECK_INTERVAL', '5')),
+        # PostgreSQLのドライバ（'psycopg2' / 'pg8000'、未指定ならURLのまま）
+        DATABASE_DRIVER=os.environ.get('DATABASE_DRIVER', None),
+        # コネクションプール（接続数 = DB_POOL_SIZE + DB_MAX_OVERFLOW がワーカーごとの上限）
+        DB_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', '10')),
+        DB_MAX_OVERFLOW=int(os.environ.get('DB_MAX_OVERFLOW', '20')),
+        DB_POOL_TIMEOUT=int(os.environ.get('DB_POOL_TIMEOUT', '10')),
+        DB_POOL_RECYCLE=int(os.environ.get('DB_POOL_RECYCLE', '1800')),
+        DB_POOL_PRE_PING=os.environ.get('DB_POOL_PRE_PING', 'True').lower() == 'true',
+        DB_POOL_SLOW_CHECKOUT=float(os.environ.get('DB_POOL_SLOW_CHECKOUT', '0.5')),
+        # PostgreSQLのクエリの打ち切り（ミリ秒、0で無効）
+        DB_STATEMENT_TIMEOUT=int(os.environ.get('DB_STATEMENT_TIMEOUT', '30000')),
+        # SQLiteの接続ごとのPRAGMA
+        SQLITE_JOURNAL_MODE=os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        SQLITE_BUSY_TIMEOUT=int(os.environ.get('SQLITE_BUSY_TIMEOUT', '5000')),
+        SQLITE_SYNCHRONOUS=os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        # 起動時に未適用のマイグレーションを適用する（複数プロセスで起動する場合は無効にして flask db upgrade を別途実行してもよい）
+        AUTO_MIGRATE=os.environ.get('AUTO_MIGRATE', 'True').lower() == 'true',
         UPLOAD_FOLDER=os.path.join(app.instance_path, 'uploads'),
         # 本番環境用の設定
         PRODUCTION=os.environ.get('PRODUCTION', 'False').lower() == 'true',
         # PerplexityのAPIモデル
         PERPLEXITY_MODEL=os.environ.get('PERPLEXITY_MODEL', 'sonar-pro'),
+        # Perplexity APIへの同時リクエスト数の上限（HTTPクライアントの接続数もこの数に合わせる）
+        PERPLEXITY_MAX_CONCURRENCY=int(os.environ.get('PERPLEXITY_MAX_CONCURRENCY', '8')),
+        # AI回答のキャッシュ（ANSWER_CACHE_REDIS_URL を設定するとワーカー間で共有）
+        ANSWER_CACHE_ENABLED=os.environ.get('ANSWER_CACHE_ENABLED', 'True').lower() == 'true',
+        ANSWER_CACHE_TTL=int(os.environ.get('ANSWER_CACHE_TTL', '86400')),
+        ANSWER_CACHE_MAX_ENTRIES=int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', '512')),
+        ANSWER_CACHE_REDIS_URL=os.environ.get('ANSWER_CACHE_REDIS_URL', None),
+        # 内部の統計情報API（/api/ask/cache-stats・/api/db/pool-stats）のBearerトークン（未設定なら統計情報APIは無効）
+        STATS_TOKEN=os.environ.get('STATS_TOKEN', None),
+        # Perplexity APIのレート制限（1分あたりの呼び出し数と連続で呼び出せる数、全ワーカーの合計）と待ち行列
+        PERPLEXITY_RATE_LIMIT=int(os.environ.get('PERPLEXITY_RATE_LIMIT', '50')),
+        PERPLEXITY_RATE_BURST=int(os.environ.get('PERPLEXITY_RATE_BURST', '10')),
+        PERPLEXITY_QUEUE_MAX=int(os.environ.get('PERPLEXITY_QUEUE_MAX', '200')),
+        PERPLEXITY_QUEUE_WAIT=int(os.environ.get('PERPLEXITY_QUEUE_WAIT', '30')),  # /api/ask・/api/ask/streamで回答を待つ秒数（超えるとポーリングに切り替え）
+        PERPLEXITY_JOB_TTL=int(os.environ.get('PERPLEXITY_JOB_TTL', '600')),  # 完了ジョブの保持秒数
         # Google Drive設定
         USE_GOOGLE_DRIVE=os.environ.get('USE_GOOGLE_DRIVE', 'False').lower() == 'true',
         GOOGLE_DRIVE_CREDENTIALS=os.environ.get('GOOGLE_DRIVE_CREDENTIALS', None),
-        GOOGLE_DRIVE_FOLDER_ID=os.environ.get('GOOGLE_DRIVE_FOLDER_ID', None)
+        GOOGLE_DRIVE_FOLDER_ID=os.environ.get('GOOGLE_DRIVE_FOLDER_ID', None),
+        # 再開可能アップロード・ダウンロードのチャンクサイズ（256KBの倍数）と中断時の再開回数
+        GOOGLE_DRIVE_CHUNK_SIZE=int(os.environ.get('GOOGLE_DRIVE_CHUNK_SIZE', str(8 * 1024 * 1024))),
+        GOOGLE_DRIVE_MAX_RETRIES=int(os.environ.get('GOOGLE_DRIVE_MAX_RETRIES', '5')),
+        # Google Driveへのバックグラウンドアップロード設定
+        DRIVE_UPLOAD_WORKERS=int(os.environ.get('DRIVE_UPLOAD_WORKERS', '2')),
+        DRIVE_UPLOAD_MAX_RETRIES=int(os.environ.get('DRIVE_UPLOAD_MAX_RETRIES', '5')),
+        DRIVE_UPLOAD_BACKOFF=float(os.environ.get('DRIVE_UPLOAD_BACKOFF', '2.0')),
+        # 画像・動画のサムネイル等の作成（Pillow / ffmpeg がある場合のみ）
+        DERIVATIVES_ENABLED=os.environ.get('DERIVATIVES_ENABLED', 'True').lower() == 'true',
+        DERIVATIVE_WORKERS=int(os.environ.get('DERIVATIVE_WORKERS', '1')),
+        THUMBNAIL_SIZE=int(os.environ.get('THUMBNAIL_SIZE', '320')),
+        PREVIEW_SIZE=int(os.environ.get('PREVIEW_SIZE', '1280')),
+        FFMPEG_PATH=os.environ.get('FFMPEG_PATH', None),
+        # 削除した添付ファイルのバックグラウンド削除と孤立ファイルの掃除（秒）
+        FILE_REAPER_INTERVAL=int(os.environ.get('FILE_REAPER_INTERVAL', '60')),
+        ORPHAN_SWEEP_INTERVAL=int(os.environ.get('ORPHAN_SWEEP_INTERVAL', str(6 * 60 * 60))),
+        ORPHAN_GRACE_PERIOD=int(os.environ.get('ORPHAN_GRACE_PERIOD', str(60 * 60))),
+        # APIレスポンスの射影（表示の種類ごとに出力する項目、JSONで指定。app.services.serializers を参照）
+        API_PROJECTIONS=json.loads(os.environ.get('API_PROJECTIONS') or '{}'),
+        # 一覧APIの差分取得（?since=）に使う変更履歴を残す秒数（ORPHAN_SWEEP_INTERVAL ごとに削除）
+        CHANGES_RETENTION=int(os.environ.get('CHANGES_RETENTION', str(7 * 24 * 60 * 60))),
+        # gunicornのワーカー数（レート制限をワーカーごとに等分するために使う）
+        WEB_CONCURRENCY=int(os.environ.get('WEB_CONCURRENCY', '1')),
+        # SocketIOのメッセージキュー（redis:// や amqp:// 等、未設定ならプロセス内で完結）
+        SOCKETIO_MESSAGE_QUEUE=os.environ.get('SOCKETIO_MESSAGE_QUEUE', None),
+        SOCKETIO_CHANNEL=os.environ.get('SOCKETIO_CHANNEL', 'flask-socketio'),
+        # 添付ファイル配信のオフロード（'x-accel' でnginxのX-Accel-Redirect、USE_X_SENDFILEでX-Sendfile）
+        ATTACHMENT_SENDFILE=os.environ.get('ATTACHMENT_SENDFILE', None),
+        ATTACHMENT_ACCEL_PREFIX=os.environ.get('ATTACHMENT_ACCEL_PREFIX', '/protected-uploads/'),
+        USE_X_SENDFILE=os.environ.get('USE_X_SENDFILE', 'False').lower() == 'true'
     )
     
     # 設定ファイルの読み込み
@@ -62,7 +134,10 @@ def create_app(test_config=None):
         app.config.from_mapping(test_config)
     
     # セッションの初期化
-    Session(app)
+    init_session(app)
+    
+    # JSONエンコーダとAPIレスポンスの射影の設定
+    init_serializers(app)
     
     # カスタムフィルターの追加
     @app.template_filter('nl2br')
@@ -97,14 +172,31 @@ def create_app(test_config=None):
         app.logger.info('Golf AI Strategist startup')
     
     # ルートの登録
-    from app.routes import main, board, messages
+    from app.routes import main, board, messages, attachments, search
     app.register_blueprint(main.bp)
     app.register_blueprint(board.bp)
     app.register_blueprint(messages.bp)
+    app.register_blueprint(attachments.bp)
+    app.register_blueprint(search.bp)
     
     # データベースの初期化
     init_db(app)
     
+    # 管理コマンドの登録
+    init_cli(app)
+    
+    # 削除待ちファイルの処理を開始（テスト時は手動で実行）
+    if not app.testing:
+        from app.services.file_reaper import get_file_reaper
+        get_file_reaper(app).start()
+    
+    # 複数ワーカーで動かす場合、ワーカー間で共有されない設定を警告
+    if app.config.get('WEB_CONCURRENCY', 1) > 1:
+        if not app.config.get('SOCKETIO_MESSAGE_QUEUE'):
+            app.logger.warning('WEB_CONCURRENCY>1 ですが SOCKETIO_MESSAGE_QUEUE が未設定のため、リアルタイム通知は同じワーカーの接続にしか届きません')
+        if app.config.get('ANSWER_CACHE_ENABLED') and not app.config.get('ANSWER_CACHE_REDIS_URL'):
+            app.logger.warning('WEB_CONCURRENCY>1 ですが ANSWER_CACHE_REDIS_URL が未設定のため、回答キャッシュはワーカーごとに持ちます')
+    
     # SocketIOの初期化
     socketio = init_socketio(app)
     
@@ -112,6 +204,13 @@ def create_app(test_config=None):
     def inject_now():
         return {'now': datetime.utcnow()}
     
+    @app.context_processor
+    def inject_socketio_transports():
+        # 複数ワーカー時はロングポーリングがワーカー間で分散しないようWebSocketのみ使用
+        if app.config.get('SOCKETIO_MESSAGE_QUEUE'):
+            return {'socketio_transports': ['websocket']}
+        return {'socketio_transports': ['polling', 'websocket']}
+    
     # グローバル変数にアプリケーションを保存（get_wsgi_application関数で使用）
     application = app
     
@@ -0,0 +1,235 @@
+"""
+管理用のFlask CLIコマンド
+使い方: flask --app run <グループ> <コマンド>
+"""
+import json
+import os
+import time
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from app.models.db import Attachment, FileTombstone, db
+
+drive_cli = AppGroup('drive', help='Google Drive関連の管理コマンド')
+files_cli = AppGroup('files', help='添付ファイルの管理コマンド')
+search_cli = AppGroup('search', help='全文検索インデックスの管理コマンド')
+counters_cli = AppGroup('counters', help='コメント数・未読件数などの集計の管理コマンド')
+sessions_cli = AppGroup('sessions', help='サーバーサイドセッションの管理コマンド')
+changes_cli = AppGroup('changes', help='一覧APIの変更履歴の管理コマンド')
+
+# 移行の進捗を保存するファイル名（インスタンスフォルダに作成）
+MIGRATION_CHECKPOINT = 'drive_migration.json'
+
+def init_cli(app):
+    """CLIコマンドを登録"""
+    app.cli.add_command(drive_cli)
+    app.cli.add_command(files_cli)
+    app.cli.add_command(search_cli)
+    app.cli.add_command(counters_cli)
+    app.cli.add_command(sessions_cli)
+    app.cli.add_command(changes_cli)
+
+def _checkpoint_path():
+    return os.path.join(current_app.instance_path, MIGRATION_CHECKPOINT)
+
+def load_checkpoint():
+    """移行の進捗を読み込む（なければ最初から）"""
+    try:
+        with open(_checkpoint_path(), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'last_id': 0, 'migrated': 0, 'failed': []}
+
+def save_checkpoint(checkpoint):
+    """移行の進捗を保存（途中で止めても続きから再開できるように）"""
+    tmp_path = f"{_checkpoint_path()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, _checkpoint_path())
+
+@drive_cli.command('migrate')
+@click.option('--batch-size', default=50, show_default=True, help='1バッチで処理する添付の件数')
+@click.option('--workers', default=4, show_default=True, help='同時アップロード数')
+@click.option('--sleep', 'pause', default=1.0, show_default=True, help='バッチ間の待機秒数（APIのレート制限対策）')
+@click.option('--limit', default=None, type=int, help='今回処理する最大件数')
+@click.option('--restart', is_flag=True, help='保存された進捗を破棄して最初から処理する')
+@click.option('--retry-failed', is_flag=True, help='前回失敗した添付のみ再処理する')
+def migrate_to_drive(batch_size, workers, pause, limit, restart, retry_failed):
+    """ローカル保存の添付ファイルをGoogle Driveへ移行する"""
+    from app.services.google_drive import get_drive_service
+    from app.services.drive_uploader import find_drive_copy, switch_to_drive
+
+    drive_service = get_drive_service()
+    if not drive_service or not drive_service.service:
+        raise click.ClickException('Google Driveが利用できません（USE_GOOGLE_DRIVE と認証情報を確認してください）')
+
+    checkpoint = {'last_id': 0, 'migrated': 0, 'failed': []} if restart else load_checkpoint()
+
+    query = Attachment.query.filter(
+        Attachment.storage_type == 'local',
+        Attachment.file_path.isnot(None)
+    )
+    if retry_failed:
+        query = query.filter(Attachment.id.in_(checkpoint['failed']))
+        checkpoint['failed'] = []
+        start_id = 0
+    else:
+        start_id = checkpoint['last_id']
+
+    total = query.filter(Attachment.id > start_id).count()
+    if limit is not None:
+        total = min(total, limit)
+    click.echo(f"移行対象: {total}件（ID > {start_id}）")
+
+    processed = 0
+    last_id = start_id
+    while processed < total:
+        batch = query.filter(Attachment.id > last_id).order_by(Attachment.id).limit(
+            min(batch_size, total - processed)
+        ).all()
+        if not batch:
+            break
+
+        # 同じ内容の添付は1回だけアップロードする
+        groups = {}
+        for attachment in batch:
+            groups.setdefault(attachment.content_hash or f"id:{attachment.id}", attachment)
+
+        uploads = {'board': [], 'messages': []}
+        for attachment in groups.values():
+            file_metadata = find_drive_copy(attachment.content_hash)
+            if file_metadata:
+                switch_to_drive(attachment, file_metadata)
+                checkpoint['migrated'] += 1
+            else:
+                subfolder = 'messages' if attachment.message_id else 'board'
+                uploads[subfolder].append(attachment)
+
+        for subfolder, attachments in uploads.items():
+            if not attachments:
+                continue
+            results = drive_service.upload_files(
+                [(a.file_path, a.filename) for a in attachments],
+                subfolder=subfolder,
+                max_workers=workers
+            )
+            for attachment, file_metadata in zip(attachments, results):
+                if file_metadata:
+                    switch_to_drive(attachment, file_metadata)
+                    checkpoint['migrated'] += 1
+                else:
+                    checkpoint['failed'].append(attachment.id)
+
+        processed += len(batch)
+        last_id = batch[-1].id
+        if not retry_failed:
+            checkpoint['last_id'] = last_id
+        save_checkpoint(checkpoint)
+        db.session.expunge_all()
+
+        click.echo(
+            f"[{processed}/{total}] 移行済み: {checkpoint['migrated']}件, "
+            f"失敗: {len(checkpoint['failed'])}件（最終ID={last_id}）"
+        )
+
+        if processed < total and pause > 0:
+            time.sleep(pause)
+
+    click.echo('完了しました' if not checkpoint['failed'] else
+               '完了しました（失敗した添付は --retry-failed で再処理できます）')
+
+@files_cli.command('derivatives')
+@click.option('--limit', default=None, type=int, help='今回処理する最大件数')
+def generate_derivatives(limit):
+    """サムネイル等の派生ファイルがない既存の画像・動画の添付に派生ファイルを作成する"""
+    from app.services.derivatives import get_derivative_pool, needs_variants
+
+    pool = get_derivative_pool(current_app._get_current_object())
+    query = Attachment.query.filter(
+        ~Attachment.variants.any(),
+        db.or_(Attachment.file_type.like('image/%'), Attachment.file_type.like('video/%'))
+    ).order_by(Attachment.id)
+    if limit is not None:
+        query = query.limit(limit)
+
+    created = 0
+    attachment_ids = [attachment.id for attachment in query if needs_variants(attachment)]
+    with click.progressbar(attachment_ids, label='派生ファイルを作成中') as bar:
+        for attachment_id in bar:
+            try:
+                if pool.generate(attachment_id):
+                    created += 1
+            except Exception as e:
+                db.session.rollback()
+                click.echo(f"\nID={attachment_id} の作成に失敗: {str(e)}")
+    click.echo(f"作成: {created}件")
+
+@files_cli.command('reap')
+def reap_files():
+    """削除待ちのファイルをすべて削除する"""
+    from app.services.file_reaper import get_file_reaper
+
+    reaper = get_file_reaper(current_app._get_current_object())
+    total = 0
+    while True:
+        count = reaper.reap()
+        total += count
+        if count < reaper.batch_size:
+            break
+    remaining = FileTombstone.query.count()
+    click.echo(f"削除: {total}件, 削除できずに残っている記録: {remaining}件")
+
+@files_cli.command('sweep')
+@click.option('--dry-run', is_flag=True, help='削除せずに対象を表示する')
+@click.option('--grace', default=None, type=int, help='孤立ファイルとみなすまでの経過秒数')
+def sweep_files(dry_run, grace):
+    """どの添付からも参照されていないアップロードファイルを削除する"""
+    from app.services.file_reaper import get_file_reaper
+
+    reaper = get_file_reaper(current_app._get_current_object())
+    if grace is not None:
+        reaper.grace_period = grace
+    orphans = reaper.sweep_orphans(dry_run=dry_run)
+    for path in orphans:
+        click.echo(path)
+    click.echo(f"{'削除対象' if dry_run else '削除'}: {len(orphans)}件")
+
+@search_cli.command('reindex')
+@click.option('--batch-size', default=500, show_default=True, help='1回にコミットする件数')
+def reindex(batch_size):
+    """すべての投稿・コメント・メッセージから検索インデックスを作り直す"""
+    from app.services.search import rebuild_index, search_backend
+
+    click.echo(f"検索方式: {search_backend()}")
+    count = rebuild_index(
+        batch_size=batch_size,
+        progress=lambda n: click.echo(f"\r登録済み: {n}件", nl=False)
+    )
+    click.echo(f"\n完了しました（{count}件）")
+
+@counters_cli.command('repair')
+@click.option('--dry-run', is_flag=True, help='修正せずに、ずれている件数を表示する')
+def repair(dry_run):
+    """投稿のコメント数・添付数と会話の最新メッセージ・未読件数を元のデータから数え直す"""
+    from app.services.counters import repair_counters
+
+    result = repair_counters(dry_run=dry_run)
+    label = '修正が必要' if dry_run else '修正'
+    click.echo(f"{label}: 投稿{result['posts']}件, 会話{result['conversations']}件")
+
+@sessions_cli.command('sweep')
+def sweep_sessions():
+    """期限切れのセッションを削除する"""
+    count = current_app.session_interface.sweep()
+    click.echo(f"削除: {count}件")
+
+@changes_cli.command('prune')
+@click.option('--retention', default=None, type=int, help='変更履歴を残す秒数（省略時は CHANGES_RETENTION）')
+def prune(retention):
+    """保持期間を過ぎた変更履歴を削除する（それより古い version からの差分の要求は再取得を求める）"""
+    from app.services.changes import prune_changes
+
+    if retention is None:
+        retention = current_app.config.get('CHANGES_RETENTION', 7 * 24 * 60 * 60)
+    count = prune_changes(retention)
+    click.echo(f"削除: {count}件")
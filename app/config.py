@@ -18,8 +18,6 @@ PERPLEXITY_TEMPERATURE = float(os.environ.get('PERPLEXITY_TEMPERATURE', '0.7'))
 PERPLEXITY_TIMEOUT = int(os.environ.get('PERPLEXITY_TIMEOUT', '25'))  # 25秒タイムアウト
 
 # セッション設定
-SESSION_TYPE = 'filesystem'
-SESSION_FILE_DIR = os.environ.get('SESSION_FILE_DIR', './flask_session')
 SESSION_PERMANENT = False
 PERMANENT_SESSION_LIFETIME = 1800  # 30分
 
@@ -1,11 +1,70 @@
+import os
+import functools
+import itertools
+import logging
+import threading
+import time
+from flask import current_app, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from flask_migrate import Migrate, upgrade
 from datetime import datetime
 
-db = SQLAlchemy()
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# リードレプリカのバインドキーの接頭辞（SQLALCHEMY_BINDS の 'replica_0', 'replica_1', ...）
+REPLICA_BIND_PREFIX = 'replica_'
+
+# 自分の書き込みの直後はプライマリから読むためのCookie（値はプライマリから読む期限のUNIX時刻）
+REPLICA_STICKY_COOKIE = 'db_primary_until'
+
+class RoutingSession(Session):
+    """
+    読み取り専用のエンドポイント（read_from_replica）では、SELECTをリードレプリカに振り分けるセッション
+
+    INSERT・UPDATE・DELETEとflushは常にプライマリで実行し、一度書き込んだ後は
+    同じリクエストの読み込みもプライマリで行う（自分の書き込みが見えるように）
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing:
+                self.info['wrote'] = True
+            elif (self.info.get('replica') and not self.info.get('wrote')
+                  and getattr(clause, 'is_select', False)):
+                # 1リクエストの読み込みは同じレプリカで行う（バージョンと内容が別のレプリカの値にならないように）
+                if 'replica_engine' not in self.info:
+                    router = current_app.extensions.get('replica_router')
+                    self.info['replica_engine'] = router.choose() if router is not None else None
+                engine = self.info['replica_engine']
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def execute(self, statement, *args, **kwargs):
+        result = super().execute(statement, *args, **kwargs)
+        # 1行も変更しなかったUPDATE・DELETE（未読がないときの既読化など）は書き込みとみなさない
+        if getattr(statement, 'is_dml', False) and getattr(result, 'rowcount', 1):
+            self.info['wrote'] = True
+        return result
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+migrate = Migrate()
+
+# マイグレーションスクリプトのディレクトリ（リポジトリ直下の migrations）
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'migrations')
+
+# 複数ワーカーが同時にマイグレーションを実行しないためのPostgreSQLのアドバイザリロックのキー
+MIGRATION_LOCK_KEY = 7283416
 
 class Post(db.Model):
     """掲示板投稿モデル"""
     __tablename__ = 'posts'
+    __table_args__ = (
+        # 投稿一覧のキーセットページネーション用
+        db.Index('ix_posts_created_at_id', 'created_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
@@ -13,6 +72,10 @@ class Post(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     
+    # 一覧表示用の集計（app.services.counters で更新）
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    attachment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # コメントの添付を含む
+    
     comments = db.relationship('Comment', backref='post', lazy=True, cascade="all, delete-orphan")
     attachments = db.relationship('Attachment', backref='post', lazy=True, cascade="all, delete-orphan")
 
@@ -23,6 +86,8 @@ class Post(db.Model):
             'author': self.author,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat(),
+            'comment_count': self.comment_count,
+            'attachment_count': self.attachment_count,
             'comments': [comment.to_dict() for comment in self.comments],
             'attachments': [attachment.to_dict() for attachment in self.attachments],
         }
@@ -31,6 +96,10 @@ class Post(db.Model):
 class Comment(db.Model):
     """投稿へのコメントモデル"""
     __tablename__ = 'comments'
+    __table_args__ = (
+        # 投稿ごとのコメント取得・削除用
+        db.Index('ix_comments_post_id_created_at', 'post_id', 'created_at'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
@@ -54,6 +123,14 @@ class Comment(db.Model):
 class Message(db.Model):
     """DMメッセージモデル"""
     __tablename__ = 'messages'
+    __table_args__ = (
+        # 会話履歴・最新メッセージ取得用
+        db.Index('ix_messages_sender_receiver_created_at', 'sender', 'receiver', 'created_at'),
+        # 会話相手一覧（自分が受信者のメッセージ）取得用
+        db.Index('ix_messages_receiver_sender_created_at', 'receiver', 'sender', 'created_at'),
+        # 未読件数の集計用
+        db.Index('ix_messages_receiver_is_read', 'receiver', 'is_read'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
@@ -76,6 +153,48 @@ class Message(db.Model):
         }
 
 
+class Conversation(db.Model):
+    """DMの会話ごとの集計（最新メッセージ・未読件数）。app.services.counters で更新"""
+    __tablename__ = 'conversations'
+    __table_args__ = (
+        db.UniqueConstraint('user_a', 'user_b', name='uq_conversations_users'),
+        # 会話相手一覧（最新メッセージの新しい順）取得用
+        db.Index('ix_conversations_user_a_last_at', 'user_a', 'last_at'),
+        db.Index('ix_conversations_user_b_last_at', 'user_b', 'last_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    # 参加者（名前の順に user_a, user_b）
+    user_a = db.Column(db.String(100), nullable=False)
+    user_b = db.Column(db.String(100), nullable=False)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('messages.id'), nullable=True)
+    last_at = db.Column(db.DateTime, nullable=True)
+    # それぞれの参加者が未読のメッセージ数
+    unread_a = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    unread_b = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    last_message = db.relationship('Message')
+
+    @staticmethod
+    def participants(user1, user2):
+        """2人のユーザー名を (user_a, user_b) の順に並べる"""
+        return (user1, user2) if user1 <= user2 else (user2, user1)
+
+    def other(self, user):
+        return self.user_b if user == self.user_a else self.user_a
+
+    def unread_count(self, user):
+        return self.unread_a if user == self.user_a else self.unread_b
+
+    def to_dict(self, user):
+        """user から見た会話相手の情報"""
+        return {
+            'username': self.other(user),
+            'latest_message': self.last_message.to_dict() if self.last_message else None,
+            'unread_count': self.unread_count(user),
+        }
+
+
 class Attachment(db.Model):
     """ファイル添付モデル"""
     __tablename__ = 'attachments'
@@ -85,17 +204,21 @@ class Attachment(db.Model):
     file_path = db.Column(db.String(500), nullable=True)  # ローカルストレージの場合のパス
     file_type = db.Column(db.String(100))
     file_size = db.Column(db.Integer)  # バイト単位
+    content_hash = db.Column(db.String(64), nullable=True, index=True)  # 内容のSHA-256（16進）。同じ内容のファイルは1つのblobを共有
     uploaded_at = db.Column(db.DateTime, default=datetime.now)
     
     # Google Drive関連のフィールド
     storage_type = db.Column(db.String(20), default='local')  # 'local' または 'google_drive'
-    drive_file_id = db.Column(db.String(100), nullable=True)  # Google DriveのファイルID
+    drive_file_id = db.Column(db.String(100), nullable=True, index=True)  # Google DriveのファイルID
     drive_view_url = db.Column(db.String(500), nullable=True) # Google Driveの表示URL
     
     # 関連付け（どれか1つだけnullableではない）
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), nullable=True)
-    comment_id = db.Column(db.Integer, db.ForeignKey('comments.id'), nullable=True)
-    message_id = db.Column(db.Integer, db.ForeignKey('messages.id'), nullable=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), nullable=True, index=True)
+    comment_id = db.Column(db.Integer, db.ForeignKey('comments.id'), nullable=True, index=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('messages.id'), nullable=True, index=True)
+    
+    # サムネイル等の派生ファイル（一覧表示で一緒に使うため常にまとめて読み込む）
+    variants = db.relationship('AttachmentVariant', backref='attachment', lazy='selectin', cascade="all, delete-orphan")
 
     def to_dict(self):
         result = {
@@ -105,6 +228,8 @@ class Attachment(db.Model):
             'file_size': self.file_size,
             'uploaded_at': self.uploaded_at.isoformat(),
             'storage_type': self.storage_type,
+            'url': self.access_url,
+            'variants': {variant.kind: variant.to_dict() for variant in self.variants},
         }
         
         # ストレージタイプに応じて適切なURLを提供
@@ -118,16 +243,285 @@ class Attachment(db.Model):
     @property
     def access_url(self):
         """ファイルへのアクセスURLを返す"""
-        if self.storage_type == 'google_drive' and self.drive_view_url:
-            return self.drive_view_url
-        else:
-            # ローカルファイルの場合はルートを返す（実際の実装ではFlaskのurl_forを使用する）
-            return f"/uploads/{self.filename}"
+        return attachment_url(self.id, self.storage_type, self.drive_view_url, self.content_hash)
+
+
+class AttachmentVariant(db.Model):
+    """添付ファイルの派生ファイル（サムネイル・プレビュー・動画のポスター画像）モデル"""
+    __tablename__ = 'attachment_variants'
+    __table_args__ = (
+        db.UniqueConstraint('attachment_id', 'kind', name='uq_attachment_variants_attachment_kind'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    attachment_id = db.Column(db.Integer, db.ForeignKey('attachments.id'), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'thumb' / 'preview' / 'poster'
+    file_path = db.Column(db.String(500), nullable=False)
+    file_type = db.Column(db.String(100))
+    file_size = db.Column(db.Integer)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    content_hash = db.Column(db.String(64), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    def to_dict(self):
+        return {
+            'url': self.access_url,
+            'file_type': self.file_type,
+            'width': self.width,
+            'height': self.height,
+        }
+
+    @property
+    def access_url(self):
+        """派生ファイルへのアクセスURLを返す（内容のハッシュを含め、長期キャッシュさせる）"""
+        return variant_url(self.attachment_id, self.kind, self.content_hash)
+
+
+class ChangeVersion(db.Model):
+    """変更の範囲（掲示板全体・DMの会話ごと）の現在のバージョン。app.services.changes で更新"""
+    __tablename__ = 'change_versions'
+
+    scope = db.Column(db.String(20), primary_key=True)  # 'board' / 'conversation'
+    scope_key = db.Column(db.String(201), primary_key=True)  # 掲示板は''、会話は参加者2人を改行でつないだもの
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # 削除済みの変更履歴の最大のバージョン（これより古いバージョンからの差分は返せない）
+    pruned_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
 
+class Change(db.Model):
+    """変更履歴（差分の取得用）。削除された項目も action='delete' の行として残す"""
+    __tablename__ = 'changes'
+    __table_args__ = (
+        # 範囲ごとの差分の取得用
+        db.Index('ix_changes_scope_version', 'scope', 'scope_key', 'version'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(20), nullable=False)
+    scope_key = db.Column(db.String(201), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    item_type = db.Column(db.String(20), nullable=False)  # 'post' / 'message' / 'read'（既読の範囲）
+    item_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(10), nullable=False)  # 'upsert' / 'delete'
+    created_at = db.Column(db.DateTime, default=datetime.now, index=True)
+
+
+# 添付ファイルのURL（app.services.serializers でカラムの値から直接作る場合にも使う）
+def attachment_url(attachment_id, storage_type, drive_view_url, content_hash):
+    if storage_type == 'google_drive' and drive_view_url:
+        return drive_view_url
+    elif content_hash:
+        # 内容のハッシュを含むURLはブラウザに長期キャッシュさせる
+        return f"/attachments/{attachment_id}/{content_hash}"
+    else:
+        return f"/attachments/{attachment_id}"
+
+def variant_url(attachment_id, kind, content_hash):
+    return f"/attachments/{attachment_id}/variants/{kind}/{content_hash}"
+
+
+class SearchDocument(db.Model):
+    """全文検索用の文書モデル（投稿・コメント・メッセージの本文をn-gramに分割して保持）"""
+    __tablename__ = 'search_documents'
+    __table_args__ = (
+        db.UniqueConstraint('doc_type', 'doc_id', name='uq_search_documents_doc'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    doc_type = db.Column(db.String(20), nullable=False)  # 'post' / 'comment' / 'message'
+    doc_id = db.Column(db.Integer, nullable=False)
+    post_id = db.Column(db.Integer, nullable=True, index=True)  # 投稿・コメントの場合の投稿ID（削除用）
+    sender = db.Column(db.String(100), nullable=True)  # メッセージの場合の送信者・受信者（閲覧権限の判定用）
+    receiver = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    tokens = db.Column(db.Text, nullable=False)  # 空白区切りのn-gram
+
+
+class FileTombstone(db.Model):
+    """削除待ちファイルモデル（添付の削除と同じトランザクションで記録し、バックグラウンドで削除）"""
+    __tablename__ = 'file_tombstones'
+
+    id = db.Column(db.Integer, primary_key=True)
+    storage_type = db.Column(db.String(20), default='local')
+    file_path = db.Column(db.String(500), nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)
+    drive_file_id = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    attempts = db.Column(db.Integer, default=0)  # 削除に失敗した回数
+    last_error = db.Column(db.Text, nullable=True)
+
+
+class StoredSession(db.Model):
+    """サーバーサイドセッション（app.services.session_store のデータベース保存先）"""
+    __tablename__ = 'sessions'
+
+    sid = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)  # flaskのタグ付きJSON
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class ReplicaRouter:
+    """リードレプリカの選択（遅延が許容範囲内のレプリカを順番に使い、なければプライマリ）"""
+
+    def __init__(self, bind_keys, max_lag=5, check_interval=5):
+        """
+        Args:
+            bind_keys (list): レプリカのバインドキー
+            max_lag (float): 読み込みに使うレプリカの最大遅延（秒）
+            check_interval (float): 遅延を確認する間隔（秒）
+        """
+        self.bind_keys = list(bind_keys)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        # バインドキーごとの遅延（秒、接続できなければNone）
+        self._lags = {key: 0.0 for key in self.bind_keys}
+        self._next_check = 0.0
+        self._check_lock = threading.Lock()
+        self._counter = itertools.count()
+
+    @property
+    def sticky_seconds(self):
+        """書き込み後にプライマリから読む秒数（遅延の確認の間に遅れが増える分も含める）"""
+        return self.max_lag + self.check_interval
+
+    def choose(self):
+        """読み込みに使うレプリカのエンジン（使えるものがなければNone）"""
+        self._maybe_check()
+        available = [
+            key for key in self.bind_keys
+            if self._lags[key] is not None and self._lags[key] <= self.max_lag
+        ]
+        if not available:
+            return None
+        return db.engines[available[next(self._counter) % len(available)]]
+
+    def _maybe_check(self):
+        """前回から check_interval 秒以上経っていればレプリカの遅延を確認"""
+        with self._check_lock:
+            if time.monotonic() < self._next_check:
+                return
+            self._next_check = time.monotonic() + self.check_interval
+        self.check()
+
+    def check(self):
+        """各レプリカの遅延を確認"""
+        for key in self.bind_keys:
+            try:
+                lag = measure_replica_lag(db.engines[key])
+            except Exception as e:
+                lag = None
+                if self._lags[key] is not None:
+                    logger.warning(f"リードレプリカ {key} に接続できないため、プライマリから読み込みます: {str(e)}")
+            else:
+                if lag > self.max_lag and (self._lags[key] or 0) <= self.max_lag:
+                    logger.warning(f"リードレプリカ {key} の遅延が {lag:.1f}秒のため、プライマリから読み込みます")
+            self._lags[key] = lag
+
+    def is_sticky(self):
+        """このクライアントが直前に書き込みをしていて、プライマリから読む必要があるか"""
+        try:
+            return float(request.cookies.get(REPLICA_STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def stats(self):
+        return {
+            'max_lag': self.max_lag,
+            'lags': dict(self._lags),
+        }
+
+def measure_replica_lag(engine):
+    """レプリカの遅延（秒）を返す（レプリケーションの情報がないデータベースでは0）"""
+    with engine.connect() as conn:
+        if engine.dialect.name != 'postgresql':
+            conn.execute(db.text('SELECT 1'))
+            return 0.0
+        # 受信済みのWALをすべて適用していれば遅延なし（更新がないとき最後の適用時刻から経過した時間を遅延としない）
+        lag = conn.execute(db.text(
+            "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+            "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        )).scalar()
+        return float(lag or 0)
+
+def read_from_replica(view):
+    """
+    エンドポイントのSELECTをリードレプリカで実行するデコレータ
+
+    レプリカが未設定・遅延している場合と、このクライアントが直前に書き込んだ場合はプライマリから読む
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        router = current_app.extensions.get('replica_router')
+        if router is not None and not router.is_sticky():
+            db.session.info['replica'] = True
+        return view(*args, **kwargs)
+    return wrapper
+
+def init_replicas(app):
+    """SQLALCHEMY_BINDS に登録したリードレプリカの振り分けを有効化"""
+    bind_keys = sorted(key for key in db.engines if key and key.startswith(REPLICA_BIND_PREFIX))
+    if not bind_keys:
+        return None
+    
+    router = ReplicaRouter(
+        bind_keys,
+        max_lag=app.config.get('DATABASE_REPLICA_MAX_LAG', 5),
+        check_interval=app.config.get('DATABASE_REPLICA_CHECK_INTERVAL', 5)
+    )
+    app.extensions['replica_router'] = router
+    
+    @app.after_request
+    def mark_primary_reads(response):
+        # 書き込んだクライアントは、レプリカに反映されるまでプライマリから読む
+        if db.session.info.get('wrote'):
+            response.set_cookie(
+                REPLICA_STICKY_COOKIE,
+                str(int(time.time() + router.sticky_seconds) + 1),
+                max_age=int(router.sticky_seconds) + 1,
+                httponly=True,
+                samesite='Lax'
+            )
+        return response
+    
+    logger.info(f"リードレプリカ: {len(bind_keys)}台")
+    return router
 
 # データベース初期化関数
 def init_db(app):
-    """アプリケーションコンテキストでデータベースを初期化"""
+    """アプリケーションコンテキストでデータベースを初期化（未適用のマイグレーションを適用）"""
+    from app.models.engine import configure_engine, instrument_engine
+    configure_engine(app)
     db.init_app(app)
+    migrate.init_app(app, db, directory=MIGRATIONS_DIR)
     with app.app_context():
-        db.create_all()
+        for engine in db.engines.values():
+            instrument_engine(app, engine)
+        init_replicas(app)
+        
+        if app.config.get('AUTO_MIGRATE', True):
+            upgrade_schema()
+        
+        from app.services.search import init_search_index
+        init_search_index()
+
+def upgrade_schema(revision='head'):
+    """
+    マイグレーションを指定のリビジョンまで適用
+
+    PostgreSQLではアドバイザリロックを取り、複数ワーカーが同時に起動しても1つずつ実行する
+    （SQLite等ではインスタンスフォルダのロックファイルで同じホストのワーカー間で1つずつ実行する）
+    """
+    if db.engine.dialect.name != 'postgresql':
+        from app.services.process_lock import process_lock
+        with process_lock(os.path.join(current_app.instance_path, 'migrate.lock')):
+            upgrade(directory=MIGRATIONS_DIR, revision=revision)
+        return
+    
+    with db.engine.connect() as conn:
+        conn.execute(db.text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        try:
+            upgrade(directory=MIGRATIONS_DIR, revision=revision)
+        finally:
+            conn.execute(db.text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
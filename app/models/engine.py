@@ -0,0 +1,276 @@
+"""
+データベースエンジンの設定
+接続URLの正規化、コネクションプールの設定、接続ごとの初期設定（SQLiteのPRAGMA・PostgreSQLのタイムアウト）と
+プールからの接続の取得にかかった時間の計測を行う
+
+init_db から呼ばれ、SQLALCHEMY_ENGINE_OPTIONS に設定をまとめて Flask-SQLAlchemy にエンジンを作らせる。
+アプリの設定で SQLALCHEMY_ENGINE_OPTIONS を指定した場合はその値を優先する
+"""
+import threading
+import time
+import logging
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from app.models.db import REPLICA_BIND_PREFIX
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# psycopg2 をeventletの待ち合わせに対応させたかどうか
+_green_patched = False
+_green_lock = threading.Lock()
+
+
+class PoolMetrics:
+    """コネクションプールの利用状況（取得回数・待ち時間・タイムアウト）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.connects = 0
+        self.invalidations = 0
+
+    def record_checkout(self, elapsed, waited):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += elapsed
+            self.wait_max = max(self.wait_max, elapsed)
+            if waited:
+                self.waits += 1
+
+    def record_timeout(self, elapsed):
+        with self._lock:
+            self.timeouts += 1
+            self.wait_total += elapsed
+            self.wait_max = max(self.wait_max, elapsed)
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def record_invalidation(self):
+        with self._lock:
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            attempts = self.checkouts + self.timeouts
+            return {
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'avg_wait_ms': round(self.wait_total / attempts * 1000, 3) if attempts else 0.0,
+                'max_wait_ms': round(self.wait_max * 1000, 3),
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """接続の取得にかかった時間を記録する QueuePool"""
+
+    # この秒数以上待った取得は警告を出す（configure_engine で設定）
+    slow_checkout = 0.5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def recreate(self):
+        # dispose() で作り直しても計測値は引き継ぐ
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        # 空き接続がなく上限まで使われている場合は、返却を待つことになる
+        waited = self._max_overflow > -1 and self.checkedin() == 0 and self._overflow >= self._max_overflow
+        started = time.monotonic()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.record_timeout(time.monotonic() - started)
+            logger.error(f"コネクションプールの接続待ちがタイムアウト: {self.status()}")
+            raise
+        elapsed = time.monotonic() - started
+        self.metrics.record_checkout(elapsed, waited)
+        if self.slow_checkout and elapsed >= self.slow_checkout:
+            logger.warning(f"コネクションプールの接続待ち {elapsed:.3f}秒: {self.status()}")
+        return connection
+
+
+def normalize_database_url(url, driver=None):
+    """
+    接続URLをSQLAlchemyが扱える形に揃える
+
+    Args:
+        url (str): 接続URL（RenderなどのPostgreSQLは 'postgres://' で始まる）
+        driver (str): PostgreSQLのドライバ（'psycopg2' / 'pg8000' など、未指定ならURLのまま）
+    """
+    if url.startswith('postgres://'):
+        # SQLAlchemyは'postgresql://'を期待する
+        url = 'postgresql://' + url[len('postgres://'):]
+    if driver:
+        parsed = make_url(url)
+        if parsed.get_backend_name() == 'postgresql':
+            url = parsed.set(drivername=f"postgresql+{driver}").render_as_string(hide_password=False)
+    return url
+
+def _is_memory_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+def engine_options(app, url):
+    """設定からエンジンのオプションを作成"""
+    config = app.config
+    if url.get_backend_name() == 'sqlite':
+        if _is_memory_sqlite(url):
+            # メモリ上のSQLiteは接続ごとに別のデータベースになるため、Flask-SQLAlchemyの既定（1接続を共有）のまま使う
+            return {}
+        # ファイルのSQLiteは接続の作成が軽く、切断もされないため、プールの大きさと待ち時間だけ設定する
+        return {
+            'poolclass': InstrumentedQueuePool,
+            'pool_size': config.get('DB_POOL_SIZE', 10),
+            'max_overflow': config.get('DB_MAX_OVERFLOW', 20),
+            'pool_timeout': config.get('DB_POOL_TIMEOUT', 10),
+        }
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config.get('DB_POOL_SIZE', 10),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 20),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 10),
+        # DBやプロキシ側で切断された接続を使わないよう、一定時間で作り直し、取得時に生存確認する
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+    }
+
+def use_green_driver(url):
+    """
+    eventlet で動かす場合に、PostgreSQLとの通信中も他の処理が進むようにする
+
+    psycopg2 はC拡張の中でソケットを待つため、monkey_patch だけではその間イベントループ全体が止まる。
+    psycogreen があれば psycopg2 を eventlet の待ち合わせに対応させ、なければ警告する
+    （pg8000 は純粋なPythonのドライバのため monkey_patch されたソケットでそのまま動く）
+    """
+    global _green_patched
+    if url.get_backend_name() != 'postgresql' or url.get_driver_name() != 'psycopg2':
+        return
+
+    try:
+        from eventlet.patcher import is_monkey_patched
+        if not is_monkey_patched('socket'):
+            return
+    except ImportError:
+        return
+
+    with _green_lock:
+        if _green_patched:
+            return
+        try:
+            from psycogreen.eventlet import patch_psycopg
+        except ImportError:
+            logger.warning(
+                "psycogreen がインストールされていないため、psycopg2 の通信中は他のリクエストが止まります"
+                "（psycogreen をインストールするか DATABASE_DRIVER=pg8000 を設定してください）"
+            )
+            return
+        patch_psycopg()
+        _green_patched = True
+        logger.info("psycopg2 を eventlet に対応させました")
+
+def replica_uris(app):
+    """リードレプリカの接続URLの一覧（SQLALCHEMY_REPLICA_URIS はカンマ区切りの文字列またはリスト）"""
+    uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+    if isinstance(uris, str):
+        uris = uris.split(',')
+    return [uri.strip() for uri in uris if uri and uri.strip()]
+
+def configure_engine(app):
+    """接続URLとエンジンのオプションをアプリの設定に反映（db.init_app の前に呼ぶ）"""
+    uri = normalize_database_url(app.config['SQLALCHEMY_DATABASE_URI'], app.config.get('DATABASE_DRIVER'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    url = make_url(uri)
+
+    options = engine_options(app, url)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    # リードレプリカはバインドとして登録する（モデルのテーブルはプライマリのみ、振り分けは RoutingSession）
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for index, replica_uri in enumerate(replica_uris(app)):
+        replica_uri = normalize_database_url(replica_uri, app.config.get('DATABASE_DRIVER'))
+        binds[f"{REPLICA_BIND_PREFIX}{index}"] = {'url': replica_uri, **engine_options(app, make_url(replica_uri))}
+    if binds:
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+    InstrumentedQueuePool.slow_checkout = app.config.get('DB_POOL_SLOW_CHECKOUT', 0.5)
+    use_green_driver(url)
+
+def instrument_engine(app, engine):
+    """接続ごとの初期設定と、プールのイベントの記録を登録（最初の接続の前に呼ぶ）"""
+    dialect = engine.dialect.name
+
+    if dialect == 'sqlite':
+        journal_mode = app.config.get('SQLITE_JOURNAL_MODE', 'WAL')
+        busy_timeout = int(app.config.get('SQLITE_BUSY_TIMEOUT', 5000))
+        synchronous = app.config.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+        file_database = not _is_memory_sqlite(engine.url)
+
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                # WALでは書き込み中も読み込みが止まらない（メモリ上のデータベースでは使えない）
+                if file_database and journal_mode:
+                    cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+                # 他の接続が書き込み中の場合に、すぐにエラーにせず待つミリ秒数
+                cursor.execute(f"PRAGMA busy_timeout={busy_timeout}")
+                # WALでは NORMAL でもデータベースは壊れない（電源断時に直前のコミットが失われることはある）
+                if synchronous:
+                    cursor.execute(f"PRAGMA synchronous={synchronous}")
+            finally:
+                cursor.close()
+
+    elif dialect == 'postgresql':
+        statement_timeout = int(app.config.get('DB_STATEMENT_TIMEOUT', 0))
+        if statement_timeout > 0:
+            @event.listens_for(engine, 'connect')
+            def set_statement_timeout(dbapi_connection, connection_record):
+                # 長いクエリが接続を使い続けてプールを枯渇させないよう打ち切る（ミリ秒）
+                cursor = dbapi_connection.cursor()
+                try:
+                    cursor.execute(f"SET statement_timeout = {statement_timeout}")
+                finally:
+                    cursor.close()
+                dbapi_connection.commit()
+
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        @event.listens_for(engine, 'connect')
+        def count_connect(dbapi_connection, connection_record):
+            engine.pool.metrics.record_connect()
+
+        @event.listens_for(engine, 'invalidate')
+        def count_invalidate(dbapi_connection, connection_record, exception):
+            engine.pool.metrics.record_invalidation()
+
+def pool_stats(engine):
+    """エンジンのコネクションプールの状態と利用状況"""
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            'idle': pool.checkedin(),
+        })
+    metrics = getattr(pool, 'metrics', None)
+    if metrics is not None:
+        stats.update(metrics.stats())
+    return stats
@@ -0,0 +1,146 @@
+from flask import (
+    Blueprint, redirect, request, jsonify, current_app, send_file
+)
+import os
+from app.models.db import Attachment, AttachmentVariant
+
+# 添付ファイル配信用のブループリント（掲示板・メッセージ共通）
+bp = Blueprint('attachments', __name__, url_prefix='/attachments')
+
+# 内容が変わらないファイルのキャッシュ期間（1年）
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# 添付ファイル配信API
+@bp.route('/<int:attachment_id>')
+@bp.route('/<int:attachment_id>/<string:content_hash>')
+def download(attachment_id, content_hash=None):
+    """添付ファイルを配信するAPI
+
+    URLに内容のハッシュが含まれている場合、ETagが一致すればDBを参照せずに304を返す
+    """
+    if content_hash and etag_matches(content_hash):
+        return not_modified(content_hash)
+
+    return serve_attachment(attachment_id, content_hash)
+
+# 派生ファイル（サムネイル等）配信API
+@bp.route('/<int:attachment_id>/variants/<string:kind>/<string:content_hash>')
+def download_variant(attachment_id, kind, content_hash):
+    """添付ファイルの派生ファイル（サムネイル・プレビュー・ポスター画像）を配信するAPI"""
+    if etag_matches(content_hash):
+        return not_modified(content_hash)
+    
+    variant = AttachmentVariant.query.filter_by(
+        attachment_id=attachment_id, kind=kind
+    ).first_or_404()
+    
+    if not os.path.exists(variant.file_path):
+        return jsonify({
+            'error': 'ファイルが見つかりません',
+            'status': 'error'
+        }), 404
+    
+    return send_local_file(
+        variant.file_path, variant.file_type, None, variant.content_hash, as_attachment=False,
+        immutable=content_hash == variant.content_hash
+    )
+
+def etag_matches(content_hash):
+    """If-None-Match が指定のハッシュ（強いETag）と一致するか判定"""
+    return request.if_none_match.contains(content_hash)
+
+def not_modified(content_hash, immutable=True):
+    """304レスポンスを作成"""
+    response = current_app.response_class(status=304)
+    response.set_etag(content_hash)
+    set_cache_headers(response, immutable)
+    return response
+
+def set_cache_headers(response, immutable):
+    """
+    キャッシュヘッダーを設定
+
+    内容のハッシュを含むURL（immutable）は内容が変わらないため長期キャッシュさせる。
+    IDだけのURLは削除後にIDが再利用されることがあるため、毎回ETagで確認させる
+    """
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.public = False
+        response.cache_control.max_age = None
+        response.cache_control.immutable = False
+        response.cache_control.no_cache = True
+
+def serve_attachment(attachment_id, content_hash=None):
+    """
+    添付ファイルのレスポンスを作成
+
+    Rangeリクエスト・条件付きGET（ETag）に対応し、ATTACHMENT_SENDFILE の設定に応じて
+    X-Sendfile / X-Accel-Redirect でフロントのプロキシに配信を任せる
+
+    Args:
+        attachment_id (int): 添付ファイルのID
+        content_hash (str): URLに含まれる内容のハッシュ（添付の内容と一致する場合のみ長期キャッシュさせる）
+    """
+    attachment = Attachment.query.get_or_404(attachment_id)
+
+    # Google Driveに保存されている場合は表示URLへリダイレクト
+    if attachment.storage_type == 'google_drive' and attachment.drive_view_url:
+        return redirect(attachment.drive_view_url)
+
+    if not attachment.file_path or not os.path.exists(attachment.file_path):
+        return jsonify({
+            'error': 'ファイルが見つかりません',
+            'status': 'error'
+        }), 404
+
+    immutable = bool(content_hash) and content_hash == attachment.content_hash
+    if attachment.content_hash and etag_matches(attachment.content_hash):
+        return not_modified(attachment.content_hash, immutable)
+
+    # PDFファイルの場合はプレビュー表示を優先、その他のファイルはダウンロード
+    as_attachment = attachment.file_type != 'application/pdf'
+
+    return send_local_file(
+        attachment.file_path, attachment.file_type, attachment.filename,
+        attachment.content_hash, as_attachment, immutable
+    )
+
+def send_local_file(file_path, file_type, filename, content_hash, as_attachment, immutable=False):
+    """ローカルのファイルを配信するレスポンスを作成（immutable なら長期キャッシュ付き）"""
+    if current_app.config.get('ATTACHMENT_SENDFILE') == 'x-accel':
+        response = accel_redirect(file_path, file_type, filename, content_hash, as_attachment)
+    else:
+        # USE_X_SENDFILE が有効ならsend_fileがX-Sendfileヘッダーで応答する
+        response = send_file(
+            file_path,
+            mimetype=file_type or None,
+            as_attachment=as_attachment,
+            download_name=filename,
+            conditional=True,
+            etag=content_hash or True,
+            max_age=IMMUTABLE_MAX_AGE if immutable else None
+        )
+
+    set_cache_headers(response, immutable)
+    return response
+
+def accel_redirect(file_path, file_type, filename, content_hash, as_attachment):
+    """nginxのX-Accel-Redirectで配信するレスポンスを作成（Rangeはnginxが処理）"""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    relative_path = os.path.relpath(file_path, upload_folder).replace(os.sep, '/')
+    prefix = current_app.config.get('ATTACHMENT_ACCEL_PREFIX', '/protected-uploads/').rstrip('/')
+
+    response = current_app.response_class(
+        mimetype=file_type or 'application/octet-stream'
+    )
+    response.headers['X-Accel-Redirect'] = f"{prefix}/{relative_path}"
+    if as_attachment:
+        response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    else:
+        response.headers['Content-Disposition'] = 'inline'
+    if content_hash:
+        response.set_etag(content_hash)
+    return response
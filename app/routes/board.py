@@ -1,61 +1,29 @@
 from flask import (
     Blueprint, flash, g, redirect, render_template,
-    request, session, url_for, jsonify, current_app, abort,
-    send_from_directory
+    request, session, url_for, jsonify, current_app, abort
 )
-from werkzeug.utils import secure_filename
 import os
-import uuid
 from datetime import datetime
-from app.models.db import db, Post, Comment, Attachment
+from sqlalchemy import or_, and_
+from app.routes.attachments import serve_attachment
+from app.services.changes import (
+    BOARD, changes_since, current_version, make_etag, not_modified, parse_since,
+    record_post_change, with_etag
+)
+from app.services.counters import record_comment
+from app.services.derivatives import schedule_derivatives
+from app.services.file_storage import save_file, schedule_drive_uploads, delete_attachments
+from app.services.file_reaper import get_file_reaper
+from app.services.search import index_comment, index_post, remove_post_documents
+from app.services.serializers import fetch_posts, json_response, projection_signature, request_view
+from app.models.db import db, read_from_replica, Post, Comment, Attachment
 
 # ブループリントの設定
 bp = Blueprint('board', __name__, url_prefix='/board')
 
-# アップロードされたファイルを保存するディレクトリを作成
-def ensure_upload_dir():
-    upload_dir = os.path.join(current_app.instance_path, 'uploads')
-    if not os.path.exists(upload_dir):
-        os.makedirs(upload_dir)
-    return upload_dir
-
-# ファイルアップロード関数
-def save_file(file):
-    if file:
-        upload_dir = ensure_upload_dir()
-        filename = secure_filename(file.filename)
-        # ユニークなファイル名を生成
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        file_path = os.path.join(upload_dir, unique_filename)
-        file.save(file_path)
-        
-        # ファイルタイプの判定を改善
-        file_type = file.content_type
-        if not file_type:
-            # 拡張子からMIMEタイプを推測
-            ext = filename.split('.')[-1].lower()
-            if ext in ['mp4', 'webm', 'ogg']:
-                file_type = f'video/{ext}'
-            elif ext in ['mp3', 'wav']:
-                file_type = f'audio/{ext}'
-            elif ext in ['jpg', 'jpeg']:
-                file_type = 'image/jpeg'
-            elif ext == 'png':
-                file_type = 'image/png'
-            elif ext == 'gif':
-                file_type = 'image/gif'
-            elif ext == 'pdf':
-                file_type = 'application/pdf'
-        
-        # Attachmentモデルに保存
-        attachment = Attachment(
-            filename=filename,
-            file_path=file_path,
-            file_type=file_type,
-            file_size=os.path.getsize(file_path)
-        )
-        return attachment
-    return None
+# 投稿一覧APIの1ページあたりの件数
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
 
 # 掲示板トップページ
 @bp.route('/')
@@ -65,23 +33,115 @@ def index():
 
 # 投稿一覧取得API
 @bp.route('/api/posts')
+@read_from_replica
 def get_posts():
-    """投稿一覧を取得するAPI"""
-    posts = Post.query.order_by(Post.created_at.desc()).all()
-    return jsonify({
-        'posts': [post.to_dict() for post in posts],
+    """投稿一覧を取得するAPI
+
+    Query Parameters:
+        before: 前ページの next_cursor（"<created_at>,<id>" 形式）
+        limit: 取得件数（最大 MAX_PAGE_SIZE、since 指定時は差分の最大件数）
+        since: 前回の version。指定するとそれ以降に追加・更新・削除された投稿だけを返す
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        cursor = parse_cursor(request.args.get('before'))
+        since, changes_limit = parse_since()
+    except ValueError:
+        return jsonify({
+            'error': 'ページ指定が不正です',
+            'status': 'error'
+        }), 400
+    
+    # 掲示板のバージョンが変わっていなければ、読み込み・シリアライズせずに304を返す
+    view = request_view('list')
+    version = current_version(BOARD)
+    etag = make_etag(version, projection_signature(view))
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    
+    if since is not None:
+        return get_post_changes(since, version, changes_limit, view, etag)
+    
+    # キーセットページネーション（created_at, id の降順）
+    conditions = []
+    if cursor:
+        before_at, before_id = cursor
+        conditions.append(or_(
+            Post.created_at < before_at,
+            and_(Post.created_at == before_at, Post.id < before_id)
+        ))
+    
+    # 次ページの有無を判定するために1件多く取得（コメント・添付ファイルはページ単位でまとめて読み込む）
+    posts, keys = fetch_posts(*conditions, limit=limit + 1, view=view)
+    has_more = len(posts) > limit
+    posts = posts[:limit]
+    
+    next_cursor = None
+    if has_more:
+        last_at, last_id = keys[limit - 1]
+        next_cursor = f"{last_at.isoformat()},{last_id}"
+    
+    return with_etag(json_response({
+        'posts': posts,
+        'next_cursor': next_cursor,
+        'version': version,
         'status': 'success'
-    })
+    }), etag)
+
+def get_post_changes(since, version, limit, view, etag):
+    """since 以降に変更された投稿（現在の内容）と削除された投稿のIDを返す"""
+    changes = changes_since(BOARD, '', since, version, limit)
+    if changes is None:
+        return jsonify({
+            'error': '変更履歴が残っていないため、一覧を再取得してください',
+            'reset': True,
+            'status': 'error'
+        }), 410
+    
+    posts = []
+    deleted = changes['deleted']
+    if changes['upserted']:
+        posts, keys = fetch_posts(Post.id.in_(changes['upserted']), view=view)
+        # 記録後に削除された投稿
+        found = {post_id for _, post_id in keys}
+        deleted += [post_id for post_id in changes['upserted'] if post_id not in found]
+    
+    return with_etag(json_response({
+        'posts': posts,
+        'deleted': deleted,
+        'version': changes['version'],
+        'has_more': changes['has_more'],
+        'status': 'success'
+    }), etag)
+
+def parse_cursor(value):
+    """"<created_at>,<id>" 形式のカーソルを (datetime, int) に変換"""
+    if not value:
+        return None
+    created_at, _, post_id = value.rpartition(',')
+    return datetime.fromisoformat(created_at), int(post_id)
 
 # 投稿詳細取得API
 @bp.route('/api/posts/<int:post_id>')
+@read_from_replica
 def get_post(post_id):
     """特定の投稿を取得するAPI"""
-    post = Post.query.get_or_404(post_id)
-    return jsonify({
-        'post': post.to_dict(),
+    view = request_view('full')
+    version = current_version(BOARD)
+    etag = make_etag(version, projection_signature(view))
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    
+    posts, _ = fetch_posts(Post.id == post_id, view=view)
+    if not posts:
+        abort(404)
+    return with_etag(json_response({
+        'post': posts[0],
+        'version': version,
         'status': 'success'
-    })
+    }), etag)
 
 # 新規投稿API
 @bp.route('/api/posts', methods=['POST'])
@@ -100,8 +160,10 @@ def create_post():
     )
     db.session.add(post)
     db.session.flush()  # IDを生成するためにflush
+    index_post(post)
     
     # ファイルがある場合は保存
+    attachments = []
     files = request.files.getlist('files')
     for file in files:
         if file and file.filename:
@@ -109,17 +171,26 @@ def create_post():
             if attachment:
                 attachment.post_id = post.id
                 db.session.add(attachment)
+                attachments.append(attachment)
     
+    post.attachment_count = len(attachments)
+    record_post_change(post.id)
     db.session.commit()
     
+    # サムネイル等の作成と、Google Drive利用時のアップロードはバックグラウンドで行う
+    schedule_derivatives(attachments)
+    schedule_drive_uploads(attachments, subfolder='board')
+    
     # Socket.IOイベントを発火させる
     from app.socketio_events import emit_new_post
-    emit_new_post(post.to_dict())
+    emit_new_post(post)
     
-    return jsonify({
-        'post': post.to_dict(),
+    # コメント・添付は投稿ごとに読み込まず、get_post と同じくまとめて読み込む
+    posts, _ = fetch_posts(Post.id == post.id, view=request_view('full'))
+    return json_response({
+        'post': posts[0],
         'status': 'success'
-    }), 201
+    }, status=201)
 
 # 投稿へのコメント追加API
 @bp.route('/api/posts/<int:post_id>/comments', methods=['POST'])
@@ -141,8 +212,10 @@ def add_comment(post_id):
     )
     db.session.add(comment)
     db.session.flush()  # IDを生成するためにflush
+    index_comment(comment)
     
     # ファイルがある場合は保存
+    attachments = []
     files = request.files.getlist('files')
     for file in files:
         if file and file.filename:
@@ -150,12 +223,19 @@ def add_comment(post_id):
             if attachment:
                 attachment.comment_id = comment.id
                 db.session.add(attachment)
+                attachments.append(attachment)
     
+    record_comment(post.id, len(attachments))
+    record_post_change(post.id)
     db.session.commit()
     
+    # サムネイル等の作成と、Google Drive利用時のアップロードはバックグラウンドで行う
+    schedule_derivatives(attachments)
+    schedule_drive_uploads(attachments, subfolder='board')
+    
     # Socket.IOイベントを発火させる
     from app.socketio_events import emit_new_comment
-    emit_new_comment({'post_id': post.id, 'comment': comment.to_dict()})
+    emit_new_comment(comment)
     
     return jsonify({
         'comment': comment.to_dict(),
@@ -169,27 +249,7 @@ def delete_post(post_id):
     current_app.logger.info(f"投稿削除API呼び出し (DELETE): ID={post_id}")
     """投稿を削除するAPI"""
     post = Post.query.get_or_404(post_id)
-    
-    # 添付ファイルの物理ファイルを削除
-    for attachment in post.attachments:
-        try:
-            if os.path.exists(attachment.file_path):
-                os.remove(attachment.file_path)
-        except Exception as e:
-            current_app.logger.error(f"ファイル削除エラー: {str(e)}")
-    
-    # コメントの添付ファイルも削除
-    for comment in post.comments:
-        for attachment in comment.attachments:
-            try:
-                if os.path.exists(attachment.file_path):
-                    os.remove(attachment.file_path)
-            except Exception as e:
-                current_app.logger.error(f"ファイル削除エラー: {str(e)}")
-    
-    # 投稿を削除（カスケード削除によりコメントと添付ファイルも削除される）
-    db.session.delete(post)
-    db.session.commit()
+    delete_post_and_files(post)
     
     # Socket.IOイベントを発火させる
     from app.socketio_events import emit_delete_post
@@ -207,27 +267,7 @@ def delete_post_alt(post_id):
     current_app.logger.info(f"投稿削除API呼び出し (POST): ID={post_id}")
     
     post = Post.query.get_or_404(post_id)
-    
-    # 添付ファイルの物理ファイルを削除
-    for attachment in post.attachments:
-        try:
-            if os.path.exists(attachment.file_path):
-                os.remove(attachment.file_path)
-        except Exception as e:
-            current_app.logger.error(f"ファイル削除エラー: {str(e)}")
-    
-    # コメントの添付ファイルも削除
-    for comment in post.comments:
-        for attachment in comment.attachments:
-            try:
-                if os.path.exists(attachment.file_path):
-                    os.remove(attachment.file_path)
-            except Exception as e:
-                current_app.logger.error(f"ファイル削除エラー: {str(e)}")
-    
-    # 投稿を削除（カスケード削除によりコメントと添付ファイルも削除される）
-    db.session.delete(post)
-    db.session.commit()
+    delete_post_and_files(post)
     
     # Socket.IOイベントを発火させる
     from app.socketio_events import emit_delete_post
@@ -238,30 +278,29 @@ def delete_post_alt(post_id):
         'status': 'success'
     })
 
+def delete_post_and_files(post):
+    """
+    投稿・コメント・添付をまとめて削除し、添付ファイルを削除待ちとして記録
+
+    ファイルの削除はバックグラウンドで行うため、リクエストはDBの更新だけで完了する
+    """
+    comment_ids = db.select(Comment.id).where(Comment.post_id == post.id)
+    attachment_condition = or_(
+        Attachment.post_id == post.id,
+        Attachment.comment_id.in_(comment_ids)
+    )
+    
+    delete_attachments(attachment_condition)
+    remove_post_documents(post.id)
+    db.session.execute(db.delete(Comment).where(Comment.post_id == post.id))
+    db.session.execute(db.delete(Post).where(Post.id == post.id))
+    record_post_change(post.id, 'delete')
+    db.session.commit()
+    
+    get_file_reaper(current_app._get_current_object()).wake()
+
 # 添付ファイルダウンロードAPI
 @bp.route('/api/attachments/<int:attachment_id>')
 def download_attachment(attachment_id):
-    """添付ファイルをダウンロードするAPI"""
-    attachment = Attachment.query.get_or_404(attachment_id)
-    
-    if not os.path.exists(attachment.file_path):
-        return jsonify({
-            'error': 'ファイルが見つかりません',
-            'status': 'error'
-        }), 404
-    
-    # PDFファイルの場合はプレビュー表示を優先
-    if attachment.file_type == 'application/pdf':
-        return send_from_directory(
-            os.path.dirname(attachment.file_path),
-            os.path.basename(attachment.file_path),
-            as_attachment=False
-        )
-    
-    # その他のファイルはダウンロード
-    return send_from_directory(
-        os.path.dirname(attachment.file_path),
-        os.path.basename(attachment.file_path),
-        as_attachment=True,
-        download_name=attachment.filename
-    )
+    """添付ファイルをダウンロードするAPI（/attachments の共通処理を使用）"""
+    return serve_attachment(attachment_id)
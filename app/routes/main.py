@@ -1,14 +1,20 @@
 from flask import (
     Blueprint, flash, g, redirect, render_template, 
-    request, session, url_for, jsonify, current_app
+    request, session, url_for, jsonify, current_app,
+    Response, stream_with_context
 )
 from werkzeug.exceptions import BadRequest, RequestTimeout
 import uuid
 import time
+import hmac
 from datetime import datetime, timezone, timedelta
 import json
 
-from app.services.perplexity import query_perplexity
+from app.services.perplexity import get_cached_answer, submit_query
+from app.services.llm_scheduler import QueueFull, get_scheduler
+from app.services.answer_cache import get_answer_cache
+from app.models.db import db
+from app.models.engine import pool_stats
 
 bp = Blueprint('main', __name__)
 
@@ -39,38 +45,31 @@ def ask():
         user_input = data.get('question', '').strip()
         
         # 入力バリデーション
-        if not user_input:
-            return jsonify({
-                'error': '質問を入力してください',
-                'status': 'error'
-            }), 400
-        
-        if len(user_input) > 1000:
-            return jsonify({
-                'error': '質問は1000文字以内にしてください',
-                'status': 'error'
-            }), 400
+        error_response = validate_question(user_input)
+        if error_response:
+            return error_response
         
-        # Perplexity APIに問い合わせ
-        response = query_perplexity(user_input)
+        # キャッシュになければスケジューラ経由でPerplexity APIに問い合わせ
+        # （no_cache指定時はキャッシュを参照しない）
+        use_cache = not use_cache_bypass(data)
+        response = get_cached_answer(user_input) if use_cache else None
+        if response is None:
+            job = submit_query(user_input, use_cache=use_cache, priority=0)
+            if not job.wait(current_app.config.get('PERPLEXITY_QUEUE_WAIT', 30)):
+                # 待ち時間内に終わらなければジョブIDを返してポーリングに切り替える
+                session['pending_qa'] = {'job_id': job.id, 'q': user_input}
+                return jsonify({
+                    'job_id': job.id,
+                    'status': 'queued'
+                }), 202
+            response = job.get()
         
         # レスポンスを処理
         answer = response.get('choices', [{}])[0].get('message', {}).get('content', '')
         usage = response.get('usage', {})
         
-        # タイムスタンプを生成（日本時間 = UTC+9）
-        jst = timezone(timedelta(hours=9))
-        timestamp = datetime.now(jst).isoformat()
-        
         # セッションにQ&Aを保存
-        qa_item = {
-            'q': user_input,
-            'a': answer,
-            'ts': timestamp
-        }
-        
-        # セッションを更新
-        session['qa'] = [qa_item]  # 最大1件のみ保存
+        save_answer(user_input, answer)
         
         # レスポンスタイム計算
         response_time = time.time() - start_time
@@ -78,12 +77,14 @@ def ask():
         # ログ出力
         current_app.logger.info(
             f"REQ_ID:{req_id} LATENCY:{response_time:.2f}s "
+            f"CACHE:{'HIT' if response.get('cached') else 'MISS'} "
             f"TOKENS:{usage.get('total_tokens', 0)} "
             f"(P:{usage.get('prompt_tokens', 0)}, C:{usage.get('completion_tokens', 0)})"
         )
         
         return jsonify({
             'answer': answer,
+            'cached': bool(response.get('cached')),
             'status': 'success',
             'response_time': f"{response_time:.2f}"
         })
@@ -102,3 +103,283 @@ def ask():
             'error': '混雑しています。後で試してください',
             'status': 'error'
         }), 503
+
+@bp.route('/api/ask/stream', methods=['POST'])
+def ask_stream():
+    """Perplexity APIの回答をServer-Sent Eventsで逐次返す
+
+    問い合わせはスケジューラ経由で行い（同じ質問の合流・優先度付きキュー・レート制限）、
+    PERPLEXITY_QUEUE_WAIT 秒待っても回答が始まらなければジョブIDを返して
+    GET /api/ask/jobs/<job_id> のポーリングに切り替えてもらう
+    """
+    start_time = time.time()
+    req_id = str(uuid.uuid4())
+    
+    # リクエストからテキストを取得
+    data = request.get_json(silent=True) or {}
+    user_input = data.get('question', '').strip()
+    
+    # 入力バリデーション
+    error_response = validate_question(user_input)
+    if error_response:
+        return error_response
+    
+    # キャッシュになければスケジューラに投入（満杯なら混雑として扱う）
+    use_cache = not use_cache_bypass(data)
+    cached = get_cached_answer(user_input) if use_cache else None
+    job = None
+    if cached is None:
+        try:
+            job = submit_query(user_input, use_cache=use_cache, priority=0, stream=True)
+        except QueueFull:
+            current_app.logger.error(f"ERROR pplx_queue:QueueFull REQ_ID:{req_id}")
+            return jsonify({
+                'error': '混雑しています。後で試してください',
+                'status': 'error'
+            }), 503, {'Retry-After': '10'}
+    
+    # タイムスタンプを生成（日本時間 = UTC+9）
+    jst = timezone(timedelta(hours=9))
+    qa_item = {
+        'q': user_input,
+        'a': '',
+        'ts': datetime.now(jst).isoformat()
+    }
+    
+    # レスポンス開始前にセッションを確定させ、Cookieを発行しておく
+    # （待ちきれずにポーリングに切り替えた場合も GET /api/ask/jobs/<job_id> で保存できるように）
+    session['qa'] = [qa_item]
+    if job is not None:
+        session['pending_qa'] = {'job_id': job.id, 'q': user_input}
+    
+    def sse(payload):
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    
+    def save_session():
+        # レスポンス送信後のため明示的に保存
+        current_app.session_interface.save_session(
+            current_app, session, current_app.response_class()
+        )
+    
+    def generate():
+        if cached is not None:
+            answer = cached['choices'][0]['message']['content']
+            yield sse({'delta': answer})
+        else:
+            chunks = []
+            for delta in job.iter_chunks(timeout=current_app.config.get('PERPLEXITY_QUEUE_WAIT', 30)):
+                chunks.append(delta)
+                yield sse({'delta': delta})
+            
+            if not job.finished:
+                # 待ち時間内に終わらなければジョブIDを返してポーリングに切り替える
+                current_app.logger.info(f"REQ_ID:{req_id} QUEUED job_id:{job.id}")
+                yield sse({
+                    'job_id': job.id,
+                    'status': 'queued'
+                })
+                return
+            
+            if job.error is not None:
+                error_type = type(job.error).__name__
+                current_app.logger.error(f"ERROR pplx_status:{error_type} REQ_ID:{req_id} MSG:{str(job.error)}")
+                session.pop('pending_qa', None)
+                save_session()
+                yield sse({
+                    'error': '混雑しています。後で試してください',
+                    'status': 'error'
+                })
+                return
+            
+            # 途中経過を配信しないジョブ（キャッシュから返した・ストリーミングでない問い合わせ）に合流した場合は全文を返す
+            answer = job.result['choices'][0]['message']['content']
+            if not chunks:
+                yield sse({'delta': answer})
+            session.pop('pending_qa', None)
+        
+        # 完成した回答をセッションに保存
+        qa_item['a'] = answer
+        session['qa'] = [qa_item]
+        save_session()
+        
+        response_time = time.time() - start_time
+        current_app.logger.info(
+            f"REQ_ID:{req_id} LATENCY:{response_time:.2f}s STREAM "
+            f"CACHE:{'HIT' if cached is not None or job.result.get('cached') else 'MISS'}"
+        )
+        
+        yield sse({
+            'status': 'success',
+            'response_time': f"{response_time:.2f}"
+        })
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+@bp.route('/api/ask/jobs', methods=['POST'])
+def submit_ask_job():
+    """質問をジョブとして投入し、すぐにジョブIDを返す
+
+    結果は GET /api/ask/jobs/<job_id> のポーリング、または
+    Socket.IOの watch_job で参加したルームへの ask_job_done イベントで受け取る
+    """
+    data = request.get_json(silent=True) or {}
+    user_input = data.get('question', '').strip()
+    
+    # 入力バリデーション
+    error_response = validate_question(user_input)
+    if error_response:
+        return error_response
+    
+    # キャッシュにあればその場で返す
+    use_cache = not use_cache_bypass(data)
+    response = get_cached_answer(user_input) if use_cache else None
+    if response is not None:
+        answer = response['choices'][0]['message']['content']
+        save_answer(user_input, answer)
+        return jsonify({
+            'answer': answer,
+            'cached': True,
+            'status': 'success'
+        })
+    
+    from app.socketio_events import emit_ask_job_done
+    try:
+        job = submit_query(user_input, use_cache=use_cache, priority=1, on_done=emit_ask_job_done)
+    except Exception as e:
+        current_app.logger.error(f"ERROR pplx_queue:{type(e).__name__} MSG:{str(e)}")
+        return jsonify({
+            'error': '混雑しています。後で試してください',
+            'status': 'error'
+        }), 503, {'Retry-After': '10'}
+    
+    session['pending_qa'] = {'job_id': job.id, 'q': user_input}
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'queue_length': get_scheduler(current_app._get_current_object()).queue_length()
+    }), 202
+
+@bp.route('/api/ask/jobs/<job_id>')
+def get_ask_job(job_id):
+    """投入した質問ジョブの状態・結果を取得"""
+    job = get_scheduler(current_app._get_current_object()).get_job(job_id)
+    if job is None:
+        return jsonify({
+            'error': 'ジョブが見つかりません',
+            'status': 'error'
+        }), 404
+    
+    if not job.finished:
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status
+        }), 202
+    
+    if job.error is not None:
+        return jsonify({
+            'job_id': job.id,
+            'error': '混雑しています。後で試してください',
+            'status': 'error'
+        }), 503
+    
+    answer = job.result['choices'][0]['message']['content']
+    
+    # 自分が投入したジョブならセッションに保存
+    pending = session.get('pending_qa')
+    if pending and pending.get('job_id') == job.id:
+        save_answer(pending['q'], answer)
+        session.pop('pending_qa', None)
+    
+    return jsonify({
+        'job_id': job.id,
+        'answer': answer,
+        'status': 'success'
+    })
+
+@bp.route('/api/ask/cache-stats')
+def cache_stats():
+    """回答キャッシュのヒット率などを返す（このワーカーの値、STATS_TOKEN が必要）"""
+    if not stats_authorized():
+        return stats_not_found()
+    
+    cache = get_answer_cache(current_app)
+    return jsonify({
+        'enabled': cache is not None,
+        'stats': cache.stats() if cache is not None else None,
+        'status': 'success'
+    })
+
+@bp.route('/api/db/pool-stats')
+def db_pool_stats():
+    """データベースのコネクションプールの使用状況と接続待ちを返す（このワーカーの値、STATS_TOKEN が必要）"""
+    if not stats_authorized():
+        return stats_not_found()
+    
+    router = current_app.extensions.get('replica_router')
+    replicas = None
+    if router is not None:
+        replicas = router.stats()
+        replicas['pools'] = {key: pool_stats(db.engines[key]) for key in router.bind_keys}
+    return jsonify({
+        'dialect': db.engine.dialect.name,
+        'stats': pool_stats(db.engine),
+        'replicas': replicas,
+        'status': 'success'
+    })
+
+def stats_authorized():
+    """内部の統計情報APIへのアクセスを許可するか（STATS_TOKEN が設定され、Bearerトークンが一致する場合のみ）"""
+    token = current_app.config.get('STATS_TOKEN')
+    if not token:
+        return False
+    
+    auth = request.headers.get('Authorization', '')
+    if not auth.startswith('Bearer '):
+        return False
+    return hmac.compare_digest(auth[len('Bearer '):].encode('utf-8'), token.encode('utf-8'))
+
+def stats_not_found():
+    """統計情報APIを許可しない場合のレスポンス（APIの存在を明かさないよう404を返す）"""
+    return jsonify({
+        'error': '見つかりません',
+        'status': 'error'
+    }), 404
+
+def use_cache_bypass(data):
+    """リクエストでキャッシュのバイパスが指定されているか判定"""
+    if data.get('no_cache'):
+        return True
+    return 'no-cache' in request.headers.get('Cache-Control', '').lower()
+
+def validate_question(user_input):
+    """質問文を検証し、不正ならエラーレスポンスを返す"""
+    if not user_input:
+        return jsonify({
+            'error': '質問を入力してください',
+            'status': 'error'
+        }), 400
+    
+    if len(user_input) > 1000:
+        return jsonify({
+            'error': '質問は1000文字以内にしてください',
+            'status': 'error'
+        }), 400
+    
+    return None
+
+def save_answer(user_input, answer):
+    """Q&Aをセッションに保存（最大1件のみ）"""
+    # タイムスタンプを生成（日本時間 = UTC+9）
+    jst = timezone(timedelta(hours=9))
+    session['qa'] = [{
+        'q': user_input,
+        'a': answer,
+        'ts': datetime.now(jst).isoformat()
+    }]
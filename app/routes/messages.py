@@ -1,60 +1,29 @@
 from flask import (
     Blueprint, flash, g, redirect, render_template,
-    request, session, url_for, jsonify, current_app, abort,
-    send_from_directory
+    request, session, url_for, jsonify, current_app, abort
 )
-from werkzeug.utils import secure_filename
 import os
-import uuid
 from datetime import datetime
-from app.models.db import db, Message, Attachment
+from sqlalchemy import and_, func, or_
+from app.routes.attachments import serve_attachment
+from app.services.changes import (
+    CONVERSATION, changes_since, conversation_key, current_version, make_etag, not_modified,
+    parse_since, record_message_changes, record_read_change, with_etag
+)
+from app.services.counters import record_message, record_read
+from app.services.derivatives import schedule_derivatives
+from app.services.file_storage import save_file, schedule_drive_uploads
+from app.services.search import index_message
+from app.services.serializers import (
+    fetch_contacts, fetch_messages, json_response, projection_signature, request_view
+)
+from app.models.db import db, read_from_replica, Message, Attachment
 
 bp = Blueprint('messages', __name__, url_prefix='/messages')
 
-# アップロードされたファイルを保存するディレクトリを作成（board.pyと共通化すべき関数）
-def ensure_upload_dir():
-    upload_dir = os.path.join(current_app.instance_path, 'uploads')
-    if not os.path.exists(upload_dir):
-        os.makedirs(upload_dir)
-    return upload_dir
-
-# ファイルアップロード関数（board.pyと共通化すべき関数）
-def save_file(file):
-    if file:
-        upload_dir = ensure_upload_dir()
-        filename = secure_filename(file.filename)
-        # ユニークなファイル名を生成
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        file_path = os.path.join(upload_dir, unique_filename)
-        file.save(file_path)
-        
-        # ファイルタイプの判定を改善
-        file_type = file.content_type
-        if not file_type:
-            # 拡張子からMIMEタイプを推測
-            ext = filename.split('.')[-1].lower()
-            if ext in ['mp4', 'webm', 'ogg']:
-                file_type = f'video/{ext}'
-            elif ext in ['mp3', 'wav']:
-                file_type = f'audio/{ext}'
-            elif ext in ['jpg', 'jpeg']:
-                file_type = 'image/jpeg'
-            elif ext == 'png':
-                file_type = 'image/png'
-            elif ext == 'gif':
-                file_type = 'image/gif'
-            elif ext == 'pdf':
-                file_type = 'application/pdf'
-        
-        # Attachmentモデルに保存
-        attachment = Attachment(
-            filename=filename,
-            file_path=file_path,
-            file_type=file_type,
-            file_size=os.path.getsize(file_path)
-        )
-        return attachment
-    return None
+# 会話履歴APIの1ページあたりの件数
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
 
 # メッセージページ
 @bp.route('/')
@@ -70,8 +39,15 @@ def chat(user):
 
 # ユーザーとのメッセージ履歴取得API
 @bp.route('/api/conversations/<string:user>')
+@read_from_replica
 def get_conversation(user):
-    """特定ユーザーとのメッセージ履歴を取得するAPI"""
+    """特定ユーザーとのメッセージ履歴を取得するAPI
+
+    Query Parameters:
+        before_id: このメッセージIDより古いものを取得（省略時は最新ページ）
+        limit: 取得件数（最大 MAX_PAGE_SIZE、since 指定時は差分の最大件数）
+        since: 前回の version。指定するとそれ以降に追加・更新（既読など）されたメッセージだけを返す
+    """
     # セッションから自分の名前を取得（認証機能がないため、仮の実装）
     sender = session.get('username', request.args.get('sender', ''))
     
@@ -81,38 +57,107 @@ def get_conversation(user):
             'status': 'error'
         }), 400
     
-    # 自分から相手へのメッセージを取得
-    sent_messages = Message.query.filter_by(
-        sender=sender,
-        receiver=user
-    ).all()
+    try:
+        limit = min(max(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        before_id = request.args.get('before_id', type=int)
+        since, changes_limit = parse_since()
+    except ValueError:
+        return jsonify({
+            'error': 'ページ指定が不正です',
+            'status': 'error'
+        }), 400
+    
+    # 最新ページを開いたときに相手からの未読メッセージをまとめて既読に更新
+    if before_id is None:
+        mark_conversation_read(user, sender)
     
-    # 相手から自分へのメッセージを取得
-    received_messages = Message.query.filter_by(
-        sender=user,
-        receiver=sender
-    ).all()
+    # 会話のバージョンが変わっていなければ、読み込み・シリアライズせずに304を返す
+    view = request_view('list')
+    version = current_version(CONVERSATION, conversation_key(sender, user))
+    etag = make_etag(version, sender, projection_signature(view))
+    response = not_modified(etag)
+    if response is not None:
+        return response
     
-    # メッセージを時間順にソート
-    all_messages = sorted(
-        sent_messages + received_messages,
-        key=lambda x: x.created_at
-    )
+    if since is not None:
+        return get_message_changes(sender, user, since, version, changes_limit, view, etag)
     
-    # 未読メッセージを既読に更新
-    for msg in received_messages:
-        if not msg.is_read:
-            msg.is_read = True
+    # 双方向のメッセージを1クエリで取得
+    conditions = [or_(
+        and_(Message.sender == sender, Message.receiver == user),
+        and_(Message.sender == user, Message.receiver == sender)
+    )]
     
-    db.session.commit()
+    # キーセットページネーション（created_at, id の降順）
+    if before_id is not None:
+        before_at = db.session.scalar(db.select(Message.created_at).where(Message.id == before_id))
+        if before_at is None:
+            abort(404)
+        conditions.append(or_(
+            Message.created_at < before_at,
+            and_(Message.created_at == before_at, Message.id < before_id)
+        ))
     
-    return jsonify({
-        'messages': [msg.to_dict() for msg in all_messages],
+    # 次ページの有無を判定するために1件多く取得
+    messages, message_ids = fetch_messages(*conditions, limit=limit + 1, view=view)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    
+    # 画面表示用に古い順へ並べ替え
+    messages.reverse()
+    
+    return with_etag(json_response({
+        'messages': messages,
+        'has_more': has_more,
+        'next_before_id': message_ids[limit - 1] if has_more else None,
+        'version': version,
         'status': 'success'
-    })
+    }), etag)
+
+def get_message_changes(sender, user, since, version, limit, view, etag):
+    """
+    since 以降に追加・更新されたメッセージ（現在の内容、古い順）と既読の範囲を返す
+
+    既読の範囲は送信者ごとの「このIDまでのメッセージが既読」（read: [{'sender', 'read_up_to'}]）
+    """
+    changes = changes_since(CONVERSATION, conversation_key(sender, user), since, version, limit)
+    if changes is None:
+        return jsonify({
+            'error': '変更履歴が残っていないため、会話を再取得してください',
+            'reset': True,
+            'status': 'error'
+        }), 410
+    
+    messages = []
+    deleted = changes['deleted']
+    if changes['upserted']:
+        messages, message_ids = fetch_messages(Message.id.in_(changes['upserted']), view=view)
+        messages.reverse()
+        # 記録後に削除されたメッセージ
+        found = set(message_ids)
+        deleted += [message_id for message_id in changes['upserted'] if message_id not in found]
+    
+    read = []
+    if changes['read']:
+        rows = db.session.execute(
+            db.select(Message.sender, func.max(Message.id)).where(
+                Message.id.in_(changes['read'])
+            ).group_by(Message.sender)
+        ).all()
+        read = [{'sender': row[0], 'read_up_to': row[1]} for row in rows]
+    
+    return with_etag(json_response({
+        'messages': messages,
+        'deleted': deleted,
+        'read': read,
+        'version': changes['version'],
+        'has_more': changes['has_more'],
+        'status': 'success'
+    }), etag)
 
 # 会話相手一覧取得API
 @bp.route('/api/contacts')
+@read_from_replica
 def get_contacts():
     """メッセージのやり取りがある相手一覧を取得するAPI"""
     # セッションから自分の名前を取得（認証機能がないため、仮の実装）
@@ -124,47 +169,10 @@ def get_contacts():
             'status': 'error'
         }), 400
     
-    # 自分が送信したメッセージの相手を取得
-    sent_to = db.session.query(Message.receiver.distinct()).filter_by(sender=sender).all()
-    sent_to = [user[0] for user in sent_to]
-    
-    # 自分が受信したメッセージの送信者を取得
-    received_from = db.session.query(Message.sender.distinct()).filter_by(receiver=sender).all()
-    received_from = [user[0] for user in received_from]
+    # 会話ごとの集計（最新メッセージ・未読件数）を読むだけで一覧を作る（最新メッセージの日時順）
+    contact_details = fetch_contacts(sender, view=request_view('list'))
     
-    # 重複を排除して一覧を作成
-    contacts = sorted(list(set(sent_to + received_from)))
-    
-    # 各連絡先の最新メッセージと未読件数を取得
-    contact_details = []
-    for contact in contacts:
-        # 最新メッセージを取得
-        latest_message = Message.query.filter(
-            ((Message.sender == sender) & (Message.receiver == contact)) |
-            ((Message.sender == contact) & (Message.receiver == sender))
-        ).order_by(Message.created_at.desc()).first()
-        
-        # 未読件数を取得
-        unread_count = Message.query.filter_by(
-            sender=contact,
-            receiver=sender,
-            is_read=False
-        ).count()
-        
-        contact_details.append({
-            'username': contact,
-            'latest_message': latest_message.to_dict() if latest_message else None,
-            'unread_count': unread_count
-        })
-    
-    # 最新メッセージの日時でソート
-    contact_details = sorted(
-        contact_details,
-        key=lambda x: x['latest_message']['created_at'] if x['latest_message'] else '1970-01-01',
-        reverse=True
-    )
-    
-    return jsonify({
+    return json_response({
         'contacts': contact_details,
         'status': 'success'
     })
@@ -187,8 +195,11 @@ def send_message():
     )
     db.session.add(message)
     db.session.flush()  # IDを生成するためにflush
+    index_message(message)
+    record_message(message)
     
     # ファイルがある場合は保存
+    attachments = []
     files = request.files.getlist('files')
     for file in files:
         if file and file.filename:
@@ -196,12 +207,18 @@ def send_message():
             if attachment:
                 attachment.message_id = message.id
                 db.session.add(attachment)
+                attachments.append(attachment)
     
+    record_message_changes(message.sender, message.receiver, [message.id])
     db.session.commit()
     
-    # Socket.IOイベントを発火させる（後で実装）
-    # socketio.emit('new_message', message.to_dict())
-    # socketio.emit(f'new_message_{message.receiver}', message.to_dict())
+    # サムネイル等の作成と、Google Drive利用時のアップロードはバックグラウンドで行う
+    schedule_derivatives(attachments)
+    schedule_drive_uploads(attachments, subfolder='messages')
+    
+    # Socket.IOイベントを発火させる
+    from app.socketio_events import emit_new_message
+    emit_new_message(message)
     
     return jsonify({
         'message': message.to_dict(),
@@ -221,47 +238,54 @@ def mark_as_read(user):
             'status': 'error'
         }), 400
     
-    # 未読メッセージを既読に更新
-    unread_messages = Message.query.filter_by(
-        sender=user,
-        receiver=receiver,
-        is_read=False
-    ).all()
-    
-    for msg in unread_messages:
-        msg.is_read = True
-    
-    db.session.commit()
+    # 未読メッセージを一括で既読に更新
+    read_count = mark_conversation_read(user, receiver)
     
     return jsonify({
-        'message': f'{len(unread_messages)}件のメッセージを既読にしました',
+        'message': f'{read_count}件のメッセージを既読にしました',
+        'read_count': read_count,
         'status': 'success'
     })
 
-# 添付ファイルダウンロードAPI（board.pyと重複するため、共通化を検討）
-@bp.route('/api/attachments/<int:attachment_id>')
-def download_attachment(attachment_id):
-    """添付ファイルをダウンロードするAPI"""
-    attachment = Attachment.query.get_or_404(attachment_id)
+def mark_conversation_read(sender, receiver):
+    """senderからreceiverへの未読メッセージを1回のUPDATEで既読にし、件数を返す"""
+    unread = (
+        Message.sender == sender,
+        Message.receiver == receiver,
+        Message.is_read == False
+    )
     
-    if not os.path.exists(attachment.file_path):
-        return jsonify({
-            'error': 'ファイルが見つかりません',
-            'status': 'error'
-        }), 404
+    # 既読にする範囲の最大のID（変更履歴にはメッセージごとではなく「このIDまで既読」を1件だけ記録する）
+    # （レプリカの遅れで未読を見落とさないよう、read_from_replica のエンドポイントでもプライマリから読む）
+    read_up_to = db.session.scalar(
+        db.select(func.max(Message.id)).where(*unread),
+        bind_arguments={'bind': db.engine}
+    )
+    if read_up_to is None:
+        return 0
     
-    # PDFファイルの場合はプレビュー表示を優先
-    if attachment.file_type == 'application/pdf':
-        return send_from_directory(
-            os.path.dirname(attachment.file_path),
-            os.path.basename(attachment.file_path),
-            as_attachment=False
-        )
+    read_count = db.session.execute(
+        db.update(Message).where(*unread, Message.id <= read_up_to)
+        .values(is_read=True).execution_options(synchronize_session=False)
+    ).rowcount
+    record_read(sender, receiver, read_count)
+    if read_count:
+        record_read_change(sender, receiver, read_up_to)
+    db.session.commit()
     
-    # その他のファイルはダウンロード
-    return send_from_directory(
-        os.path.dirname(attachment.file_path),
-        os.path.basename(attachment.file_path),
-        as_attachment=True,
-        download_name=attachment.filename
-    )
+    # 既読になったメッセージがあれば送信者に通知
+    if read_count:
+        from app.socketio_events import emit_read_messages
+        emit_read_messages({
+            'sender': sender,
+            'receiver': receiver,
+            'read_count': read_count
+        })
+    
+    return read_count
+
+# 添付ファイルダウンロードAPI
+@bp.route('/api/attachments/<int:attachment_id>')
+def download_attachment(attachment_id):
+    """添付ファイルをダウンロードするAPI（/attachments の共通処理を使用）"""
+    return serve_attachment(attachment_id)
@@ -0,0 +1,57 @@
+from flask import Blueprint, request, session, jsonify
+from app.services.search import search as search_documents
+
+# 全文検索用のブループリント（掲示板・メッセージ共通）
+bp = Blueprint('search', __name__)
+
+# 検索結果の1ページあたりの件数
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# 検索対象の種類
+DOC_TYPES = ('post', 'comment', 'message')
+
+# 全文検索API
+@bp.route('/api/search')
+def search():
+    """投稿・コメント・メッセージを全文検索するAPI
+
+    Query Parameters:
+        q: 検索語（空白区切りの語はすべて含むものを返す）
+        type: 対象の種類（post, comment, message をカンマ区切り、省略時はすべて）
+        page: ページ番号（1始まり）
+        limit: 1ページの件数（最大 MAX_PAGE_SIZE）
+
+    メッセージはセッションのユーザーが送受信したもののみ検索する（未ログインなら対象外）
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({
+            'error': '検索語を指定してください',
+            'status': 'error'
+        }), 400
+    
+    doc_types = None
+    if request.args.get('type'):
+        doc_types = [t for t in request.args.get('type').split(',') if t in DOC_TYPES]
+        if not doc_types:
+            return jsonify({
+                'error': f"type には {', '.join(DOC_TYPES)} を指定してください",
+                'status': 'error'
+            }), 400
+    
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    # クエリパラメータで他人を名乗ってメッセージを検索できないよう、セッションのユーザーのみ使う
+    user = session.get('username', '')
+    
+    results, total = search_documents(query, user=user, doc_types=doc_types, page=page, per_page=limit)
+    
+    return jsonify({
+        'results': results,
+        'total': total,
+        'page': page,
+        'limit': limit,
+        'has_more': page * limit < total,
+        'status': 'success'
+    })
@@ -0,0 +1,152 @@
+"""
+キャディアドバイスの回答キャッシュ
+正規化した質問文とモデル設定をキーに、Perplexity APIの回答を再利用する
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+import logging
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_prompt(text):
+    """
+    質問文を正規化
+
+    全角英数・半角カナなどの表記ゆれをNFKCで揃え、空白の連続を1つにまとめる
+    """
+    text = unicodedata.normalize('NFKC', text or '')
+    return _WHITESPACE_RE.sub(' ', text).strip().lower()
+
+def make_cache_key(prompt, model, temperature, max_tokens, system_prompt):
+    """キャッシュキーを作成（システムプロンプトはハッシュで含める）"""
+    system_hash = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()
+    raw = json.dumps(
+        [normalize_prompt(prompt), model, temperature, max_tokens, system_hash],
+        ensure_ascii=False
+    )
+    return 'pplx:' + hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class AnswerCache:
+    """TTL付きLRUキャッシュ（ワーカー内メモリ + 任意の共有バックエンド）"""
+
+    def __init__(self, max_entries=512, ttl=3600, shared=None):
+        """
+        Args:
+            max_entries (int): メモリ上に保持する最大件数
+            ttl (int): 有効期間（秒）
+            shared: cachelibのキャッシュ（RedisCache等）。Noneならメモリのみ
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """キャッシュから値を取得（なければNone）"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        # メモリになければ共有バックエンドを参照
+        value = None
+        if self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                logger.warning(f"共有キャッシュの取得に失敗: {str(e)}")
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, value, now)
+        return value
+
+    def set(self, key, value):
+        """キャッシュに値を保存"""
+        with self._lock:
+            self._store(key, value, time.time())
+
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, timeout=self.ttl)
+            except Exception as e:
+                logger.warning(f"共有キャッシュの保存に失敗: {str(e)}")
+
+    def _store(self, key, value, now):
+        """メモリに保存し、上限を超えたら古いものから削除（ロック取得済みで呼ぶ）"""
+        self._entries[key] = (now + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """メモリ上のキャッシュを削除"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ヒット率などの統計情報を返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+# シングルトンパターンでキャッシュインスタンスを提供する関数
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+def get_answer_cache(app):
+    """回答キャッシュのシングルトンインスタンスを取得（無効化されていればNone）"""
+    global _answer_cache
+
+    if not app.config.get('ANSWER_CACHE_ENABLED', True):
+        return None
+
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            shared = None
+            redis_url = app.config.get('ANSWER_CACHE_REDIS_URL')
+            if redis_url:
+                try:
+                    import redis
+                    from cachelib.redis import RedisCache
+                    shared = RedisCache(
+                        host=redis.from_url(redis_url),
+                        default_timeout=app.config.get('ANSWER_CACHE_TTL', 86400)
+                    )
+                except Exception as e:
+                    logger.error(f"共有キャッシュの初期化に失敗: {str(e)}")
+
+            _answer_cache = AnswerCache(
+                max_entries=app.config.get('ANSWER_CACHE_MAX_ENTRIES', 512),
+                ttl=app.config.get('ANSWER_CACHE_TTL', 86400),
+                shared=shared
+            )
+
+    return _answer_cache
@@ -0,0 +1,236 @@
+"""
+変更のバージョンと差分
+掲示板全体とDMの会話ごとにバージョン（書き込みのたびに増える番号）を持ち、
+一覧APIのETagと、?since=<バージョン> による差分（追加・更新・削除された項目）の取得に使う
+
+バージョンの更新は change_versions の行の「version = version + n」のUPDATEで行い、変更履歴と同じ
+トランザクションでコミットする。同じ範囲への書き込みはこの行のロックで順番に並ぶため、
+バージョンの順にコミットされ、差分の取得で途中の変更を取りこぼさない（書き込みの最後、コミットの直前に呼ぶこと）
+"""
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from flask import current_app, request
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from app.models.db import Change, ChangeVersion, Comment, Conversation, Message, db
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# 変更の範囲
+BOARD = 'board'
+CONVERSATION = 'conversation'
+
+# 既読の範囲の変更（item_id はその時点で既読にした最大のメッセージID）
+READ = 'read'
+
+# 差分の1回の最大件数
+DEFAULT_CHANGES_LIMIT = 200
+MAX_CHANGES_LIMIT = 1000
+
+
+def conversation_key(user1, user2):
+    """2人の会話の範囲のキー（参加者の並び順は Conversation.participants と同じ）"""
+    return '\n'.join(Conversation.participants(user1, user2))
+
+# 変更の記録（呼び出し側のトランザクションでコミットする）
+def record_changes(scope, scope_key, item_type, item_ids, action='upsert'):
+    """
+    項目の変更を記録し、範囲のバージョンを進める
+
+    Args:
+        scope (str): BOARD / CONVERSATION
+        scope_key (str): 範囲のキー（掲示板は''、会話は conversation_key）
+        item_type (str): 'post' / 'message' / READ
+        item_ids (list): 変更された項目のID
+        action (str): 'upsert'（追加・更新）/ 'delete'（削除）
+    """
+    item_ids = list(dict.fromkeys(item_ids))
+    if not item_ids:
+        return None
+
+    version = _advance_version(scope, scope_key, len(item_ids))
+    first = version - len(item_ids) + 1
+    now = datetime.now()
+    db.session.execute(db.insert(Change), [
+        {
+            'scope': scope,
+            'scope_key': scope_key,
+            'version': first + i,
+            'item_type': item_type,
+            'item_id': item_id,
+            'action': action,
+            'created_at': now,
+        }
+        for i, item_id in enumerate(item_ids)
+    ])
+    return version
+
+def record_post_change(post_id, action='upsert'):
+    """投稿（コメント・添付を含む）の変更を記録"""
+    return record_changes(BOARD, '', 'post', [post_id], action)
+
+def record_message_changes(sender, receiver, message_ids):
+    """会話のメッセージ（既読・添付を含む）の変更を記録"""
+    return record_changes(CONVERSATION, conversation_key(sender, receiver), 'message', message_ids)
+
+def record_read_change(sender, receiver, read_up_to):
+    """receiver が sender からの read_up_to 以前のメッセージを既読にしたことを1件の変更として記録"""
+    return record_changes(CONVERSATION, conversation_key(sender, receiver), READ, [read_up_to])
+
+def record_attachment_changes(attachments):
+    """添付の保存先・派生ファイルの変更を、添付先の投稿・メッセージの変更として記録"""
+    post_ids = set()
+    messages = {}
+    for attachment in attachments:
+        if attachment.post_id is not None:
+            post_ids.add(attachment.post_id)
+        elif attachment.comment_id is not None:
+            post_ids.add(db.session.scalar(db.select(Comment.post_id).where(Comment.id == attachment.comment_id)))
+        elif attachment.message_id is not None:
+            row = db.session.execute(
+                db.select(Message.sender, Message.receiver).where(Message.id == attachment.message_id)
+            ).first()
+            if row is not None:
+                messages.setdefault(conversation_key(row.sender, row.receiver), []).append(attachment.message_id)
+
+    post_ids.discard(None)
+    if post_ids:
+        record_changes(BOARD, '', 'post', sorted(post_ids))
+    for scope_key, message_ids in messages.items():
+        record_changes(CONVERSATION, scope_key, 'message', message_ids)
+
+def _advance_version(scope, scope_key, count):
+    """範囲のバージョンを count 進め、新しいバージョンを返す（行のロックはコミットまで保持される）"""
+    condition = (ChangeVersion.scope == scope, ChangeVersion.scope_key == scope_key)
+    updated = db.session.execute(
+        db.update(ChangeVersion).where(*condition).values(
+            version=ChangeVersion.version + count
+        ).execution_options(synchronize_session=False)
+    ).rowcount
+    if not updated:
+        try:
+            # 範囲の最初の変更
+            with db.session.begin_nested():
+                db.session.execute(db.insert(ChangeVersion).values(
+                    scope=scope, scope_key=scope_key, version=count, pruned_version=0
+                ))
+            return count
+        except IntegrityError:
+            # 同じ範囲の最初の変更が同時に記録され、先に行が作られた
+            db.session.execute(
+                db.update(ChangeVersion).where(*condition).values(
+                    version=ChangeVersion.version + count
+                ).execution_options(synchronize_session=False)
+            )
+    return db.session.scalar(db.select(ChangeVersion.version).where(*condition))
+
+# 変更の読み込み
+def current_version(scope, scope_key=''):
+    """範囲の現在のバージョン（変更がなければ0）"""
+    version = db.session.scalar(db.select(ChangeVersion.version).where(
+        ChangeVersion.scope == scope, ChangeVersion.scope_key == scope_key
+    ))
+    return version or 0
+
+def changes_since(scope, scope_key, since, until, limit=DEFAULT_CHANGES_LIMIT):
+    """
+    since より後、until まで（先に current_version で読んだバージョン）の変更をまとめる
+
+    Returns:
+        dict: {'upserted': [ID, ...], 'deleted': [ID, ...], 'read': [既読にした最大のID, ...],
+               'version': 次の since に使うバージョン, 'has_more': 続きがあるか}。
+              since が古すぎて変更履歴が削除済みならNone
+    """
+    pruned_version = db.session.scalar(db.select(ChangeVersion.pruned_version).where(
+        ChangeVersion.scope == scope, ChangeVersion.scope_key == scope_key
+    )) or 0
+    if since < pruned_version:
+        return None
+
+    rows = db.session.execute(
+        db.select(Change.version, Change.item_type, Change.item_id, Change.action).where(
+            Change.scope == scope,
+            Change.scope_key == scope_key,
+            Change.version > since,
+            Change.version <= until
+        ).order_by(Change.version).limit(limit + 1)
+    ).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # 同じ項目の変更は最後のものだけを使う
+    actions = {}
+    for row in rows:
+        key = (row.item_type, row.item_id)
+        actions.pop(key, None)
+        actions[key] = row.action
+    items = [(item_id, action) for (item_type, item_id), action in actions.items() if item_type != READ]
+
+    return {
+        'upserted': [item_id for item_id, action in items if action == 'upsert'],
+        'deleted': [item_id for item_id, action in items if action == 'delete'],
+        'read': [item_id for item_type, item_id in actions if item_type == READ],
+        'version': rows[-1].version if has_more else max(until, since),
+        'has_more': has_more,
+    }
+
+def parse_since():
+    """リクエストの ?since= と ?limit= を返す（since がなければ None）。不正な値は ValueError"""
+    since = request.args.get('since')
+    if since is None:
+        return None, None
+    since = int(since)
+    if since < 0:
+        raise ValueError(since)
+    limit = min(max(int(request.args.get('limit', DEFAULT_CHANGES_LIMIT)), 1), MAX_CHANGES_LIMIT)
+    return since, limit
+
+# 条件付きGET
+def make_etag(version, *parts):
+    """バージョンとリクエストの内容（クエリ文字列・表示する項目など）から弱いETagの値を作る"""
+    digest = hashlib.sha1(repr((request.full_path,) + parts).encode('utf-8')).hexdigest()[:16]
+    return f"{version}-{digest}"
+
+def not_modified(etag):
+    """If-None-Match が一致すれば304のレスポンスを返す（一致しなければNone）"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = current_app.response_class(status=304)
+    return with_etag(response, etag)
+
+def with_etag(response, etag):
+    """ETagを付け、ブラウザには毎回304で確認させる"""
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# 変更履歴の削除
+def prune_changes(retention):
+    """
+    retention 秒より古い変更履歴を削除し、件数を返す
+
+    削除した範囲は pruned_version を進め、それより古いバージョンからの差分の要求には一覧の再取得を求める
+    """
+    cutoff = datetime.now() - timedelta(seconds=retention)
+    pruned = db.session.execute(
+        db.select(Change.scope, Change.scope_key, func.max(Change.version)).where(
+            Change.created_at < cutoff
+        ).group_by(Change.scope, Change.scope_key)
+    ).all()
+    for scope, scope_key, version in pruned:
+        db.session.execute(
+            db.update(ChangeVersion).where(
+                ChangeVersion.scope == scope,
+                ChangeVersion.scope_key == scope_key,
+                ChangeVersion.pruned_version < version
+            ).values(pruned_version=version).execution_options(synchronize_session=False)
+        )
+    count = 0
+    if pruned:
+        count = db.session.execute(db.delete(Change).where(Change.created_at < cutoff)).rowcount
+    db.session.commit()
+    if count:
+        logger.info(f"古い変更履歴を削除: {count}件")
+    return count
@@ -0,0 +1,182 @@
+"""
+一覧表示用の集計の更新
+投稿のコメント数・添付数（posts）と、DMの会話ごとの最新メッセージ・未読件数（conversations）を
+書き込みと同じトランザクションで更新し、一覧・未読バッジの表示では集計せずに読むだけにする
+
+更新はすべて「カラム = カラム + n」のUPDATEで行うため、同時に書き込まれても件数がずれない。
+ずれてしまった場合は repair_counters で元のデータから作り直せる
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import case, func, or_
+from sqlalchemy.exc import IntegrityError
+from app.models.db import Attachment, Comment, Conversation, Message, Post, db
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# 投稿の集計（呼び出し側のトランザクションでコミットする）
+def record_comment(post_id, attachment_count=0):
+    """コメントの追加を投稿のコメント数・添付数に反映"""
+    db.session.execute(
+        db.update(Post).where(Post.id == post_id).values(
+            comment_count=Post.comment_count + 1,
+            attachment_count=Post.attachment_count + attachment_count,
+            # 件数の更新では投稿の更新日時を変えない
+            updated_at=Post.updated_at
+        ).execution_options(synchronize_session=False)
+    )
+
+# 会話の集計（呼び出し側のトランザクションでコミットする）
+def record_message(message):
+    """
+    メッセージの送信を会話の最新メッセージと受信者の未読件数に反映
+
+    Args:
+        message: Message - flush済み（IDと送信日時が確定した）メッセージ
+    """
+    user_a, user_b = Conversation.participants(message.sender, message.receiver)
+    unread = 'unread_a' if message.receiver == user_a else 'unread_b'
+
+    # 送信日時が前後して届いた場合も最新メッセージが古いものに戻らないようにする
+    newer = or_(Conversation.last_at.is_(None), Conversation.last_at <= message.created_at)
+    values = {
+        'last_message_id': case((newer, message.id), else_=Conversation.last_message_id),
+        'last_at': case((newer, message.created_at), else_=Conversation.last_at),
+        unread: getattr(Conversation, unread) + 1,
+    }
+    if _update_conversation(user_a, user_b, values):
+        return
+
+    try:
+        # 最初のメッセージ（会話の行がまだない）
+        with db.session.begin_nested():
+            db.session.execute(db.insert(Conversation).values(
+                user_a=user_a,
+                user_b=user_b,
+                last_message_id=message.id,
+                last_at=message.created_at,
+                unread_a=1 if unread == 'unread_a' else 0,
+                unread_b=1 if unread == 'unread_b' else 0
+            ))
+    except IntegrityError:
+        # 同じ2人の最初のメッセージが同時に送られ、先に行が作られた
+        _update_conversation(user_a, user_b, values)
+
+def record_read(sender, receiver, read_count):
+    """receiver が sender からのメッセージを read_count 件既読にしたことを未読件数に反映"""
+    if not read_count:
+        return
+    user_a, user_b = Conversation.participants(sender, receiver)
+    column = getattr(Conversation, 'unread_a' if receiver == user_a else 'unread_b')
+    _update_conversation(user_a, user_b, {
+        column.key: case((column > read_count, column - read_count), else_=0)
+    })
+
+def _update_conversation(user_a, user_b, values):
+    result = db.session.execute(
+        db.update(Conversation).where(
+            Conversation.user_a == user_a,
+            Conversation.user_b == user_b
+        ).values(**values).execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+# 集計の作り直し
+def repair_counters(dry_run=False):
+    """
+    投稿のコメント数・添付数と会話の集計を、元のデータから数え直して修正する
+
+    Args:
+        dry_run (bool): Trueなら修正せずに件数だけ返す
+
+    Returns:
+        dict: 修正した（dry_runなら修正が必要な）件数 {'posts': n, 'conversations': n}
+    """
+    result = {
+        'posts': _repair_posts(dry_run),
+        'conversations': _repair_conversations(dry_run),
+    }
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+        logger.info(f"集計を修正: 投稿{result['posts']}件, 会話{result['conversations']}件")
+    return result
+
+def _repair_posts(dry_run):
+    """投稿のコメント数・添付数を数え直す"""
+    comment_count = db.select(func.count(Comment.id)).where(
+        Comment.post_id == Post.id
+    ).scalar_subquery()
+    # 投稿自体の添付とコメントの添付
+    attachment_count = db.select(func.count(Attachment.id)).where(
+        Attachment.post_id == Post.id
+    ).scalar_subquery() + db.select(func.count(Attachment.id)).join(
+        Comment, Attachment.comment_id == Comment.id
+    ).where(Comment.post_id == Post.id).scalar_subquery()
+    mismatch = or_(Post.comment_count != comment_count, Post.attachment_count != attachment_count)
+
+    if dry_run:
+        return db.session.scalar(db.select(func.count(Post.id)).where(mismatch))
+    return db.session.execute(
+        db.update(Post).where(mismatch).values(
+            comment_count=comment_count,
+            attachment_count=attachment_count,
+            updated_at=Post.updated_at
+        ).execution_options(synchronize_session=False)
+    ).rowcount
+
+def _repair_conversations(dry_run):
+    """メッセージから会話ごとの最新メッセージ・未読件数を数え直す"""
+    # 送信者→受信者の向きごとに集計し、2人の並び順はPython側で決める
+    # （データベースの照合順序とConversation.participantsの並び順が異なる場合があるため）
+    ranked = db.select(
+        Message.sender,
+        Message.receiver,
+        Message.id.label('message_id'),
+        Message.created_at,
+        func.row_number().over(
+            partition_by=(Message.sender, Message.receiver),
+            order_by=(Message.created_at.desc(), Message.id.desc())
+        ).label('rank'),
+        func.sum(case((Message.is_read == False, 1), else_=0)).over(
+            partition_by=(Message.sender, Message.receiver)
+        ).label('unread')
+    ).subquery()
+
+    expected = {}
+    for row in db.session.execute(db.select(ranked).where(ranked.c.rank == 1)):
+        user_a, user_b = Conversation.participants(row.sender, row.receiver)
+        values = expected.setdefault((user_a, user_b), {
+            'last_message_id': None, 'last_at': None, 'unread_a': 0, 'unread_b': 0
+        })
+        values['unread_a' if row.receiver == user_a else 'unread_b'] += int(row.unread or 0)
+        if values['last_message_id'] is None or (
+            (row.created_at or datetime.min, row.message_id) >
+            (values['last_at'] or datetime.min, values['last_message_id'])
+        ):
+            values['last_message_id'] = row.message_id
+            values['last_at'] = row.created_at
+
+    fixed = 0
+    for conversation in Conversation.query.all():
+        values = expected.pop((conversation.user_a, conversation.user_b), None)
+        if values is None:
+            # メッセージが残っていない会話
+            fixed += 1
+            if not dry_run:
+                db.session.delete(conversation)
+            continue
+        if any(getattr(conversation, key) != value for key, value in values.items()):
+            fixed += 1
+            if not dry_run:
+                for key, value in values.items():
+                    setattr(conversation, key, value)
+
+    # 集計の行がない会話
+    fixed += len(expected)
+    if not dry_run:
+        for (user_a, user_b), values in expected.items():
+            db.session.add(Conversation(user_a=user_a, user_b=user_b, **values))
+    return fixed
@@ -0,0 +1,316 @@
+"""
+画像・動画の添付ファイルから派生ファイル（サムネイル・プレビュー・ポスター画像）を作成
+一覧表示では元のファイルの代わりに縮小したWebPを使い、転送量を抑える
+
+画像の変換には Pillow、動画のポスター画像には ffmpeg を使用する（どちらも無ければその派生ファイルは作成しない）
+"""
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
+from eventlet import tpool
+from flask import current_app
+from app.models.db import Attachment, AttachmentVariant, db
+from app.services.changes import record_attachment_changes
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillowは任意の依存
+    Image = None
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# 派生ファイルの種類ごとの長辺の最大ピクセル数
+DEFAULT_SIZES = {'thumb': 320, 'preview': 1280}
+
+# WebPの画質
+WEBP_QUALITY = 80
+
+# ffmpegの実行時間の上限（秒）
+FFMPEG_TIMEOUT = 60
+
+def pillow_available():
+    return Image is not None
+
+def ffmpeg_path():
+    """ffmpegのパス（見つからなければNone）"""
+    return current_app.config.get('FFMPEG_PATH') or shutil.which('ffmpeg')
+
+def needs_variants(attachment):
+    """派生ファイルを作成する対象の添付か判定"""
+    file_type = attachment.file_type or ''
+    if file_type.startswith('image/') and file_type != 'image/svg+xml':
+        return pillow_available()
+    if file_type.startswith('video/'):
+        return ffmpeg_path() is not None
+    return False
+
+def schedule_derivatives(attachments):
+    """
+    コミット済みの添付の派生ファイルをバックグラウンドで作成
+
+    Args:
+        attachments: list - コミット済みのAttachmentモデル
+    """
+    if not current_app.config.get('DERIVATIVES_ENABLED', True):
+        return
+
+    pool = get_derivative_pool(current_app._get_current_object())
+    # 同じ内容の添付は1回だけ変換する（残りは作成済みの派生ファイルを共有する）
+    scheduled_hashes = set()
+    for attachment in attachments:
+        if not needs_variants(attachment):
+            continue
+        if attachment.content_hash:
+            if attachment.content_hash in scheduled_hashes:
+                continue
+            scheduled_hashes.add(attachment.content_hash)
+        pool.submit(attachment.id)
+
+
+class DerivativePool:
+    """派生ファイルを作成するワーカープール"""
+
+    def __init__(self, app, max_workers=1, sizes=None):
+        """
+        Args:
+            app: Flaskアプリケーション（ジョブはこのアプリのコンテキストで実行）
+            max_workers (int): 同時に変換する数（画像の変換はCPUを使うため少なめにする）
+            sizes (dict): 派生ファイルの種類 -> 長辺の最大ピクセル数
+        """
+        self.app = app
+        self.sizes = sizes or DEFAULT_SIZES
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='derivatives')
+
+    def submit(self, attachment_id):
+        """変換ジョブを投入"""
+        return self._executor.submit(self._run, attachment_id)
+
+    def _run(self, attachment_id):
+        """アプリケーションコンテキスト内で変換を実行"""
+        with self.app.app_context():
+            try:
+                return self.generate(attachment_id)
+            except Exception as e:
+                logger.error(f"派生ファイルの作成に失敗: ID={attachment_id} {str(e)}")
+                db.session.rollback()
+                return False
+            finally:
+                db.session.remove()
+
+    def generate(self, attachment_id):
+        """
+        添付の派生ファイルを作成し、同じ内容の添付にもまとめて登録する
+
+        Returns:
+            bool: 派生ファイルを登録したかどうか
+        """
+        attachment = db.session.get(Attachment, attachment_id)
+        if attachment is None or attachment.variants or not needs_variants(attachment):
+            return False
+
+        # 同じ内容の添付ですでに作成済みならそれを共有する
+        templates = self._existing_variants(attachment)
+        if not templates:
+            templates = self._create_files(attachment)
+        if not templates:
+            return False
+
+        if attachment.content_hash:
+            targets = Attachment.query.filter_by(content_hash=attachment.content_hash).all()
+        else:
+            targets = [attachment]
+
+        updated = []
+        for target in targets:
+            existing_kinds = {variant.kind for variant in target.variants}
+            added = False
+            for kind, values in templates.items():
+                if kind not in existing_kinds:
+                    target.variants.append(AttachmentVariant(kind=kind, **values))
+                    added = True
+            if added:
+                updated.append(target)
+        record_attachment_changes(updated)
+        db.session.commit()
+        logger.info(f"派生ファイルを登録: ID={attachment_id}, 種類={sorted(templates)}, 添付={len(updated)}件")
+
+        from app.socketio_events import emit_attachment_updated
+        for target in updated:
+            emit_attachment_updated(target)
+
+        return True
+
+    def _existing_variants(self, attachment):
+        """同じ内容の添付に登録済みの派生ファイルの情報を返す"""
+        if not attachment.content_hash:
+            return {}
+        variants = AttachmentVariant.query.join(Attachment).filter(
+            Attachment.content_hash == attachment.content_hash
+        ).all()
+        return {
+            variant.kind: variant_values(variant)
+            for variant in variants if os.path.exists(variant.file_path)
+        }
+
+    def _create_files(self, attachment):
+        """元のファイルから派生ファイルを作成し、種類ごとの情報を返す"""
+        with source_file(attachment) as source:
+            if source is None:
+                logger.warning(f"派生ファイルの作成元が見つかりません: ID={attachment.id}")
+                return {}
+            if attachment.file_type.startswith('video/'):
+                return self._video_variants(source)
+            return self._image_variants(source)
+
+    def _image_variants(self, source):
+        """画像を縮小したWebPを作成"""
+        # 変換はCPUを使うため、イベントループを止めないようOSスレッドで実行する
+        rendered = tpool.execute(render_webp, source, self.sizes)
+        return {
+            kind: store_variant(buffer, 'image/webp', size)
+            for kind, (buffer, size) in rendered.items()
+        }
+
+    def _video_variants(self, source):
+        """動画の先頭付近のフレームからポスター画像（とPillowがあればサムネイル）を作成"""
+        max_size = max(self.sizes.values())
+        frame = None
+        # 1秒未満の動画は先頭のフレームを使う
+        for offset in ('1', '0'):
+            result = subprocess.run(
+                [
+                    ffmpeg_path(), '-v', 'error', '-ss', offset, '-i', source,
+                    '-frames:v', '1',
+                    '-vf', f"scale='min({max_size},iw)':'min({max_size},ih)':force_original_aspect_ratio=decrease",
+                    '-f', 'image2', '-c:v', 'mjpeg', 'pipe:1'
+                ],
+                capture_output=True, timeout=FFMPEG_TIMEOUT
+            )
+            if result.returncode == 0 and result.stdout:
+                frame = result.stdout
+                break
+        if frame is None:
+            logger.warning(f"ポスター画像を作成できません: {result.stderr.decode(errors='replace')[:200]}")
+            return {}
+
+        if not pillow_available():
+            return {'poster': store_variant(io.BytesIO(frame), 'image/jpeg', None)}
+
+        rendered = tpool.execute(render_webp, io.BytesIO(frame), {'thumb': self.sizes['thumb']})
+        buffer, size = rendered['thumb']
+        with Image.open(io.BytesIO(frame)) as image:
+            poster_size = image.size
+        return {
+            'poster': store_variant(io.BytesIO(frame), 'image/jpeg', poster_size),
+            'thumb': store_variant(buffer, 'image/webp', size),
+        }
+
+
+def render_webp(source, sizes):
+    """
+    画像を縮小してWebPにエンコード
+
+    Args:
+        source: 画像のパスまたはファイルオブジェクト
+        sizes (dict): 種類 -> 長辺の最大ピクセル数
+
+    Returns:
+        dict: 種類 -> (WebPのバッファ, (幅, 高さ))
+    """
+    results = {}
+    with Image.open(source) as image:
+        # スマートフォンの写真は向きをEXIFで持っているため、画素に反映してから縮小する
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.getbands() else 'RGB')
+        for kind, size in sizes.items():
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+            buffer = io.BytesIO()
+            resized.save(buffer, 'WEBP', quality=WEBP_QUALITY)
+            results[kind] = (buffer, resized.size)
+    return results
+
+
+def variant_values(variant):
+    """派生ファイルの記録を、別の添付に登録するための値に変換"""
+    return {
+        'file_path': variant.file_path,
+        'file_type': variant.file_type,
+        'file_size': variant.file_size,
+        'width': variant.width,
+        'height': variant.height,
+        'content_hash': variant.content_hash,
+    }
+
+def store_variant(buffer, file_type, size):
+    """派生ファイルを内容アドレス方式で保存し、登録用の値を返す"""
+    from app.services.file_storage import store_blob
+    buffer.seek(0)
+    file_path, file_size, content_hash, _, _ = store_blob(buffer, namespace='variants')
+    width, height = size if size else (None, None)
+    return {
+        'file_path': file_path,
+        'file_type': file_type,
+        'file_size': file_size,
+        'width': width,
+        'height': height,
+        'content_hash': content_hash,
+    }
+
+
+@contextmanager
+def source_file(attachment):
+    """
+    派生ファイルの作成元のパスを返すコンテキストマネージャ（見つからなければNone）
+
+    ローカルのblobがすでにDriveへ移されていれば、一時ファイルにダウンロードして使う
+    """
+    if attachment.storage_type == 'local' and attachment.file_path and os.path.exists(attachment.file_path):
+        yield attachment.file_path
+        return
+
+    tmp_path = None
+    try:
+        if attachment.storage_type == 'google_drive' and attachment.drive_file_id:
+            from app.services.google_drive import get_drive_service
+            drive_service = get_drive_service()
+            if drive_service:
+                fd, tmp_path = tempfile.mkstemp(prefix='derivative-')
+                with os.fdopen(fd, 'wb') as f:
+                    downloaded = drive_service.download_file(attachment.drive_file_id, f)
+                if downloaded:
+                    yield tmp_path
+                    return
+        yield None
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# シングルトンパターンでワーカープールを提供する関数
+_derivative_pool = None
+_derivative_pool_lock = threading.Lock()
+
+def get_derivative_pool(app):
+    """派生ファイル作成用ワーカープールのシングルトンインスタンスを取得"""
+    global _derivative_pool
+
+    with _derivative_pool_lock:
+        if _derivative_pool is None:
+            _derivative_pool = DerivativePool(
+                app,
+                max_workers=app.config.get('DERIVATIVE_WORKERS', 1),
+                sizes={
+                    'thumb': app.config.get('THUMBNAIL_SIZE', DEFAULT_SIZES['thumb']),
+                    'preview': app.config.get('PREVIEW_SIZE', DEFAULT_SIZES['preview']),
+                }
+            )
+        return _derivative_pool
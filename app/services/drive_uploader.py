@@ -0,0 +1,204 @@
+"""
+Google Driveへのバックグラウンドアップロード
+アップロードされたファイルはまずローカルのblobとして保存し、コミット後にワーカーが
+Driveへ移してAttachmentを更新する
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from app.models.db import Attachment, FileTombstone, db
+from app.services.changes import record_attachment_changes
+from app.services.google_drive import get_drive_service
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+
+class DriveUploadPool:
+    """Driveアップロードを実行するワーカープール（リトライ・指数バックオフ付き）"""
+
+    def __init__(self, app, max_workers=2, max_retries=5, backoff=2.0, drive_service_factory=None):
+        """
+        Args:
+            app: Flaskアプリケーション（ジョブはこのアプリのコンテキストで実行）
+            max_workers (int): 同時アップロード数
+            max_retries (int): 失敗時の最大再試行回数
+            backoff (float): 初回再試行までの秒数（以降は倍々に延ばす）
+            drive_service_factory (callable): Driveサービスを返す関数（テスト用に差し替え可能）
+        """
+        self.app = app
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.drive_service_factory = drive_service_factory or get_drive_service
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='drive-upload')
+
+    def submit(self, attachment_id, subfolder='uploads'):
+        """アップロードジョブを投入"""
+        return self._executor.submit(self._run, attachment_id, subfolder)
+
+    def _run(self, attachment_id, subfolder):
+        """アプリケーションコンテキスト内でアップロードを実行"""
+        with self.app.app_context():
+            try:
+                return self.upload(attachment_id, subfolder)
+            except Exception as e:
+                logger.error(f"Driveアップロードジョブ失敗: ID={attachment_id} {str(e)}")
+                return False
+            finally:
+                db.session.remove()
+
+    def upload(self, attachment_id, subfolder='uploads'):
+        """
+        ローカル保存済みの添付ファイルをDriveへ移す
+
+        同じ内容（content_hash）のローカル添付もまとめて切り替える
+
+        Returns:
+            bool: Driveへの切り替えに成功したかどうか
+        """
+        attachment = db.session.get(Attachment, attachment_id)
+        if attachment is None or attachment.storage_type != 'local' or not attachment.file_path:
+            return False
+
+        drive_service = self.drive_service_factory()
+        if not drive_service:
+            logger.error("Google Driveサービスが利用できません")
+            return False
+
+        # 同じ内容がすでにDriveにあればアップロードせずに共有する
+        file_metadata = find_drive_copy(attachment.content_hash)
+
+        if file_metadata is None:
+            file_metadata = self._upload_with_retry(drive_service, attachment, subfolder)
+            if not file_metadata:
+                logger.error(f"Driveアップロードを断念、ローカルに保持: ID={attachment_id}")
+                return False
+
+        # アップロード中に別のジョブが切り替えた・添付が削除された場合は、
+        # アップロードしたファイルは削除待ちになる
+        return bool(switch_to_drive(attachment, file_metadata))
+
+    def _upload_with_retry(self, drive_service, attachment, subfolder):
+        """失敗時は指数バックオフで再試行しながらアップロード"""
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                # 待機中に別のジョブが切り替えていれば終了
+                db.session.refresh(attachment)
+                if attachment.storage_type != 'local':
+                    return None
+            try:
+                file_metadata = drive_service.upload_file(
+                    file_path=attachment.file_path,
+                    file_name=attachment.filename,
+                    subfolder=subfolder
+                )
+                if file_metadata:
+                    return file_metadata
+            except Exception as e:
+                logger.warning(f"Driveアップロード失敗（{attempt + 1}回目）: {str(e)}")
+
+            if attempt < self.max_retries:
+                time.sleep(self.backoff * (2 ** attempt))
+        return None
+
+
+def find_drive_copy(content_hash):
+    """同じ内容がすでにDriveにあればそのメタデータを返す（なければNone）"""
+    if not content_hash:
+        return None
+    existing = Attachment.query.filter(
+        Attachment.content_hash == content_hash,
+        Attachment.storage_type == 'google_drive',
+        Attachment.drive_file_id.isnot(None)
+    ).first()
+    if existing is None:
+        return None
+    return {'id': existing.drive_file_id, 'webViewLink': existing.drive_view_url}
+
+
+def switch_to_drive(attachment, file_metadata):
+    """
+    Driveへアップロード済みの添付と、同じblobを参照しているローカル添付をまとめてDriveに切り替える
+
+    アップロード中に状態が変わっている可能性があるため、切り替え時点でまだローカルにある添付だけを
+    条件付きのUPDATEで切り替える。1件も残っていなければ（別のジョブが先に切り替えた・添付が削除された）
+    Driveのファイルを削除待ちにする（ほかの添付が参照していればFileReaperは削除しない）
+
+    コミット後、参照がなくなったローカルのblobを削除してクライアントに通知する
+
+    Args:
+        attachment: Attachment - アップロードした添付
+        file_metadata: dict - Driveのファイルメタデータ（id, webViewLink）
+
+    Returns:
+        list: 切り替えたAttachment
+    """
+    content_hash = attachment.content_hash
+    local_path = attachment.file_path
+    drive_file_id = file_metadata.get('id')
+
+    if content_hash:
+        condition = Attachment.content_hash == content_hash
+    else:
+        condition = Attachment.id == attachment.id
+    target_ids = db.session.scalars(
+        db.select(Attachment.id).where(condition, Attachment.storage_type == 'local').with_for_update()
+    ).all()
+
+    switched = 0
+    if target_ids:
+        switched = db.session.execute(
+            db.update(Attachment).where(
+                Attachment.id.in_(target_ids),
+                Attachment.storage_type == 'local'
+            ).values(
+                storage_type='google_drive',
+                drive_file_id=drive_file_id,
+                drive_view_url=file_metadata.get('webViewLink'),
+                file_path=None
+            ).execution_options(synchronize_session=False)
+        ).rowcount
+
+    if not switched:
+        db.session.add(FileTombstone(storage_type='google_drive', drive_file_id=drive_file_id, attempts=0))
+        db.session.commit()
+        logger.info(f"切り替える添付がないためDriveのファイルを削除待ちに: ID={drive_file_id}")
+        return []
+
+    targets = Attachment.query.filter(
+        Attachment.id.in_(target_ids),
+        Attachment.drive_file_id == drive_file_id
+    ).populate_existing().all()
+    record_attachment_changes(targets)
+    db.session.commit()
+    logger.info(f"Driveへの切り替え完了: ID={file_metadata.get('id')}, 添付={len(targets)}件")
+
+    # 参照がなくなったローカルのblobを削除
+    from app.services.file_storage import release_local_blob
+    release_local_blob(local_path, content_hash)
+
+    from app.socketio_events import emit_attachment_updated
+    for target in targets:
+        emit_attachment_updated(target)
+
+    return targets
+
+
+# シングルトンパターンでワーカープールを提供する関数
+_upload_pool = None
+_upload_pool_lock = threading.Lock()
+
+def get_upload_pool(app):
+    """Driveアップロード用ワーカープールのシングルトンインスタンスを取得"""
+    global _upload_pool
+
+    with _upload_pool_lock:
+        if _upload_pool is None:
+            _upload_pool = DriveUploadPool(
+                app,
+                max_workers=app.config.get('DRIVE_UPLOAD_WORKERS', 2),
+                max_retries=app.config.get('DRIVE_UPLOAD_MAX_RETRIES', 5),
+                backoff=app.config.get('DRIVE_UPLOAD_BACKOFF', 2.0)
+            )
+        return _upload_pool
@@ -0,0 +1,260 @@
+"""
+削除済み添付ファイルのバックグラウンド削除
+FileTombstone に記録されたファイルをまとめて削除し、定期的にアップロードフォルダと
+attachments テーブルを突き合わせて、どこからも参照されていないファイルを掃除する
+（同じ周期で、保持期間を過ぎた一覧APIの変更履歴も削除する）
+
+同じホストの複数のワーカープロセスのうち、ロックファイルを取得した1つだけが処理を行う
+（ほかのワーカーは周期ごとにロックの取得を試み、処理中のワーカーが終了したら引き継ぐ）
+"""
+import os
+import time
+import threading
+import logging
+from app.models.db import Attachment, AttachmentVariant, FileTombstone, db
+from app.services.changes import prune_changes
+from app.services.file_storage import blob_recently_used
+from app.services.google_drive import get_drive_service
+from app.services.process_lock import ProcessLock
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+
+class RecentFileError(Exception):
+    """grace_period 以内に作成・再利用されたため、まだ削除しないファイル"""
+
+
+class FileReaper:
+    """削除待ちファイルの削除と孤立ファイルの掃除を行うバックグラウンドワーカー"""
+
+    def __init__(self, app, interval=60, batch_size=100, max_attempts=10,
+                 sweep_interval=6 * 60 * 60, grace_period=60 * 60, changes_retention=7 * 24 * 60 * 60):
+        """
+        Args:
+            app: Flaskアプリケーション（処理はこのアプリのコンテキストで実行）
+            interval (int): 削除待ちファイルを確認する間隔（秒）
+            batch_size (int): 1回に処理する削除待ちファイルの件数
+            max_attempts (int): 削除に失敗したファイルを再試行する最大回数
+            sweep_interval (int): 孤立ファイルを掃除する間隔（秒、0以下で無効）
+            grace_period (int): 孤立ファイルとみなすまでの経過時間（アップロード中のファイルを除くため）
+            changes_retention (int): 変更履歴を残す秒数（0以下なら削除しない）
+        """
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.sweep_interval = sweep_interval
+        self.grace_period = grace_period
+        self.changes_retention = changes_retention
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._leader = ProcessLock(os.path.join(app.instance_path, 'file_reaper.lock'))
+
+    def start(self):
+        """ワーカースレッドを起動（起動済みなら何もしない）"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        """削除待ちファイルが追加されたことを通知（次の周期を待たずに処理する）"""
+        self.start()
+        self._wake.set()
+
+    def _worker(self):
+        next_sweep = time.monotonic()
+        while True:
+            if not self._leader.acquire(blocking=False):
+                # 別のワーカーが処理している
+                self._wake.wait(self.interval)
+                self._wake.clear()
+                continue
+
+            with self.app.app_context():
+                try:
+                    # 溜まっている分はバッチ単位で続けて処理する（失敗を含むバッチが出たら次の周期へ）
+                    while self.reap() >= self.batch_size:
+                        pass
+                    if self.sweep_interval > 0 and time.monotonic() >= next_sweep:
+                        self.sweep_orphans()
+                        if self.changes_retention > 0:
+                            prune_changes(self.changes_retention)
+                        next_sweep = time.monotonic() + self.sweep_interval
+                except Exception as e:
+                    logger.error(f"ファイル削除ワーカーのエラー: {str(e)}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def reap(self):
+        """
+        削除待ちファイルを1バッチ分削除
+
+        同じ内容・同じDriveファイルを参照する添付が残っているものは削除せずに記録だけ消す
+
+        Returns:
+            int: 処理を終えた（記録を消した）件数
+        """
+        tombstones = FileTombstone.query.filter(
+            FileTombstone.attempts < self.max_attempts
+        ).order_by(FileTombstone.id).limit(self.batch_size).with_for_update(skip_locked=True).all()
+        if not tombstones:
+            db.session.rollback()
+            return 0
+
+        done = []
+        drive_tombstones = {}
+        for tombstone in tombstones:
+            if tombstone.storage_type == 'google_drive' and tombstone.drive_file_id:
+                if self._drive_file_in_use(tombstone.drive_file_id):
+                    done.append(tombstone)
+                else:
+                    drive_tombstones.setdefault(tombstone.drive_file_id, []).append(tombstone)
+            else:
+                try:
+                    self._remove_local(tombstone)
+                    done.append(tombstone)
+                except RecentFileError as e:
+                    # コミット前の添付が再利用している可能性があるため記録を残して次の周期で再試行する
+                    # （grace_period を過ぎるまでは試行回数に数えない）
+                    self._record_failure(tombstone, e, count=False)
+                except OSError as e:
+                    self._record_failure(tombstone, e)
+
+        # Driveのファイルはバッチリクエストでまとめて削除
+        if drive_tombstones:
+            drive_service = get_drive_service()
+            if drive_service:
+                results = drive_service.delete_files(list(drive_tombstones))
+            else:
+                results = {}
+            for drive_file_id, group in drive_tombstones.items():
+                for tombstone in group:
+                    if results.get(drive_file_id):
+                        done.append(tombstone)
+                    else:
+                        self._record_failure(tombstone, 'Google Driveからの削除に失敗')
+
+        for tombstone in done:
+            db.session.delete(tombstone)
+        db.session.commit()
+
+        if done:
+            logger.info(f"削除待ちファイルを処理: {len(done)}/{len(tombstones)}件")
+        return len(done)
+
+    def _drive_file_in_use(self, drive_file_id):
+        return db.session.query(
+            Attachment.query.filter_by(drive_file_id=drive_file_id).exists()
+        ).scalar()
+
+    def _remove_local(self, tombstone):
+        """
+        ローカルファイルを削除（同じ内容の添付・派生ファイルが残っていれば削除しない）
+
+        参照はコミット済みの行しか数えられないため、grace_period 以内に作成・再利用されたファイルは
+        RecentFileError を送出して削除を見送る（sweep_orphans と同じ猶予）
+        """
+        if not tombstone.file_path:
+            return
+        if tombstone.storage_type == 'variant':
+            in_use = AttachmentVariant.query.filter_by(content_hash=tombstone.content_hash)
+        else:
+            in_use = Attachment.query.filter_by(content_hash=tombstone.content_hash, storage_type='local')
+        if tombstone.content_hash and db.session.query(in_use.exists()).scalar():
+            return
+        if blob_recently_used(tombstone.file_path, self.grace_period):
+            raise RecentFileError(f"最近作成・再利用されたファイルのため削除を延期: {tombstone.file_path}")
+        try:
+            os.remove(tombstone.file_path)
+            logger.info(f"ローカルファイル削除: {tombstone.file_path}")
+        except FileNotFoundError:
+            pass
+
+    def _record_failure(self, tombstone, error, count=True):
+        tombstone.last_error = str(error)
+        if not count:
+            logger.info(f"ファイル削除を延期: ID={tombstone.id} {str(error)}")
+            return
+        tombstone.attempts = (tombstone.attempts or 0) + 1
+        logger.warning(f"ファイル削除失敗（{tombstone.attempts}回目）: ID={tombstone.id} {str(error)}")
+
+    def sweep_orphans(self, dry_run=False):
+        """
+        アップロードフォルダ内で、どの添付・派生ファイルからも参照されていないファイルを削除
+
+        grace_period 以内に更新されたファイル（アップロード中・コミット前のもの）は対象外
+
+        Args:
+            dry_run (bool): Trueなら削除せずに対象を返すだけ
+
+        Returns:
+            list: 削除した（dry_runなら削除対象の）ファイルのパス
+        """
+        upload_folder = self.app.config['UPLOAD_FOLDER']
+        if not os.path.isdir(upload_folder):
+            return []
+
+        referenced_paths = set()
+        referenced_hashes = set()
+        queries = (
+            db.session.query(Attachment.file_path, Attachment.content_hash).filter(
+                Attachment.storage_type == 'local'
+            ),
+            db.session.query(AttachmentVariant.file_path, AttachmentVariant.content_hash),
+        )
+        for query in queries:
+            for file_path, content_hash in query.yield_per(1000):
+                if file_path:
+                    referenced_paths.add(os.path.abspath(file_path))
+                if content_hash:
+                    referenced_hashes.add(content_hash)
+        db.session.rollback()
+
+        cutoff = time.time() - self.grace_period
+        orphans = []
+        for dirpath, _, filenames in os.walk(upload_folder):
+            for filename in filenames:
+                path = os.path.abspath(os.path.join(dirpath, filename))
+                if path in referenced_paths or filename in referenced_hashes:
+                    continue
+                try:
+                    if os.path.getmtime(path) > cutoff:
+                        continue
+                    if not dry_run:
+                        os.remove(path)
+                    orphans.append(path)
+                except OSError as e:
+                    logger.warning(f"孤立ファイルの削除に失敗: {path} {str(e)}")
+
+        if orphans:
+            logger.info(f"孤立ファイルを{'検出' if dry_run else '削除'}: {len(orphans)}件")
+        return orphans
+
+
+# シングルトンパターンでワーカーを提供する関数
+_file_reaper = None
+_file_reaper_lock = threading.Lock()
+
+def get_file_reaper(app):
+    """ファイル削除ワーカーのシングルトンインスタンスを取得"""
+    global _file_reaper
+
+    with _file_reaper_lock:
+        if _file_reaper is None:
+            _file_reaper = FileReaper(
+                app,
+                interval=app.config.get('FILE_REAPER_INTERVAL', 60),
+                batch_size=app.config.get('FILE_REAPER_BATCH_SIZE', 100),
+                max_attempts=app.config.get('FILE_REAPER_MAX_ATTEMPTS', 10),
+                sweep_interval=app.config.get('ORPHAN_SWEEP_INTERVAL', 6 * 60 * 60),
+                grace_period=app.config.get('ORPHAN_GRACE_PERIOD', 60 * 60),
+                changes_retention=app.config.get('CHANGES_RETENTION', 7 * 24 * 60 * 60)
+            )
+        return _file_reaper
@@ -3,138 +3,346 @@
 環境設定に応じてローカルまたはGoogle Driveにファイルを保存
 """
 import os
+import time
 import uuid
-import tempfile
+import hashlib
+import mimetypes
+from datetime import datetime
 from werkzeug.utils import secure_filename
 from flask import current_app
-from app.models.db import Attachment, db
+from app.models.db import Attachment, AttachmentVariant, FileTombstone, db
 from app.services.google_drive import get_drive_service
 import logging
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
 
-def save_file(uploaded_file, subfolder='uploads'):
+# 1回に読み書きするサイズ
+CHUNK_SIZE = 64 * 1024
+
+# MIMEタイプ判定に使う先頭バイト数
+SNIFF_BYTES = 32
+
+def sniff_mime_type(head):
+    """
+    ファイル先頭のバイト列からMIMEタイプを判定
+
+    Args:
+        head: bytes - ファイルの先頭部分
+
+    Returns:
+        str: 判定できたMIMEタイプ（不明ならNone）
+    """
+    if head.startswith(b'%PDF'):
+        return 'application/pdf'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head.startswith(b'RIFF') and head[8:12] == b'WAVE':
+        return 'audio/wav'
+    if head[4:8] == b'ftyp':
+        # QuickTime形式（iPhoneの動画など）
+        if head[8:10] == b'qt':
+            return 'video/quicktime'
+        return 'video/mp4'
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'video/webm'
+    if head.startswith(b'OggS'):
+        return 'audio/ogg'
+    if head.startswith(b'ID3') or head[:2] in (b'\xff\xfb', b'\xff\xf3', b'\xff\xf2'):
+        return 'audio/mpeg'
+    return None
+
+def guess_file_type(filename, head, content_type=None):
+    """先頭バイト列 → クライアント申告 → 拡張子 の順でMIMEタイプを決定"""
+    sniffed = sniff_mime_type(head)
+    if sniffed:
+        return sniffed
+    if content_type and content_type != 'application/octet-stream':
+        return content_type
+    guessed, _ = mimetypes.guess_type(filename)
+    return guessed or content_type
+
+def write_stream(stream, file_path):
+    """
+    ストリームをチャンク単位でファイルに書き込みながら、サイズ・ハッシュ・先頭バイトを取得
+
+    書き込み中のファイルは .part として保存し、完了後にリネームする
+
+    Args:
+        stream: 読み込み元のファイルライクオブジェクト
+        file_path: str - 保存先のパス
+
+    Returns:
+        tuple: (サイズ, SHA-256の16進文字列, 先頭バイト列)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    head = b''
+    part_path = f"{file_path}.part"
+    
+    try:
+        with open(part_path, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if len(head) < SNIFF_BYTES:
+                    head += chunk[:SNIFF_BYTES - len(head)]
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        os.replace(part_path, file_path)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    
+    return size, digest.hexdigest(), head
+
+def blob_path(content_hash, namespace='blobs'):
+    """内容のハッシュからblobの保存パスを求める（先頭2文字ずつで2階層に分散）"""
+    return os.path.join(
+        current_app.config['UPLOAD_FOLDER'], namespace,
+        content_hash[:2], content_hash[2:4], content_hash
+    )
+
+def store_blob(stream, namespace='blobs'):
+    """
+    ストリームを内容アドレス方式のblobとして保存
+
+    一時ファイルに書き込みながらハッシュを求め、同じ内容のblobがなければ
+    ハッシュ名にリネームする（あれば一時ファイルを破棄して既存のblobを使う）
+
+    既存のblobを使う場合は mtime を更新し、コミット前の添付から参照されていることを
+    blob_recently_used で判定できるようにする（その間は参照数が0でも削除しない）
+
+    Args:
+        stream: 読み込み元のファイルライクオブジェクト
+        namespace: str - UPLOAD_FOLDER 内の保存先フォルダ（派生ファイルは 'variants'）
+
+    Returns:
+        tuple: (保存パス, サイズ, SHA-256の16進文字列, 先頭バイト列, 新規作成したかどうか)
+    """
+    tmp_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], namespace, 'tmp')
+    os.makedirs(tmp_folder, exist_ok=True)
+    tmp_path = os.path.join(tmp_folder, uuid.uuid4().hex)
+    
+    file_size, content_hash, head = write_stream(stream, tmp_path)
+    
+    file_path = blob_path(content_hash, namespace)
+    if os.path.exists(file_path):
+        try:
+            os.utime(file_path)
+            os.remove(tmp_path)
+            return file_path, file_size, content_hash, head, False
+        except FileNotFoundError:
+            # 確認した直後に削除された場合は一時ファイルをblobにする
+            pass
+    
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    os.replace(tmp_path, file_path)
+    return file_path, file_size, content_hash, head, True
+
+def blob_recently_used(file_path, grace_period=None):
+    """
+    ファイルが grace_period 秒以内に作成・再利用されたか判定
+
+    該当するblobはコミット前の添付から参照されている可能性があるため、参照数が0でも削除しない
+    （grace_period を過ぎてから孤立ファイルの掃除で削除される）
+    """
+    if grace_period is None:
+        grace_period = current_app.config.get('ORPHAN_GRACE_PERIOD', 60 * 60)
+    try:
+        return os.path.getmtime(file_path) > time.time() - grace_period
+    except OSError:
+        return False
+
+def save_file(uploaded_file):
     """
     アップロードされたファイルを保存し、Attachmentモデルを作成
     
+    ファイルは1回の読み込みで保存先に書き込み、同時にサイズ・ハッシュ・MIMEタイプを求める。
+    同じ内容のファイルは1つのblob（Google Drive利用時は1つのDriveファイル）を共有する。
+    Driveへのアップロードはコミット後に schedule_drive_uploads() でバックグラウンド実行する
+    
     Args:
         uploaded_file: FileStorage - アップロードされたファイルオブジェクト
-        subfolder: str - 保存先サブフォルダ
         
     Returns:
         Attachment: 保存されたファイルのAttachmentモデル（まだDB未保存）
     """
-    if not uploaded_file:
+    if not uploaded_file or not uploaded_file.filename:
         return None
     
     try:
-        # ファイル名の安全化と一意性の確保
         original_filename = secure_filename(uploaded_file.filename)
-        file_ext = os.path.splitext(original_filename)[1]
-        unique_filename = f"{uuid.uuid4().hex}{file_ext}"
-        
-        # ファイルサイズとタイプの取得
-        file_size = 0
-        uploaded_file.seek(0, os.SEEK_END)
-        file_size = uploaded_file.tell()
-        uploaded_file.seek(0)  # ファイルポインタを先頭に戻す
-        file_type = uploaded_file.content_type
         
-        logger.info(f"ファイル保存開始: {original_filename}, サイズ: {file_size}, タイプ: {file_type}")
+        # ローカルストレージにblobとして書き込み
+        try:
+            file_path, file_size, content_hash, head, created = store_blob(uploaded_file.stream)
+        except Exception as e:
+            logger.error(f"ローカルストレージへの保存失敗: {str(e)}")
+            return None
         
-        # 保存先の決定（Google DriveかLocal Storage）
-        use_google_drive = current_app.config.get('USE_GOOGLE_DRIVE', False)
+        file_type = guess_file_type(original_filename, head, uploaded_file.content_type)
+        logger.info(
+            f"ファイル保存: {file_path}, サイズ: {file_size}, タイプ: {file_type}, "
+            f"{'新規' if created else '重複'}"
+        )
         
         # 新しいAttachmentモデルの作成
         attachment = Attachment(
             filename=original_filename,
             file_type=file_type,
-            file_size=file_size
+            file_size=file_size,
+            content_hash=content_hash,
+            storage_type='local',
+            file_path=file_path
         )
         
-        if use_google_drive:
-            # Google Driveへのアップロード
-            drive_service = get_drive_service()
-            if not drive_service:
-                logger.error("Google Driveサービスが利用できません")
-                return None
-            
-            # 一時ファイルとして保存
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_path = temp_file.name
-                uploaded_file.save(temp_path)
-            
-            try:
-                # Google Driveにアップロード
-                logger.info(f"Google Driveにアップロード開始: {original_filename}")
-                file_metadata = drive_service.upload_file(
-                    file_path=temp_path,
-                    file_name=original_filename,
-                    subfolder=subfolder
-                )
-                
-                if file_metadata:
-                    # アップロード成功
-                    attachment.storage_type = 'google_drive'
-                    attachment.drive_file_id = file_metadata.get('id')
-                    attachment.drive_view_url = file_metadata.get('webViewLink')
-                    logger.info(f"Google Driveへのアップロード成功: {file_metadata.get('id')}")
-                    
-                    # 一時ファイルを削除
-                    try:
-                        os.remove(temp_path)
-                    except Exception as e:
-                        logger.warning(f"一時ファイル削除エラー: {str(e)}")
-                else:
-                    # Google Driveへのアップロードに失敗した場合、ローカルに保存
-                    logger.warning("Google Driveへのアップロード失敗、ローカルに保存します")
-                    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], subfolder)
-                    os.makedirs(upload_folder, exist_ok=True)
-                    file_path = os.path.join(upload_folder, unique_filename)
-                    
-                    # 一時ファイルを移動
-                    os.rename(temp_path, file_path)
-                    
-                    attachment.storage_type = 'local'
-                    attachment.file_path = file_path
-            except Exception as e:
-                logger.error(f"Google Driveへのアップロード失敗: {str(e)}")
-                # エラー時もローカルに保持
-                try:
-                    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], subfolder)
-                    os.makedirs(upload_folder, exist_ok=True)
-                    file_path = os.path.join(upload_folder, unique_filename)
-                    
-                    # 一時ファイルを移動
-                    os.rename(temp_path, file_path)
-                    
-                    attachment.storage_type = 'local'
-                    attachment.file_path = file_path
-                except Exception as move_error:
-                    logger.error(f"ローカルへの保存も失敗: {str(move_error)}")
-                    return None
-        else:
-            # ローカルストレージに保存
-            upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], subfolder)
-            os.makedirs(upload_folder, exist_ok=True)
-            file_path = os.path.join(upload_folder, unique_filename)
-            
-            try:
-                uploaded_file.save(file_path)
-                logger.info(f"ローカルストレージに保存: {file_path}")
-                
-                attachment.storage_type = 'local'
-                attachment.file_path = file_path
-            except Exception as e:
-                logger.error(f"ローカルストレージへの保存失敗: {str(e)}")
-                return None
+        if current_app.config.get('USE_GOOGLE_DRIVE', False):
+            # 同じ内容がすでにDriveにあればそれを共有する
+            existing = Attachment.query.filter(
+                Attachment.content_hash == content_hash,
+                Attachment.storage_type == 'google_drive',
+                Attachment.drive_file_id.isnot(None)
+            ).first()
+            if existing:
+                attachment.storage_type = 'google_drive'
+                attachment.drive_file_id = existing.drive_file_id
+                attachment.drive_view_url = existing.drive_view_url
+                attachment.file_path = None
+                release_local_blob(file_path, content_hash)
         
         return attachment
     except Exception as e:
         logger.error(f"ファイル保存中の予期せぬエラー: {str(e)}")
         return None
 
+def schedule_drive_uploads(attachments, subfolder='uploads'):
+    """
+    コミット済みのローカル添付をバックグラウンドでGoogle Driveへ移す
+
+    Args:
+        attachments: list - コミット済みのAttachmentモデル
+        subfolder: str - Google Drive上の保存先サブフォルダ
+    """
+    if not current_app.config.get('USE_GOOGLE_DRIVE', False):
+        return
+    
+    from app.services.drive_uploader import get_upload_pool
+    pool = get_upload_pool(current_app._get_current_object())
+    # 同じ内容のblobは1回だけアップロードする（ジョブ内で同じハッシュの添付をまとめて切り替える）
+    scheduled_hashes = set()
+    for attachment in attachments:
+        if attachment.storage_type != 'local':
+            continue
+        if attachment.content_hash:
+            if attachment.content_hash in scheduled_hashes:
+                continue
+            scheduled_hashes.add(attachment.content_hash)
+        pool.submit(attachment.id, subfolder)
+
+def release_local_blob(file_path, content_hash):
+    """
+    ローカルのファイルを参照しているAttachmentがなければ削除
+
+    呼び出し時点でDBに反映済みの参照のみを数える（削除済み・未追加の行は含まない）。
+    コミット前の添付が再利用している可能性がある新しいblobは削除せず、孤立ファイルの掃除に任せる
+
+    Returns:
+        bool: ファイルを削除したかどうか
+    """
+    if not file_path:
+        return False
+    
+    # ハッシュがあれば内容アドレス方式のblobとして参照数を確認
+    if content_hash:
+        with db.session.no_autoflush:
+            ref_count = Attachment.query.filter(
+                Attachment.content_hash == content_hash,
+                Attachment.storage_type == 'local'
+            ).count()
+        if ref_count > 0:
+            return False
+        if blob_recently_used(file_path):
+            logger.info(f"最近使われたblobのため削除を見送り: {file_path}")
+            return False
+    
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            logger.info(f"ローカルファイル削除: {file_path}")
+            return True
+    except Exception as e:
+        logger.warning(f"ローカルファイル削除エラー: {str(e)}")
+    return False
+
+def enqueue_file_cleanup(condition):
+    """
+    条件に一致するAttachmentとその派生ファイルを削除待ちとして記録
+
+    添付の削除と同じトランザクションで呼び出し、実際のファイル削除はバックグラウンドの
+    FileReaper に任せる（同じ内容を共有する添付・派生ファイルが残っていれば削除しない）
+
+    Args:
+        condition: Attachment に対するSQLの条件式
+
+    Returns:
+        int: 記録した件数
+    """
+    now = db.literal(datetime.now(), db.DateTime)
+    columns = ['storage_type', 'file_path', 'content_hash', 'drive_file_id', 'created_at', 'attempts']
+    
+    result = db.session.execute(
+        db.insert(FileTombstone).from_select(
+            columns,
+            db.select(
+                Attachment.storage_type,
+                Attachment.file_path,
+                Attachment.content_hash,
+                Attachment.drive_file_id,
+                now,
+                db.literal(0)
+            ).where(condition)
+        )
+    )
+    variant_result = db.session.execute(
+        db.insert(FileTombstone).from_select(
+            columns,
+            db.select(
+                db.literal('variant'),
+                AttachmentVariant.file_path,
+                AttachmentVariant.content_hash,
+                db.null(),
+                now,
+                db.literal(0)
+            ).where(AttachmentVariant.attachment_id.in_(db.select(Attachment.id).where(condition)))
+        )
+    )
+    return result.rowcount + variant_result.rowcount
+
+def delete_attachments(condition):
+    """
+    条件に一致するAttachmentと派生ファイルの記録を一括削除し、ファイルを削除待ちにする
+
+    コミットは呼び出し側で行う
+
+    Args:
+        condition: Attachment に対するSQLの条件式
+    """
+    enqueue_file_cleanup(condition)
+    db.session.execute(db.delete(AttachmentVariant).where(
+        AttachmentVariant.attachment_id.in_(db.select(Attachment.id).where(condition))
+    ))
+    db.session.execute(db.delete(Attachment).where(condition))
+
 def delete_file(attachment):
     """
     ファイルを削除
@@ -3,12 +3,35 @@ Google Drive APIを使用してファイルの保存と取得を行うサービ
 """
 import os
 import io
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from flask import current_app
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 
+# アップロード・ダウンロードのチャンクサイズ（256KBの倍数である必要がある）
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# バッチリクエスト1回あたりの最大件数（Drive APIの上限は100）
+BATCH_SIZE = 100
+
+# アップロードしたファイルに付与する閲覧権限
+PUBLIC_READER = {'type': 'anyone', 'role': 'reader'}
+
+# 再試行する HTTP ステータス
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+def is_retryable(error):
+    """一時的なエラー（再試行で回復しうるもの）か判定"""
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    return isinstance(error, (ConnectionError, TimeoutError, OSError))
+
 class GoogleDriveService:
     """Google DriveとAPIを通じて連携するサービスクラス"""
     
@@ -17,7 +40,16 @@ class GoogleDriveService:
         self.service = None
         self.creds = None
         self.folder_id = None
+        self.chunk_size = current_app.config.get('GOOGLE_DRIVE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+        self.max_retries = current_app.config.get('GOOGLE_DRIVE_MAX_RETRIES', 5)
+        # サブフォルダ名 -> フォルダID のキャッシュ（インスタンスフォルダにも保存）
+        self._folder_cache = {}
+        self._folder_cache_lock = threading.Lock()
+        self._folder_cache_path = os.path.join(current_app.instance_path, 'drive_folders.json')
+        # 並列アップロード用にスレッドごとのAPIクライアントを保持（httplib2はスレッドセーフでない）
+        self._local = threading.local()
         self._connect()
+        self._load_folder_cache()
     
     def _connect(self):
         """Google Drive APIへの接続を初期化"""
@@ -67,38 +99,83 @@ class GoogleDriveService:
         
         return folder_id
     
+    def _load_folder_cache(self):
+        """保存済みのフォルダIDキャッシュを読み込む（ルートフォルダが同じ場合のみ）"""
+        try:
+            with open(self._folder_cache_path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('root') == self.folder_id:
+                self._folder_cache = dict(data.get('folders', {}))
+        except (OSError, ValueError):
+            self._folder_cache = {}
+    
+    def _save_folder_cache(self):
+        """フォルダIDキャッシュをインスタンスフォルダに保存"""
+        try:
+            os.makedirs(os.path.dirname(self._folder_cache_path), exist_ok=True)
+            tmp_path = f"{self._folder_cache_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'root': self.folder_id, 'folders': self._folder_cache}, f)
+            os.replace(tmp_path, self._folder_cache_path)
+        except OSError as e:
+            current_app.logger.warning(f"フォルダIDキャッシュの保存に失敗: {str(e)}")
+    
+    def invalidate_folder(self, folder_name=None):
+        """フォルダIDキャッシュを無効化（folder_name省略時はすべて）"""
+        with self._folder_cache_lock:
+            if folder_name is None:
+                self._folder_cache.clear()
+            else:
+                self._folder_cache.pop(folder_name, None)
+            self._save_folder_cache()
+    
     def create_subfolder(self, folder_name):
-        """サブフォルダを作成"""
+        """サブフォルダを作成（作成済みならキャッシュしたIDを返す）"""
         if not self.service or not self.folder_id:
             return None
         
+        with self._folder_cache_lock:
+            cached_id = self._folder_cache.get(folder_name)
+        if cached_id:
+            return cached_id
+        
+        service = self._thread_service()
+        
         # サブフォルダがすでに存在するか確認
-        existing_folder = self.service.files().list(
-            q=f"name='{folder_name}' and '{self.folder_id}' in parents and mimeType='application/vnd.google-apps.folder'",
+        existing_folder = service.files().list(
+            q=f"name='{folder_name}' and '{self.folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false",
             spaces='drive',
             fields='files(id, name)'
         ).execute()
         
         if existing_folder.get('files'):
             # 既存のフォルダを返す
-            return existing_folder.get('files')[0].get('id')
-        
-        # 新しいサブフォルダを作成
-        folder_metadata = {
-            'name': folder_name,
-            'mimeType': 'application/vnd.google-apps.folder',
-            'parents': [self.folder_id]
-        }
+            folder_id = existing_folder.get('files')[0].get('id')
+        else:
+            # 新しいサブフォルダを作成
+            folder_metadata = {
+                'name': folder_name,
+                'mimeType': 'application/vnd.google-apps.folder',
+                'parents': [self.folder_id]
+            }
+            
+            folder = service.files().create(
+                body=folder_metadata,
+                fields='id'
+            ).execute()
+            folder_id = folder.get('id')
         
-        folder = self.service.files().create(
-            body=folder_metadata,
-            fields='id'
-        ).execute()
+        with self._folder_cache_lock:
+            self._folder_cache[folder_name] = folder_id
+            self._save_folder_cache()
         
-        return folder.get('id')
+        return folder_id
     
     def upload_file(self, file_path, file_name=None, subfolder=None):
-        """ファイルをアップロード
+        """ファイルをアップロード（再開可能なチャンクアップロード）
+        
+        一時的なエラーで中断した場合は、送信済みの位置から再開する
+        アップロード用のワーカープールから並列に呼ばれるため、スレッドごとのAPIクライアントを使う
         
         Args:
             file_path (str): アップロードするファイルのパス
@@ -120,6 +197,34 @@ class GoogleDriveService:
         if not file_name:
             file_name = os.path.basename(file_path)
         
+        try:
+            try:
+                file = self._upload_resumable(file_path, file_name, subfolder)
+            except HttpError as e:
+                # キャッシュしたサブフォルダが削除されていた場合は作り直して再試行
+                if not subfolder or e.resp.status != 404:
+                    raise
+                current_app.logger.warning(f"サブフォルダが見つからないため再作成: {subfolder}")
+                self.invalidate_folder(subfolder)
+                file = self._upload_resumable(file_path, file_name, subfolder)
+            
+            # ファイルへのアクセス権を設定（任意、必要に応じて）
+            # ここでは例として閲覧権限を設定
+            self._thread_service().permissions().create(
+                fileId=file.get('id'),
+                body=PUBLIC_READER
+            ).execute()
+            
+            return file
+            
+        except Exception as e:
+            current_app.logger.error(f"ファイルのアップロードに失敗: {str(e)}")
+            return None
+    
+    def _upload_resumable(self, file_path, file_name, subfolder, service=None):
+        """再開可能アップロードを実行し、作成されたファイルのメタデータを返す"""
+        service = service or self._thread_service()
+        
         # 保存先のフォルダIDを決定
         parent_id = self.folder_id
         if subfolder:
@@ -133,55 +238,89 @@ class GoogleDriveService:
             'parents': [parent_id]
         }
         
-        # アップロード実行
-        try:
-            media = MediaFileUpload(file_path)
-            file = self.service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id,name,mimeType,webViewLink'
-            ).execute()
-            
-            # ファイルへのアクセス権を設定（任意、必要に応じて）
-            # ここでは例として閲覧権限を設定
-            self.service.permissions().create(
-                fileId=file.get('id'),
-                body={'type': 'anyone', 'role': 'reader'}
-            ).execute()
-            
-            return file
-            
-        except Exception as e:
-            current_app.logger.error(f"ファイルのアップロードに失敗: {str(e)}")
-            return None
+        media = MediaFileUpload(file_path, chunksize=self.chunk_size, resumable=True)
+        request = service.files().create(
+            body=file_metadata,
+            media_body=media,
+            fields='id,name,mimeType,webViewLink'
+        )
+        
+        # チャンクごとに送信し、失敗したら同じリクエストで続きから再開する
+        response = None
+        failures = 0
+        while response is None:
+            try:
+                _, response = request.next_chunk()
+                failures = 0
+            except Exception as e:
+                if not is_retryable(e) or failures >= self.max_retries:
+                    raise
+                failures += 1
+                wait = 2 ** failures
+                current_app.logger.warning(
+                    f"アップロード中断、{wait}秒後に再開（{failures}回目）: {str(e)}"
+                )
+                time.sleep(wait)
+        
+        return response
     
-    def download_file(self, file_id):
-        """ファイルをダウンロード
+    def download_file(self, file_id, destination):
+        """ファイルをダウンロード（チャンク単位で書き込み、全体をメモリに載せない）
         
         Args:
             file_id (str): ダウンロードするファイルのID
+            destination (str | file): 保存先のパス、または書き込み可能なファイルオブジェクト
             
         Returns:
-            bytes: ファイルの内容
+            bool: ダウンロードに成功したかどうか
         """
         if not self.service:
-            return None
+            return False
         
         try:
-            request = self.service.files().get_media(fileId=file_id)
-            file_content = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_content, request)
-            
-            done = False
-            while not done:
-                _, done = downloader.next_chunk()
-            
-            file_content.seek(0)
-            return file_content.read()
+            if isinstance(destination, str):
+                with open(destination, 'wb') as f:
+                    self._download_to(file_id, f)
+            else:
+                self._download_to(file_id, destination)
+            return True
             
         except Exception as e:
             current_app.logger.error(f"ファイルのダウンロードに失敗: {str(e)}")
-            return None
+            return False
+    
+    def _download_to(self, file_id, fh):
+        """ファイルオブジェクトにチャンク単位で書き込む"""
+        request = self.service.files().get_media(fileId=file_id)
+        downloader = MediaIoBaseDownload(fh, request, chunksize=self.chunk_size)
+        
+        done = False
+        while not done:
+            _, done = downloader.next_chunk(num_retries=self.max_retries)
+    
+    def iter_file(self, file_id):
+        """ファイルの内容をチャンク単位で返すジェネレータ（レスポンスのストリーミング用）
+        
+        Args:
+            file_id (str): ダウンロードするファイルのID
+            
+        Yields:
+            bytes: ファイルの内容（最大 chunk_size バイトずつ）
+        """
+        if not self.service:
+            return
+        
+        buffer = io.BytesIO()
+        request = self.service.files().get_media(fileId=file_id)
+        downloader = MediaIoBaseDownload(buffer, request, chunksize=self.chunk_size)
+        
+        done = False
+        while not done:
+            _, done = downloader.next_chunk(num_retries=self.max_retries)
+            # 受信したチャンクを返してバッファを空にする
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
     
     def get_file_metadata(self, file_id):
         """ファイルのメタデータを取得
@@ -224,6 +363,132 @@ class GoogleDriveService:
         except Exception as e:
             current_app.logger.error(f"ファイルの削除に失敗: {str(e)}")
             return False
+    
+    def upload_files(self, files, subfolder=None, max_workers=4):
+        """複数のファイルを並列にアップロード
+        
+        アップロードは最大 max_workers 件ずつ並列に行い、閲覧権限の付与はバッチリクエストにまとめる
+        
+        Args:
+            files (list): ファイルのパス、または (パス, 保存時のファイル名) のリスト
+            subfolder (str, optional): サブフォルダ名
+            max_workers (int): 同時アップロード数
+            
+        Returns:
+            list: 入力と同じ順のメタデータ（失敗したファイルはNone）
+        """
+        if not self.service or not self.folder_id or not files:
+            return [None] * len(files)
+        
+        items = [(f, None) if isinstance(f, str) else tuple(f) for f in files]
+        
+        # 並列実行前にサブフォルダIDを解決しておく
+        if subfolder:
+            self.create_subfolder(subfolder)
+        
+        def upload(item):
+            file_path, file_name = item
+            if not os.path.exists(file_path):
+                current_app.logger.error(f"ファイルが存在しません: {file_path}")
+                return None
+            try:
+                return self._upload_resumable(
+                    file_path, file_name or os.path.basename(file_path), subfolder,
+                    service=self._thread_service()
+                )
+            except Exception as e:
+                current_app.logger.error(f"ファイルのアップロードに失敗: {file_path} {str(e)}")
+                return None
+        
+        app = current_app._get_current_object()
+        
+        def run(item):
+            with app.app_context():
+                return upload(item)
+        
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='drive-batch') as executor:
+            results = list(executor.map(run, items))
+        
+        # 閲覧権限をまとめて付与し、失敗したものは結果から除く
+        uploaded_ids = [r.get('id') for r in results if r]
+        granted = self._batch_execute(
+            uploaded_ids,
+            lambda file_id: self.service.permissions().create(fileId=file_id, body=PUBLIC_READER)
+        )
+        return [r if r and granted.get(r.get('id')) else None for r in results]
+    
+    def delete_files(self, file_ids):
+        """複数のファイルをバッチリクエストで削除
+        
+        Args:
+            file_ids (list): 削除するファイルのIDのリスト
+            
+        Returns:
+            dict: ファイルID -> 削除に成功したかどうか（すでに存在しないものは成功扱い）
+        """
+        if not self.service:
+            return {file_id: False for file_id in file_ids}
+        
+        return self._batch_execute(
+            file_ids,
+            lambda file_id: self.service.files().delete(fileId=file_id),
+            ignore_statuses={404}
+        )
+    
+    def _batch_execute(self, file_ids, make_request, ignore_statuses=()):
+        """ファイルIDごとのリクエストを BATCH_SIZE 件ずつバッチで実行
+        
+        一時的なエラーで失敗したものは、次のバッチで再試行する
+        
+        Returns:
+            dict: ファイルID -> 成功したかどうか
+        """
+        results = {}
+        pending = list(dict.fromkeys(file_ids))
+        attempts = 0
+        
+        while pending:
+            retry = []
+            
+            def callback(request_id, response, exception):
+                if exception is None:
+                    results[request_id] = True
+                elif isinstance(exception, HttpError) and exception.resp.status in ignore_statuses:
+                    results[request_id] = True
+                elif is_retryable(exception) and attempts < self.max_retries:
+                    retry.append(request_id)
+                else:
+                    current_app.logger.error(f"バッチリクエスト失敗: ID={request_id} {str(exception)}")
+                    results[request_id] = False
+            
+            for i in range(0, len(pending), BATCH_SIZE):
+                batch = self.service.new_batch_http_request(callback=callback)
+                for file_id in pending[i:i + BATCH_SIZE]:
+                    batch.add(make_request(file_id), request_id=file_id)
+                try:
+                    batch.execute()
+                except Exception as e:
+                    # バッチ全体が失敗した場合は含まれるリクエストをすべて再試行対象にする
+                    for file_id in pending[i:i + BATCH_SIZE]:
+                        if file_id not in results and file_id not in retry:
+                            callback(file_id, None, e)
+            
+            pending = retry
+            if pending:
+                attempts += 1
+                time.sleep(2 ** attempts)
+        
+        return results
+    
+    def _thread_service(self):
+        """現在のスレッド専用のAPIクライアントを取得"""
+        if self.creds is None:
+            return self.service
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = build('drive', 'v3', credentials=self.creds, cache_discovery=False)
+            self._local.service = service
+        return service
 
 
 # シングルトンパターンでサービスインスタンスを提供する関数
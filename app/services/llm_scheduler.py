@@ -0,0 +1,316 @@
+"""
+LLM呼び出しのジョブスケジューラ
+同一質問の同時リクエストをまとめ（シングルフライト）、優先度付きキューから順に実行する
+
+上流のレート制限（bucket）のトークンはジョブの関数が上流を呼び出す直前に取得する
+（キャッシュから返せるジョブでトークンを消費しないように）
+
+ジョブの関数は current_job().publish() で途中経過（生成中のテキスト）を配信でき、
+待っているリクエストは Job.iter_chunks() で到着順に受け取る
+"""
+import heapq
+import itertools
+import threading
+import time
+import uuid
+import logging
+from werkzeug.exceptions import ServiceUnavailable
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# ワーカースレッドが実行中のジョブ
+_local = threading.local()
+
+
+class QueueFull(ServiceUnavailable):
+    """待ち行列が上限に達したときの例外"""
+    description = '混雑しています。後で試してください'
+
+
+class TokenBucket:
+    """トークンバケット方式のレートリミッタ"""
+
+    def __init__(self, rate_per_minute, burst):
+        """
+        Args:
+            rate_per_minute (float): 1分あたりに補充するトークン数
+            burst (int): バケットの容量（連続して実行できる最大数）
+        """
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """トークンを1つ取得（取得できるまで待機）。timeout内に取得できなければFalse"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+class Job:
+    """スケジューラに投入されたLLM呼び出し"""
+
+    def __init__(self, key, priority):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.priority = priority
+        self.status = 'queued'  # queued / running / done / error
+        self.result = None
+        self.error = None
+        self.waiters = 1  # 同じジョブを待っているリクエスト数
+        self.callbacks = []  # 完了時に呼ぶコールバック（合流したリクエストの分も含む）
+        self.created_at = time.time()
+        self.finished_at = None
+        self.chunks = []  # publish() で配信された途中経過
+        self._done = threading.Event()
+        self._chunks_cond = threading.Condition()
+
+    def wait(self, timeout=None):
+        """完了まで待機。timeout内に完了すればTrue"""
+        return self._done.wait(timeout)
+
+    def get(self):
+        """結果を返す（失敗していれば例外を送出）"""
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    @property
+    def finished(self):
+        return self._done.is_set()
+
+    def publish(self, chunk):
+        """途中経過を配信（ジョブの関数から呼ぶ）"""
+        with self._chunks_cond:
+            self.chunks.append(chunk)
+            self._chunks_cond.notify_all()
+
+    def iter_chunks(self, timeout=None):
+        """
+        配信された途中経過を到着順に返す（すでに配信済みの分から）
+
+        ジョブが完了するか、timeout秒のあいだ新しい途中経過が届かなければ終了する
+        （終了後に job.finished で完了したかを確認する）
+        """
+        index = 0
+        while True:
+            with self._chunks_cond:
+                if index >= len(self.chunks) and not self._done.is_set():
+                    self._chunks_cond.wait(timeout)
+                chunks = self.chunks[index:]
+                finished = self._done.is_set()
+            if not chunks and not finished:
+                return
+            yield from chunks
+            index += len(chunks)
+            if finished:
+                return
+
+    def _finish(self):
+        with self._chunks_cond:
+            self._done.set()
+            self._chunks_cond.notify_all()
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'waiters': self.waiters,
+            'created_at': self.created_at,
+        }
+
+
+class LLMScheduler:
+    """優先度付きキュー・レート制限・シングルフライトを備えたLLM呼び出しスケジューラ"""
+
+    def __init__(self, app, workers=4, rate_per_minute=50, burst=10,
+                 max_queue=200, result_ttl=600):
+        """
+        Args:
+            app: Flaskアプリケーション（ジョブはこのアプリのコンテキストで実行）
+            workers (int): 同時に実行するジョブ数
+            rate_per_minute (float): 上流APIへの1分あたりの呼び出し上限
+            burst (int): 連続して呼び出せる最大数
+            max_queue (int): 待ち行列の上限（超えるとQueueFull）
+            result_ttl (int): 完了したジョブの結果を保持する秒数（ポーリング用）
+        """
+        self.app = app
+        self.workers = workers
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self.bucket = TokenBucket(rate_per_minute, burst)
+        self._queue = []
+        self._seq = itertools.count()
+        self._inflight = {}  # key -> Job（待機中・実行中）
+        self._jobs = {}  # job_id -> Job
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, key, fn, priority=0, on_done=None):
+        """
+        ジョブを投入
+
+        同じkeyのジョブが待機中・実行中ならそれを返す（重複して呼び出さない）。
+        その場合も on_done は完了時に呼ばれる
+
+        Args:
+            key (str): 同一リクエストを判定するキー
+            fn (callable): 実行する関数（アプリケーションコンテキスト内で呼ばれる）
+            priority (int): 小さいほど優先
+            on_done (callable): 完了時に Job を引数に呼ばれるコールバック
+
+        Returns:
+            Job: 投入された（または共有された）ジョブ
+
+        Raises:
+            QueueFull: 待ち行列が上限に達している場合
+        """
+        with self._cond:
+            job = self._inflight.get(key)
+            if job is not None:
+                job.waiters += 1
+                if on_done is not None:
+                    job.callbacks.append(on_done)
+                # 優先度の高いリクエストが合流した場合は繰り上げる
+                if priority < job.priority and job.status == 'queued':
+                    job.priority = priority
+                    self._requeue(job)
+                logger.info(f"LLMジョブを共有: {job.id} (waiters={job.waiters})")
+                return job
+
+            if len(self._queue) >= self.max_queue:
+                raise QueueFull()
+
+            job = Job(key, priority)
+            if on_done is not None:
+                job.callbacks.append(on_done)
+            heapq.heappush(self._queue, (priority, next(self._seq), job, fn))
+            self._inflight[key] = job
+            self._jobs[job.id] = job
+            self._prune()
+            self._ensure_workers()
+            self._cond.notify()
+            return job
+
+    def get_job(self, job_id):
+        """ジョブIDからジョブを取得（期限切れ・不明ならNone）"""
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def queue_length(self):
+        with self._cond:
+            return len(self._queue)
+
+    def _requeue(self, job):
+        """ジョブの優先度変更をヒープに反映（ロック取得済みで呼ぶ）"""
+        for i, (_, seq, queued_job, fn) in enumerate(self._queue):
+            if queued_job is job:
+                self._queue[i] = (job.priority, seq, job, fn)
+                heapq.heapify(self._queue)
+                return
+
+    def _ensure_workers(self):
+        """ワーカースレッドを必要数まで起動（ロック取得済みで呼ぶ）"""
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _prune(self):
+        """保持期間を過ぎた完了ジョブを削除（ロック取得済みで呼ぶ）"""
+        expired_before = time.time() - self.result_ttl
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished and job.finished_at < expired_before]:
+            del self._jobs[job_id]
+
+    def _worker(self):
+        """キューからジョブを取り出して実行"""
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                _, _, job, fn = heapq.heappop(self._queue)
+                job.status = 'running'
+
+            _local.job = job
+            try:
+                with self.app.app_context():
+                    job.result = fn()
+                job.status = 'done'
+            except Exception as e:
+                job.error = e
+                job.status = 'error'
+                logger.error(f"LLMジョブ失敗: {job.id} {type(e).__name__}: {str(e)}")
+            finally:
+                _local.job = None
+
+            with self._cond:
+                job.finished_at = time.time()
+                self._inflight.pop(job.key, None)
+                # ここ以降に同じkeyで投入されたリクエストは新しいジョブになる
+                callbacks = list(job.callbacks)
+            job._finish()
+
+            for on_done in callbacks:
+                try:
+                    with self.app.app_context():
+                        on_done(job)
+                except Exception as e:
+                    logger.error(f"LLMジョブ完了通知エラー: {str(e)}")
+
+
+def current_job():
+    """ワーカーで実行中のジョブを返す（ジョブの関数の外ではNone）"""
+    return getattr(_local, 'job', None)
+
+
+# シングルトンパターンでスケジューラを提供する関数
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler(app):
+    """
+    LLMスケジューラのシングルトンインスタンスを取得
+
+    スケジューラはワーカープロセスごとに作られるため、上流のレート制限は
+    WEB_CONCURRENCY で等分してプロセス全体で PERPLEXITY_RATE_LIMIT を超えないようにする
+    """
+    global _scheduler
+
+    with _scheduler_lock:
+        if _scheduler is None:
+            processes = max(1, app.config.get('WEB_CONCURRENCY', 1))
+            rate_per_minute = app.config.get('PERPLEXITY_RATE_LIMIT', 50) / processes
+            burst = max(1, app.config.get('PERPLEXITY_RATE_BURST', 10) // processes)
+            if processes > 1:
+                logger.info(f"レート制限をワーカー数で等分: {rate_per_minute:.1f}回/分, バースト{burst}（{processes}ワーカー）")
+            _scheduler = LLMScheduler(
+                app,
+                workers=app.config.get('PERPLEXITY_MAX_CONCURRENCY', 8),
+                rate_per_minute=rate_per_minute,
+                burst=burst,
+                max_queue=app.config.get('PERPLEXITY_QUEUE_MAX', 200),
+                result_ttl=app.config.get('PERPLEXITY_JOB_TTL', 600)
+            )
+        return _scheduler
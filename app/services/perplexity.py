@@ -1,77 +1,235 @@
+import threading
+from contextlib import contextmanager
 from flask import current_app
 from werkzeug.exceptions import RequestTimeout, ServiceUnavailable
 from openai import OpenAI
+import httpx
+from app.services.answer_cache import get_answer_cache, make_cache_key
+from app.services.llm_scheduler import current_job, get_scheduler
 
-def query_perplexity(user_input):
+PERPLEXITY_API_URL = "https://api.perplexity.ai"
+
+# システムプロンプト
+SYSTEM_PROMPT = (
+    "You are a professional golf caddie with extensive knowledge of golf course strategy. "
+    "Provide specific advice for the hole described by the user. "
+    "Include recommendations for tee shot direction, club selection, approach strategy, "
+    "and green reading. Consider any weather conditions or player tendencies mentioned. "
+    "Keep your response concise but thorough, focusing on practical advice. "
+    "Respond in Japanese only."
+)
+
+# プロセス共通のクライアントと同時実行数の制御
+_client = None
+_client_api_key = None
+_client_lock = threading.Lock()
+_slots = None
+
+def get_client():
     """
-    Perplexity APIに問い合わせを行う
-    
-    Args:
-        user_input (str): ユーザーからの入力テキスト
-        
+    プロセス共通のOpenAIクライアントを取得
+
+    httpxの接続プールを使い回すことで、リクエストごとのTLSハンドシェイクを避ける
+
     Returns:
-        dict: APIからのレスポンス
-        
+        OpenAI: Perplexity API用のクライアント
+
     Raises:
-        RequestTimeout: リクエストがタイムアウトした場合
-        ServiceUnavailable: APIが利用できない場合
+        ServiceUnavailable: APIキーが設定されていない場合
     """
+    global _client, _client_api_key
+
     # APIキーを取得
     api_key = current_app.config.get('PERPLEXITY_API_KEY')
     if not api_key:
         current_app.logger.error("Perplexity API キーが設定されていません")
         raise ServiceUnavailable("API設定エラー")
-    
-    # システムプロンプトを設定
-    system_prompt = (
-        "You are a professional golf caddie with extensive knowledge of golf course strategy. "
-        "Provide specific advice for the hole described by the user. "
-        "Include recommendations for tee shot direction, club selection, approach strategy, "
-        "and green reading. Consider any weather conditions or player tendencies mentioned. "
-        "Keep your response concise but thorough, focusing on practical advice. "
-        "Respond in Japanese only."
-    )
-    
-    # メッセージを設定
-    messages = [
-        {"role": "system", "content": system_prompt},
+
+    with _client_lock:
+        if _client is None or _client_api_key != api_key:
+            max_connections = current_app.config.get('PERPLEXITY_MAX_CONCURRENCY', 8)
+            # プロキシ設定を無効化し、Keep-Aliveで接続を再利用
+            http_client = httpx.Client(
+                proxies=None,
+                timeout=current_app.config.get('PERPLEXITY_TIMEOUT', 25),
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections
+                )
+            )
+            if _client is not None:
+                _client.close()
+            _client = OpenAI(
+                api_key=api_key,
+                base_url=current_app.config.get('PERPLEXITY_API_URL', PERPLEXITY_API_URL),
+                http_client=http_client
+            )
+            _client_api_key = api_key
+        return _client
+
+@contextmanager
+def _request_slot():
+    """同時リクエスト数を PERPLEXITY_MAX_CONCURRENCY に制限する"""
+    global _slots
+
+    with _client_lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(
+                current_app.config.get('PERPLEXITY_MAX_CONCURRENCY', 8)
+            )
+
+    # 空きを待っても取得できなければ混雑として扱う
+    if not _slots.acquire(timeout=current_app.config.get('PERPLEXITY_TIMEOUT', 25)):
+        raise RequestTimeout("Perplexity API の同時実行数が上限に達しました")
+    try:
+        yield
+    finally:
+        _slots.release()
+
+def _build_messages(user_input):
+    """APIに送信するメッセージを作成"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": user_input}
     ]
-    
+
+def prompt_key(user_input):
+    """現在のモデル設定で質問のキーを作成（回答キャッシュ・同一リクエストの判定に使用）"""
+    return make_cache_key(
+        user_input,
+        current_app.config.get('PERPLEXITY_MODEL', 'sonar-pro'),
+        current_app.config.get('PERPLEXITY_TEMPERATURE', 0.7),
+        current_app.config.get('PERPLEXITY_MAX_TOKENS', 1024),
+        SYSTEM_PROMPT
+    )
+
+def get_cached_answer(user_input):
+    """キャッシュ済みの回答を返す（なければNone）"""
+    cache = get_answer_cache(current_app)
+    if cache is None:
+        return None
+    cached = cache.get(prompt_key(user_input))
+    if cached is None:
+        return None
+    return dict(cached, cached=True)
+
+def submit_query(user_input, use_cache=True, priority=0, on_done=None, stream=False):
+    """
+    Perplexity APIへの問い合わせをスケジューラに投入
+
+    同じ質問がすでに待機中・実行中であればそのジョブを共有する
+
+    Args:
+        user_input (str): ユーザーからの入力テキスト
+        use_cache (bool): Falseならキャッシュを参照しない
+        priority (int): 小さいほど優先
+        on_done (callable): 完了時に Job を引数に呼ばれるコールバック
+        stream (bool): Trueならストリーミングで問い合わせ、生成されたテキストの断片を
+            Job.iter_chunks() で受け取れるようにする
+
+    Returns:
+        Job: 投入されたジョブ（結果は query_perplexity と同じ形式）
+
+    Raises:
+        QueueFull: 待ち行列が上限に達している場合
+    """
+    scheduler = get_scheduler(current_app._get_current_object())
+    return scheduler.submit(
+        prompt_key(user_input),
+        lambda: query_perplexity(user_input, use_cache=use_cache, stream=stream),
+        priority=priority,
+        on_done=on_done
+    )
+
+def query_perplexity(user_input, use_cache=True, stream=False):
+    """
+    Perplexity APIに問い合わせを行う
+
+    Args:
+        user_input (str): ユーザーからの入力テキスト
+        use_cache (bool): Falseならキャッシュを参照せずAPIに問い合わせる（結果はキャッシュを更新）
+        stream (bool): Trueならストリーミングで問い合わせ、受信したテキストの断片を
+            実行中のジョブに配信する（current_job().publish）
+
+    Returns:
+        dict: APIからのレスポンス（キャッシュから返した場合は 'cached': True）
+
+    Raises:
+        RequestTimeout: リクエストがタイムアウトした場合
+        ServiceUnavailable: APIが利用できない場合
+    """
+    if use_cache:
+        cached = get_cached_answer(user_input)
+        if cached is not None:
+            return cached
+
+    # 上流を呼び出す場合のみレート制限のトークンを取得（スケジューラのワーカーから呼ばれるため取得できるまで待つ）
+    get_scheduler(current_app._get_current_object()).bucket.acquire()
+
+    cache = get_answer_cache(current_app)
+    cache_key = prompt_key(user_input)
+    client = get_client()
+
     try:
-        # OpenAIクライアントを初期化（プロキシ設定を無効化）
-        import httpx
-        http_client = httpx.Client(proxies=None)
-        
-        client = OpenAI(
-            api_key=api_key,
-            base_url="https://api.perplexity.ai",
-            http_client=http_client
-        )
-        
-        # チャット完了をリクエスト
-        response = client.chat.completions.create(
-            model=current_app.config.get('PERPLEXITY_MODEL', 'sonar-pro'),
-            messages=messages,
-            max_tokens=current_app.config.get('PERPLEXITY_MAX_TOKENS', 1024),
-            temperature=current_app.config.get('PERPLEXITY_TEMPERATURE', 0.7),
-            stream=False
-        )
-        
+        with _request_slot():
+            # チャット完了をリクエスト
+            response = client.chat.completions.create(
+                model=current_app.config.get('PERPLEXITY_MODEL', 'sonar-pro'),
+                messages=_build_messages(user_input),
+                max_tokens=current_app.config.get('PERPLEXITY_MAX_TOKENS', 1024),
+                temperature=current_app.config.get('PERPLEXITY_TEMPERATURE', 0.7),
+                stream=stream
+            )
+            if stream:
+                content, usage = _read_stream(response)
+
+        if not stream:
+            content = response.choices[0].message.content
+            usage = response.usage
+
         # レスポンスを辞書形式に変換
-        return {
+        result = {
             'choices': [{
                 'message': {
-                    'content': response.choices[0].message.content
+                    'content': content
                 }
             }],
             'usage': {
-                'prompt_tokens': response.usage.prompt_tokens,
-                'completion_tokens': response.usage.completion_tokens,
-                'total_tokens': response.usage.total_tokens
-            }
+                'prompt_tokens': usage.prompt_tokens,
+                'completion_tokens': usage.completion_tokens,
+                'total_tokens': usage.total_tokens
+            } if usage is not None else {}
         }
-        
+
+    except RequestTimeout:
+        raise
     except Exception as e:
         current_app.logger.error(f"Perplexity API エラー: {str(e)}")
         raise ServiceUnavailable(f"APIエラー: {str(e)}")
+
+    # 最後まで受信できた回答のみキャッシュする
+    if cache is not None and result['choices'][0]['message']['content']:
+        cache.set(cache_key, result)
+    return dict(result, cached=False)
+
+def _read_stream(response):
+    """ストリーミングの応答を読み切り、断片を実行中のジョブに配信して (本文, usage) を返す"""
+    job = current_job()
+    chunks = []
+    usage = None
+    try:
+        for chunk in response:
+            # 使用量は最後のチャンクに含まれる
+            if getattr(chunk, 'usage', None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                chunks.append(delta)
+                if job is not None:
+                    job.publish(delta)
+    finally:
+        # 途中で失敗した場合も接続をプールに戻す
+        response.close()
+    return ''.join(chunks), usage
@@ -0,0 +1,78 @@
+"""
+同じホストで動く複数のワーカープロセス間のロック（インスタンスフォルダのロックファイルを使う）
+
+gunicornのワーカーごとに1回ずつ実行されると困る処理（SQLiteのマイグレーション・
+バックグラウンドのファイル削除）を、1プロセスずつ・1プロセスだけで実行するために使う。
+ノードをまたぐ排他はデータベース側（PostgreSQLのアドバイザリロック・SKIP LOCKED）で行う
+"""
+import os
+import threading
+import logging
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間のロックを行わない
+    fcntl = None
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+
+class ProcessLock:
+    """ロックファイルによるプロセス間の排他ロック（取得したプロセスが終了すると自動的に解放される）"""
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): ロックファイルのパス
+        """
+        self.path = path
+        self._fd = None
+        self._lock = threading.Lock()
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self, blocking=True):
+        """ロックを取得（取得済みならそのまま）。blocking=Falseで取得できなければFalse"""
+        with self._lock:
+            if self._fd is not None:
+                return True
+            if fcntl is None:
+                self._fd = -1
+                return True
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            except Exception:
+                os.close(fd)
+                raise
+            self._fd = fd
+            return True
+
+    def release(self):
+        with self._lock:
+            if self._fd is None:
+                return
+            if self._fd >= 0:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+            self._fd = None
+
+
+@contextmanager
+def process_lock(path):
+    """ロックを取得できるまで待ってから処理を実行する"""
+    lock = ProcessLock(path)
+    lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
@@ -0,0 +1,305 @@
+"""
+投稿・コメント・メッセージの全文検索
+日本語は単語の区切りがないため、本文を2文字ずつのn-gramに分割して転置インデックスに登録する
+
+データベースに応じて次の方式で検索する
+- SQLite: FTS5（bm25でランキング）
+- PostgreSQL: 全文検索（GINインデックス、ts_rankでランキング）
+- それ以外・FTS5が使えない場合: LIKE（新しい順）
+"""
+import re
+import unicodedata
+import logging
+from flask import current_app
+from sqlalchemy import and_, func, or_
+from app.models.db import Comment, Message, Post, SearchDocument, db
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# n-gramの文字数
+NGRAM_SIZE = 2
+
+# SQLiteのFTS5仮想テーブル名
+FTS_TABLE = 'search_fts'
+
+# 検索結果の抜粋の前後の文字数
+SNIPPET_CONTEXT = 40
+
+_WORD_RE = re.compile(r'\w+')
+
+def tokenize(text):
+    """
+    テキストをn-gramのトークンに分割
+
+    NFKCで正規化・小文字化したうえで、単語（空白・記号で区切られた部分）ごとに
+    2文字ずつのn-gramと末尾の1文字を作る（1文字での前方一致検索にも対応するため）
+
+    Returns:
+        list: トークンのリスト
+    """
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    tokens = []
+    for word in _WORD_RE.findall(text):
+        if len(word) >= NGRAM_SIZE:
+            tokens.extend(word[i:i + NGRAM_SIZE] for i in range(len(word) - NGRAM_SIZE + 1))
+        tokens.append(word[-1])
+    return tokens
+
+def query_terms(query):
+    """検索語をトークンに分割（重複を除く）。1文字のトークンは前方一致で検索する"""
+    text = unicodedata.normalize('NFKC', query or '').lower()
+    terms = []
+    for word in _WORD_RE.findall(text):
+        if len(word) >= NGRAM_SIZE:
+            terms.extend(word[i:i + NGRAM_SIZE] for i in range(len(word) - NGRAM_SIZE + 1))
+        else:
+            terms.append(word)
+    return list(dict.fromkeys(terms))
+
+def init_search_index():
+    """検索方式を決定し、必要な全文検索インデックスを作成（アプリケーションコンテキスト内で呼ぶ）"""
+    dialect = db.engine.dialect.name
+    backend = 'like'
+
+    try:
+        if dialect == 'sqlite':
+            with db.engine.begin() as conn:
+                conn.execute(db.text(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                    "tokens, content='search_documents', content_rowid='id', "
+                    "tokenize='unicode61 remove_diacritics 0')"
+                ))
+                # search_documents の変更をFTS5のインデックスに反映
+                conn.execute(db.text(
+                    "CREATE TRIGGER IF NOT EXISTS search_documents_ai AFTER INSERT ON search_documents BEGIN "
+                    f"INSERT INTO {FTS_TABLE}(rowid, tokens) VALUES (new.id, new.tokens); END"
+                ))
+                conn.execute(db.text(
+                    "CREATE TRIGGER IF NOT EXISTS search_documents_ad AFTER DELETE ON search_documents BEGIN "
+                    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, tokens) VALUES ('delete', old.id, old.tokens); END"
+                ))
+                conn.execute(db.text(
+                    "CREATE TRIGGER IF NOT EXISTS search_documents_au AFTER UPDATE ON search_documents BEGIN "
+                    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, tokens) VALUES ('delete', old.id, old.tokens); "
+                    f"INSERT INTO {FTS_TABLE}(rowid, tokens) VALUES (new.id, new.tokens); END"
+                ))
+            backend = 'fts5'
+        elif dialect == 'postgresql':
+            with db.engine.begin() as conn:
+                conn.execute(db.text(
+                    "CREATE INDEX IF NOT EXISTS ix_search_documents_tsv ON search_documents "
+                    "USING gin (to_tsvector('simple', tokens))"
+                ))
+            backend = 'postgresql'
+    except Exception as e:
+        logger.warning(f"全文検索インデックスを作成できないためLIKE検索を使用: {str(e)}")
+
+    current_app.extensions['search_backend'] = backend
+    return backend
+
+def search_backend():
+    return current_app.extensions.get('search_backend', 'like')
+
+# インデックスの更新（呼び出し側のトランザクションでコミットする）
+def index_document(doc_type, doc_id, text, created_at=None, post_id=None, sender=None, receiver=None):
+    """文書を検索インデックスに登録（同じ文書が登録済みなら置き換える）"""
+    tokens = ' '.join(tokenize(text))
+    document = SearchDocument.query.filter_by(doc_type=doc_type, doc_id=doc_id).first()
+    if document is None:
+        document = SearchDocument(doc_type=doc_type, doc_id=doc_id)
+        db.session.add(document)
+    document.tokens = tokens
+    document.created_at = created_at
+    document.post_id = post_id
+    document.sender = sender
+    document.receiver = receiver
+    return document
+
+def index_post(post):
+    return index_document('post', post.id, post.content, post.created_at, post_id=post.id)
+
+def index_comment(comment):
+    return index_document('comment', comment.id, comment.content, comment.created_at, post_id=comment.post_id)
+
+def index_message(message):
+    return index_document(
+        'message', message.id, message.content, message.created_at,
+        sender=message.sender, receiver=message.receiver
+    )
+
+def remove_post_documents(post_id):
+    """投稿とそのコメントを検索インデックスから削除"""
+    db.session.execute(db.delete(SearchDocument).where(SearchDocument.post_id == post_id))
+
+def rebuild_index(batch_size=500, progress=None):
+    """
+    すべての投稿・コメント・メッセージから検索インデックスを作り直す
+
+    Args:
+        batch_size (int): 1回にコミットする件数
+        progress (callable): 件数を引数に呼ばれるコールバック
+
+    Returns:
+        int: 登録した件数
+    """
+    db.session.execute(db.delete(SearchDocument))
+    db.session.commit()
+
+    count = 0
+    sources = (
+        (Post, lambda post: dict(doc_type='post', doc_id=post.id, text=post.content,
+                                 created_at=post.created_at, post_id=post.id)),
+        (Comment, lambda comment: dict(doc_type='comment', doc_id=comment.id, text=comment.content,
+                                       created_at=comment.created_at, post_id=comment.post_id)),
+        (Message, lambda message: dict(doc_type='message', doc_id=message.id, text=message.content,
+                                       created_at=message.created_at,
+                                       sender=message.sender, receiver=message.receiver)),
+    )
+    for model, to_values in sources:
+        rows = []
+        for item in db.session.query(model).order_by(model.id).yield_per(batch_size):
+            values = to_values(item)
+            values['tokens'] = ' '.join(tokenize(values.pop('text')))
+            rows.append(values)
+            if len(rows) >= batch_size:
+                count += _insert_documents(rows)
+                if progress:
+                    progress(count)
+        count += _insert_documents(rows)
+        if progress:
+            progress(count)
+
+    if search_backend() == 'fts5':
+        with db.engine.begin() as conn:
+            conn.execute(db.text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')"))
+    return count
+
+def _insert_documents(rows):
+    if not rows:
+        return 0
+    count = len(rows)
+    db.session.execute(db.insert(SearchDocument), rows)
+    db.session.commit()
+    rows.clear()
+    return count
+
+# 検索
+def search(query, user=None, doc_types=None, page=1, per_page=20):
+    """
+    検索語に一致する文書をスコアの高い順に取得
+
+    メッセージは user が送信者・受信者のものだけを対象にする
+
+    Args:
+        query (str): 検索語（空白区切りの語はすべて含むものを返す）
+        user (str): 閲覧者のユーザー名
+        doc_types (list): 対象の種類（'post' / 'comment' / 'message'、省略時はすべて）
+        page (int): ページ番号（1始まり）
+        per_page (int): 1ページの件数
+
+    Returns:
+        tuple: (検索結果の辞書のリスト, 総件数)
+    """
+    terms = query_terms(query)
+    if not terms:
+        return [], 0
+
+    visible = SearchDocument.doc_type.in_(['post', 'comment'])
+    if user:
+        visible = or_(visible, and_(
+            SearchDocument.doc_type == 'message',
+            or_(SearchDocument.sender == user, SearchDocument.receiver == user)
+        ))
+    conditions = [visible]
+    if doc_types:
+        conditions.append(SearchDocument.doc_type.in_(doc_types))
+
+    backend = search_backend()
+    if backend == 'fts5':
+        fts = db.table(FTS_TABLE, db.column('rowid'))
+        match = ' '.join(f'"{term}"*' if len(term) < NGRAM_SIZE else f'"{term}"' for term in terms)
+        score = func.bm25(db.literal_column(FTS_TABLE))
+        stmt = db.select(SearchDocument, score.label('score')).join(
+            fts, fts.c.rowid == SearchDocument.id
+        ).where(db.text(f"{FTS_TABLE} MATCH :match").bindparams(match=match))
+        order_by = [score, SearchDocument.created_at.desc()]
+    elif backend == 'postgresql':
+        # GINインデックスの式と一致させるため、設定名はバインド変数にせずリテラルで渡す
+        config = db.literal_column("'simple'")
+        tsquery = func.to_tsquery(config, ' & '.join(
+            f"{term}:*" if len(term) < NGRAM_SIZE else term for term in terms
+        ))
+        tsvector = func.to_tsvector(config, SearchDocument.tokens)
+        score = func.ts_rank(tsvector, tsquery)
+        stmt = db.select(SearchDocument, score.label('score')).where(tsvector.op('@@')(tsquery))
+        order_by = [score.desc(), SearchDocument.created_at.desc()]
+    else:
+        stmt = db.select(SearchDocument, db.literal(0).label('score')).where(
+            *[SearchDocument.tokens.contains(term) for term in terms]
+        )
+        order_by = [SearchDocument.created_at.desc()]
+
+    stmt = stmt.where(*conditions)
+    total = db.session.scalar(db.select(func.count()).select_from(stmt.subquery()))
+    rows = db.session.execute(
+        stmt.order_by(*order_by, SearchDocument.id.desc())
+        .limit(per_page).offset((page - 1) * per_page)
+    ).all()
+
+    return _build_results(rows, query), total
+
+def _build_results(rows, query):
+    """検索インデックスの行から、元の本文の抜粋を含む検索結果を作成"""
+    ids = {'post': [], 'comment': [], 'message': []}
+    for document, _ in rows:
+        ids[document.doc_type].append(document.doc_id)
+
+    # 種類ごとに1回のクエリで本文を取得
+    sources = {}
+    for doc_type, model in (('post', Post), ('comment', Comment), ('message', Message)):
+        if ids[doc_type]:
+            for item in model.query.filter(model.id.in_(ids[doc_type])):
+                sources[(doc_type, item.id)] = item
+
+    results = []
+    for document, score in rows:
+        item = sources.get((document.doc_type, document.doc_id))
+        if item is None:
+            continue
+        result = {
+            'type': document.doc_type,
+            'id': item.id,
+            'score': float(score or 0),
+            'created_at': item.created_at.isoformat() if item.created_at else None,
+            'snippet': make_snippet(item.content, query),
+        }
+        if document.doc_type == 'message':
+            result['sender'] = item.sender
+            result['receiver'] = item.receiver
+        else:
+            result['author'] = item.author
+            result['post_id'] = document.post_id
+        results.append(result)
+    return results
+
+def make_snippet(text, query):
+    """本文のうち検索語が最初に現れる位置の前後を抜き出す"""
+    normalized = unicodedata.normalize('NFKC', text or '')
+    lowered = normalized.lower()
+    position = -1
+    for word in _WORD_RE.findall(unicodedata.normalize('NFKC', query or '').lower()):
+        position = lowered.find(word)
+        if position >= 0:
+            break
+
+    if position < 0:
+        position = 0
+    start = max(0, position - SNIPPET_CONTEXT)
+    end = min(len(normalized), position + SNIPPET_CONTEXT * 2)
+    snippet = normalized[start:end].replace('\n', ' ')
+    if start > 0:
+        snippet = '…' + snippet
+    if end < len(normalized):
+        snippet += '…'
+    return snippet
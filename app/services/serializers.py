@@ -0,0 +1,333 @@
+"""
+APIレスポンスのシリアライズ
+投稿一覧・投稿詳細・会話履歴・会話相手一覧は、ORMのオブジェクトを作らずにCoreのselectで必要なカラムだけを読み、
+行のタプルから辞書を組み立てて高速なJSONエンコーダ（orjson、なければ標準のjson）でエンコードする
+
+レスポンスに含める項目は表示の種類（'list' / 'full'）ごとの射影で決める。
+一覧では使わない項目（添付のファイルパスや保存先など）を省き、API_PROJECTIONS で変更できる
+"""
+import json
+from datetime import date, datetime
+import logging
+from flask import current_app, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import or_
+from app.models.db import (
+    Attachment, AttachmentVariant, Comment, Conversation, Message, Post,
+    attachment_url, variant_url, db
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# 表示の種類（?view= で指定）
+VIEWS = ('list', 'full')
+
+# モデルのカラムをそのまま出力する項目
+POST_COLUMNS = ('id', 'content', 'author', 'created_at', 'updated_at', 'comment_count', 'attachment_count')
+COMMENT_COLUMNS = ('id', 'content', 'author', 'created_at', 'post_id')
+MESSAGE_COLUMNS = ('id', 'content', 'sender', 'receiver', 'created_at', 'is_read')
+ATTACHMENT_COLUMNS = ('id', 'filename', 'file_type', 'file_size', 'uploaded_at', 'storage_type')
+VARIANT_COLUMNS = ('file_type', 'width', 'height')
+
+# 出力できる項目（カラム + 組み立てる項目）
+FIELDS = {
+    'post': POST_COLUMNS + ('comments', 'attachments'),
+    'comment': COMMENT_COLUMNS + ('attachments',),
+    'message': MESSAGE_COLUMNS + ('attachments',),
+    # file_url は Google Drive 上のファイル、file_path はローカルのファイルの場合のみ出力
+    'attachment': ATTACHMENT_COLUMNS + ('url', 'variants', 'file_url', 'file_path'),
+    'variant': ('url',) + VARIANT_COLUMNS,
+}
+
+# 既定の射影（'full' は各モデルの to_dict と同じ項目）
+DEFAULT_PROJECTIONS = {
+    'post': {
+        'full': FIELDS['post'],
+        'list': ('id', 'content', 'author', 'created_at', 'comment_count', 'attachment_count',
+                 'comments', 'attachments'),
+    },
+    'comment': {
+        'full': FIELDS['comment'],
+        'list': FIELDS['comment'],
+    },
+    'message': {
+        'full': FIELDS['message'],
+        'list': FIELDS['message'],
+    },
+    'attachment': {
+        'full': FIELDS['attachment'],
+        'list': ('id', 'filename', 'file_type', 'file_size', 'url', 'variants'),
+    },
+    'variant': {
+        'full': FIELDS['variant'],
+        'list': ('url', 'width', 'height'),
+    },
+}
+
+
+# JSONエンコード
+def _default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dumps(obj):
+    """JSONのバイト列にエンコード（日時はISO 8601形式）"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_default).encode('utf-8')
+
+def json_response(payload, status=200):
+    """dumps でエンコードしたJSONレスポンスを作成"""
+    return current_app.response_class(dumps(payload), status=status, mimetype='application/json')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    jsonify を orjson でエンコードするJSONプロバイダー
+
+    日時・dataclass などはFlaskの既定の変換（日時はHTTPの日付形式）に任せ、出力の形は変えない
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs.get('cls') is not None:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode('utf-8')
+        except TypeError:
+            # 64ビットを超える整数など orjson で扱えない値
+            return super().dumps(obj, **kwargs)
+
+
+# 射影
+def get_projection(kind, view):
+    """表示の種類ごとの出力する項目"""
+    projections = current_app.extensions.get('api_projections', DEFAULT_PROJECTIONS)
+    return projections[kind][view]
+
+def projection_signature(view):
+    """表示の種類で出力するすべての項目（ETagに含め、API_PROJECTIONS の変更で一致しなくなるようにする）"""
+    return tuple(get_projection(kind, view) for kind in FIELDS)
+
+def request_view(default):
+    """リクエストの ?view= で指定された表示の種類（不正な値なら default）"""
+    view = request.args.get('view', default)
+    return view if view in VIEWS else default
+
+def build_projections(overrides=None):
+    """既定の射影に API_PROJECTIONS の指定を反映し、存在しない項目がないか確認"""
+    projections = {kind: dict(views) for kind, views in DEFAULT_PROJECTIONS.items()}
+    for kind, views in (overrides or {}).items():
+        if kind not in FIELDS:
+            raise ValueError(f"API_PROJECTIONS に不明な種類があります: {kind}")
+        for view, fields in views.items():
+            if view not in VIEWS:
+                raise ValueError(f"API_PROJECTIONS に不明な表示の種類があります: {kind}.{view}")
+            unknown = [name for name in fields if name not in FIELDS[kind]]
+            if unknown:
+                raise ValueError(f"API_PROJECTIONS に不明な項目があります: {kind}.{view}: {', '.join(unknown)}")
+            projections[kind][view] = tuple(fields)
+    return projections
+
+def _columns(model, names, allowed):
+    """出力する項目のうちカラムの名前とカラム"""
+    names = [name for name in names if name in allowed]
+    return names, [getattr(model, name) for name in names]
+
+
+# 読み込み
+def fetch_posts(*conditions, limit=None, view='list'):
+    """
+    投稿を新しい順に読み込む
+
+    Returns:
+        (list, list): 投稿の辞書と、それぞれの (created_at, id)（カーソル用）
+    """
+    fields = get_projection('post', view)
+    names, columns = _columns(Post, fields, POST_COLUMNS)
+    stmt = db.select(*columns, Post.created_at, Post.id).where(*conditions).order_by(
+        Post.created_at.desc(), Post.id.desc()
+    )
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    rows = db.session.execute(stmt).all()
+
+    count = len(names)
+    posts = [dict(zip(names, row)) for row in rows]
+    keys = [(row[count], row[count + 1]) for row in rows]
+    post_ids = [post_id for _, post_id in keys]
+    if not post_ids:
+        return posts, keys
+
+    comments = {}
+    comment_items = []
+    if 'comments' in fields:
+        comment_fields = get_projection('comment', view)
+        comment_names, comment_columns = _columns(Comment, comment_fields, COMMENT_COLUMNS)
+        comment_rows = db.session.execute(
+            db.select(*comment_columns, Comment.post_id, Comment.id).where(
+                Comment.post_id.in_(post_ids)
+            ).order_by(Comment.post_id, Comment.created_at, Comment.id)
+        ).all()
+        count = len(comment_names)
+        for row in comment_rows:
+            item = dict(zip(comment_names, row))
+            comments.setdefault(row[count], []).append(item)
+            comment_items.append((row[count + 1], item))
+        if 'attachments' not in comment_fields:
+            comment_items = []
+
+    targets = []
+    if 'attachments' in fields:
+        targets.append((Attachment.post_id, post_ids))
+    if comment_items:
+        targets.append((Attachment.comment_id, [comment_id for comment_id, _ in comment_items]))
+    attachments = fetch_attachments(targets, view)
+
+    for post, post_id in zip(posts, post_ids):
+        if 'comments' in fields:
+            post['comments'] = comments.get(post_id, [])
+        if 'attachments' in fields:
+            post['attachments'] = attachments.get(('post_id', post_id), [])
+    for comment_id, comment in comment_items:
+        comment['attachments'] = attachments.get(('comment_id', comment_id), [])
+    return posts, keys
+
+def fetch_messages(*conditions, limit=None, view='list'):
+    """
+    メッセージを新しい順に読み込む
+
+    Returns:
+        (list, list): メッセージの辞書と、それぞれのID
+    """
+    fields = get_projection('message', view)
+    names, columns = _columns(Message, fields, MESSAGE_COLUMNS)
+    stmt = db.select(*columns, Message.id).where(*conditions).order_by(
+        Message.created_at.desc(), Message.id.desc()
+    )
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    rows = db.session.execute(stmt).all()
+
+    count = len(names)
+    messages = [dict(zip(names, row)) for row in rows]
+    message_ids = [row[count] for row in rows]
+    if 'attachments' in fields and message_ids:
+        attachments = fetch_attachments([(Attachment.message_id, message_ids)], view)
+        for message, message_id in zip(messages, message_ids):
+            message['attachments'] = attachments.get(('message_id', message_id), [])
+    return messages, message_ids
+
+def fetch_contacts(user, view='list'):
+    """user の会話相手を最新メッセージの新しい順に読み込む（Conversation.to_dict と同じ形）"""
+    rows = db.session.execute(
+        db.select(
+            Conversation.user_a, Conversation.user_b, Conversation.unread_a, Conversation.unread_b,
+            Conversation.last_message_id
+        ).where(
+            or_(Conversation.user_a == user, Conversation.user_b == user)
+        ).order_by(Conversation.last_at.desc(), Conversation.last_message_id.desc())
+    ).all()
+
+    message_ids = [row.last_message_id for row in rows if row.last_message_id is not None]
+    latest = {}
+    if message_ids:
+        messages, ids = fetch_messages(Message.id.in_(message_ids), view=view)
+        latest = dict(zip(ids, messages))
+
+    return [
+        {
+            'username': row.user_b if row.user_a == user else row.user_a,
+            'latest_message': latest.get(row.last_message_id),
+            'unread_count': row.unread_a if row.user_a == user else row.unread_b,
+        }
+        for row in rows
+    ]
+
+def fetch_attachments(targets, view='list'):
+    """
+    添付ファイルをまとめて読み込む
+
+    Args:
+        targets (list): (Attachment.post_id などの関連付けのカラム, IDのリスト) のリスト
+
+    Returns:
+        dict: {(カラム名, ID): [添付の辞書, ...]}
+    """
+    fields = get_projection('attachment', view)
+    names, columns = _columns(Attachment, fields, ATTACHMENT_COLUMNS)
+    count = len(names)
+
+    rows = []
+    for owner_column, owner_ids in targets:
+        if not owner_ids:
+            continue
+        for row in db.session.execute(
+            db.select(
+                *columns, owner_column, Attachment.id, Attachment.storage_type,
+                Attachment.drive_view_url, Attachment.content_hash, Attachment.file_path
+            ).where(owner_column.in_(owner_ids)).order_by(Attachment.id)
+        ):
+            rows.append((owner_column.key, row))
+    if not rows:
+        return {}
+
+    variants = {}
+    if 'variants' in fields:
+        variants = fetch_variants([row[count + 1] for _, row in rows], view)
+
+    result = {}
+    for key, row in rows:
+        item = dict(zip(names, row))
+        owner_id, attachment_id, storage_type, drive_view_url, content_hash, file_path = row[count:]
+        if 'url' in fields:
+            item['url'] = attachment_url(attachment_id, storage_type, drive_view_url, content_hash)
+        if 'variants' in fields:
+            item['variants'] = variants.get(attachment_id, {})
+        # Attachment.to_dict と同じく保存先に応じてどちらか一方
+        if storage_type == 'google_drive' and drive_view_url:
+            if 'file_url' in fields:
+                item['file_url'] = drive_view_url
+        elif 'file_path' in fields:
+            item['file_path'] = file_path
+        result.setdefault((key, owner_id), []).append(item)
+    return result
+
+def fetch_variants(attachment_ids, view='list'):
+    """添付ごとの派生ファイル {attachment_id: {kind: 派生ファイルの辞書}}"""
+    fields = get_projection('variant', view)
+    names, columns = _columns(AttachmentVariant, fields, VARIANT_COLUMNS)
+    count = len(names)
+
+    result = {}
+    for row in db.session.execute(
+        db.select(
+            *columns, AttachmentVariant.attachment_id, AttachmentVariant.kind, AttachmentVariant.content_hash
+        ).where(AttachmentVariant.attachment_id.in_(attachment_ids))
+    ):
+        item = dict(zip(names, row))
+        attachment_id, kind, content_hash = row[count:]
+        if 'url' in fields:
+            item['url'] = variant_url(attachment_id, kind, content_hash)
+        result.setdefault(attachment_id, {})[kind] = item
+    return result
+
+
+def init_serializers(app):
+    """JSONプロバイダーと API_PROJECTIONS の射影を設定"""
+    app.json_provider_class = FastJSONProvider
+    app.json = FastJSONProvider(app)
+    app.extensions['api_projections'] = build_projections(app.config.get('API_PROJECTIONS'))
+    if orjson is None:
+        logger.info("orjson がインストールされていないため、標準のjsonでエンコードします")
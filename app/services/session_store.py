@@ -0,0 +1,369 @@
+"""
+サーバーサイドセッション
+セッションの中身はサーバー側に保存し、Cookieにはセッションの識別子だけを入れる
+
+保存先は SESSION_BACKEND で選ぶ
+- 'sql': アプリのデータベース（sessions テーブル）。複数ワーカー・複数ノードで共有できる
+- 'redis': SESSION_REDIS_URL のRedis（有効期限はRedisのTTLで管理）
+- 'memory': ワーカー内のメモリのみ（1プロセスで動かす場合・開発用）
+
+共有の保存先の前にワーカー内のLRUキャッシュを置き、同じワーカーへの続けてのリクエストでは保存先を読まない。
+セッションの中身は実際に参照されたときに初めて読み込むため、セッションを使わないAPIでは読み書きが発生しない
+"""
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+import logging
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from app.models.db import StoredSession, db
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# セッションIDの形式（Cookieの値をそのまま保存先のキーに使うため検証する）
+_SID_RE = re.compile(r'^[A-Za-z0-9_-]{32,64}$')
+
+# Redisのキーの接頭辞
+REDIS_KEY_PREFIX = 'session:'
+
+def generate_sid():
+    return secrets.token_urlsafe(32)
+
+
+class ServerSession(SessionMixin):
+    """保存先からの読み込みを最初に参照されるまで遅らせるセッション"""
+
+    def __init__(self, sid, loader=None):
+        """
+        Args:
+            sid (str): セッションID
+            loader (callable): 保存されている中身を返す関数（なければNone）。Noneなら新しいセッション
+        """
+        self.sid = sid
+        self.new = loader is None
+        self.modified = False
+        self.accessed = False
+        self._loader = loader
+        self._data = {} if loader is None else None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def _load(self):
+        self.accessed = True
+        if self._data is None:
+            data = self._loader()
+            self._loader = None
+            if data is None:
+                # 期限切れ・不明なIDはそのまま使わず、新しいIDで作り直す
+                self.sid = generate_sid()
+                self.new = True
+                data = {}
+            self._data = data
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def clear(self):
+        # 中身を読み込まずに空にする
+        self.accessed = True
+        self._loader = None
+        self._data = {}
+        self.modified = True
+
+
+class MemorySessionStore:
+    """有効期限付きLRU（ワーカー内メモリ）"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at <= time.time():
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            return payload
+
+    def set(self, sid, payload, expires_at):
+        with self._lock:
+            self._entries[sid] = (expires_at, payload)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+    def sweep(self):
+        """期限切れのセッションを削除し、件数を返す"""
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, (expires_at, _) in self._entries.items() if expires_at <= now]
+            for sid in expired:
+                del self._entries[sid]
+        return len(expired)
+
+
+class SQLSessionStore:
+    """アプリのデータベースの sessions テーブル（ORMのトランザクションとは別の接続で読み書きする）"""
+
+    table = StoredSession.__table__
+
+    def get(self, sid):
+        with db.engine.connect() as conn:
+            return conn.execute(
+                db.select(self.table.c.data).where(
+                    self.table.c.sid == sid,
+                    self.table.c.expires_at > datetime.now()
+                )
+            ).scalar()
+
+    def set(self, sid, payload, expires_at):
+        values = {'data': payload, 'expires_at': datetime.fromtimestamp(expires_at)}
+        with db.engine.begin() as conn:
+            dialect = conn.dialect.name
+            if dialect in ('sqlite', 'postgresql'):
+                if dialect == 'sqlite':
+                    from sqlalchemy.dialects.sqlite import insert
+                else:
+                    from sqlalchemy.dialects.postgresql import insert
+                conn.execute(
+                    insert(self.table).values(sid=sid, **values)
+                    .on_conflict_do_update(index_elements=['sid'], set_=values)
+                )
+                return
+            updated = conn.execute(
+                db.update(self.table).where(self.table.c.sid == sid).values(**values)
+            ).rowcount
+            if not updated:
+                conn.execute(db.insert(self.table).values(sid=sid, **values))
+
+    def delete(self, sid):
+        with db.engine.begin() as conn:
+            conn.execute(db.delete(self.table).where(self.table.c.sid == sid))
+
+    def sweep(self):
+        with db.engine.begin() as conn:
+            return conn.execute(
+                db.delete(self.table).where(self.table.c.expires_at <= datetime.now())
+            ).rowcount
+
+
+class RedisSessionStore:
+    """Redis（有効期限はキーのTTLで管理するため掃除は不要）"""
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.from_url(url)
+
+    def get(self, sid):
+        payload = self.client.get(REDIS_KEY_PREFIX + sid)
+        return payload.decode('utf-8') if payload is not None else None
+
+    def set(self, sid, payload, expires_at):
+        ttl = max(1, int(expires_at - time.time()))
+        self.client.set(REDIS_KEY_PREFIX + sid, payload, ex=ttl)
+
+    def delete(self, sid):
+        self.client.delete(REDIS_KEY_PREFIX + sid)
+
+    def sweep(self):
+        return 0
+
+
+class TieredSessionStore:
+    """ワーカー内のLRUキャッシュ + 共有の保存先（書き込みは両方に行う）"""
+
+    def __init__(self, shared, max_entries=1024, cache_ttl=5):
+        """
+        Args:
+            shared: 共有の保存先（SQLSessionStore / RedisSessionStore）
+            max_entries (int): ワーカー内に保持する最大件数
+            cache_ttl (int): ワーカー内のキャッシュを使う秒数（他のワーカーでの更新が見えるまでの最大時間）
+        """
+        self.shared = shared
+        self.cache_ttl = cache_ttl
+        self.local = MemorySessionStore(max_entries) if cache_ttl > 0 else None
+
+    def get(self, sid):
+        if self.local is not None:
+            payload = self.local.get(sid)
+            if payload is not None:
+                return payload
+        payload = self.shared.get(sid)
+        if payload is not None and self.local is not None:
+            self.local.set(sid, payload, time.time() + self.cache_ttl)
+        return payload
+
+    def set(self, sid, payload, expires_at):
+        self.shared.set(sid, payload, expires_at)
+        if self.local is not None:
+            self.local.set(sid, payload, min(expires_at, time.time() + self.cache_ttl))
+
+    def delete(self, sid):
+        if self.local is not None:
+            self.local.delete(sid)
+        self.shared.delete(sid)
+
+    def sweep(self):
+        if self.local is not None:
+            self.local.sweep()
+        return self.shared.sweep()
+
+
+class ServerSessionInterface(SessionInterface):
+    """セッションの中身をサーバー側の保存先に置くセッションインターフェース"""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, sweep_interval=600):
+        """
+        Args:
+            store: 保存先（get / set / delete / sweep を持つオブジェクト）
+            sweep_interval (int): 期限切れのセッションを削除する間隔（秒、0以下で無効）
+        """
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._sweep_lock = threading.Lock()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and _SID_RE.match(sid):
+            return ServerSession(sid, loader=lambda: self._load(sid))
+        return ServerSession(generate_sid())
+
+    def _load(self, sid):
+        try:
+            payload = self.store.get(sid)
+            if payload is None:
+                return None
+            return self.serializer.loads(payload)
+        except Exception as e:
+            logger.warning(f"セッションの読み込みに失敗: {str(e)}")
+            return None
+
+    def save_session(self, app, session, response):
+        # 参照されなかったセッションは読み書きしない
+        if not session.loaded:
+            return
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        # 空になったセッションは削除する
+        if not session:
+            if session.modified:
+                if not session.new:
+                    self._call_store('delete', session.sid)
+                response.delete_cookie(
+                    name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly
+                )
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        expires_at = time.time() + app.permanent_session_lifetime.total_seconds()
+        self._call_store('set', session.sid, self.serializer.dumps(dict(session)), expires_at)
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=httponly,
+            domain=domain,
+            path=path,
+            secure=secure,
+            samesite=samesite
+        )
+        self._maybe_sweep()
+
+    def _call_store(self, method, *args):
+        try:
+            return getattr(self.store, method)(*args)
+        except Exception as e:
+            logger.error(f"セッションの保存先の操作に失敗（{method}）: {str(e)}")
+            return None
+
+    def _maybe_sweep(self):
+        """前回から sweep_interval 秒以上経っていれば期限切れのセッションを削除"""
+        if self.sweep_interval <= 0:
+            return
+        with self._sweep_lock:
+            if time.monotonic() < self._next_sweep:
+                return
+            self._next_sweep = time.monotonic() + self.sweep_interval
+        self.sweep()
+
+    def sweep(self):
+        """期限切れのセッションを削除し、件数を返す"""
+        count = self._call_store('sweep') or 0
+        if count:
+            logger.info(f"期限切れのセッションを削除: {count}件")
+        return count
+
+
+def create_session_store(app):
+    """設定に応じたセッションの保存先を作成"""
+    backend = app.config.get('SESSION_BACKEND', 'sql')
+    max_entries = app.config.get('SESSION_CACHE_SIZE', 1024)
+    cache_ttl = app.config.get('SESSION_CACHE_TTL', 5)
+
+    if backend == 'memory':
+        return MemorySessionStore(max_entries)
+    if backend == 'redis':
+        redis_url = app.config.get('SESSION_REDIS_URL')
+        if redis_url:
+            try:
+                return TieredSessionStore(RedisSessionStore(redis_url), max_entries, cache_ttl)
+            except Exception as e:
+                logger.error(f"Redisのセッション保存先の初期化に失敗、データベースを使用: {str(e)}")
+        else:
+            logger.error("SESSION_REDIS_URL が未設定のため、データベースにセッションを保存します")
+    elif backend != 'sql':
+        raise ValueError(f"不明なSESSION_BACKEND: {backend}")
+    return TieredSessionStore(SQLSessionStore(), max_entries, cache_ttl)
+
+def init_session(app):
+    """サーバーサイドセッションを有効化"""
+    app.session_interface = ServerSessionInterface(
+        create_session_store(app),
+        sweep_interval=app.config.get('SESSION_SWEEP_INTERVAL', 600)
+    )
+    return app.session_interface
@@ -1,5 +1,8 @@
 from flask_socketio import SocketIO, emit, join_room, leave_room
+import queue
+import threading
 import logging
+import socketio as python_socketio
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
@@ -7,11 +10,86 @@ logger = logging.getLogger(__name__)
 # SocketIOの設定
 socketio = SocketIO()
 
+# 掲示板を開いているクライアントが参加するルーム
+BOARD_ROOM = 'board'
+
+# 1回のjoin_postsで参加できる投稿ルームの上限
+MAX_POST_ROOMS = 200
+
+# プロセス内のメッセージキューを使う SOCKETIO_MESSAGE_QUEUE の値（テスト用）
+LOCAL_MESSAGE_QUEUE = 'local://'
+
+
+class LocalPubSubManager(python_socketio.PubSubManager):
+    """
+    プロセス内のメッセージキュー（テスト用）
+
+    同じチャンネルの LocalPubSubManager を持つSocketIOサーバー同士をワーカーに見立てて、
+    Redis/Kombu と同じ経路（JSONにエンコードしたメッセージの配信）でイベントを届ける
+    """
+    name = 'local'
+
+    # チャンネル -> 購読しているマネージャーのキュー
+    _subscribers = {}
+    _subscribers_lock = threading.Lock()
+
+    def __init__(self, channel='flask-socketio', write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self._queue = queue.Queue()
+        if not write_only:
+            with self._subscribers_lock:
+                self._subscribers.setdefault(channel, []).append(self._queue)
+
+    def _publish(self, data):
+        message = self.json.dumps(data)
+        with self._subscribers_lock:
+            queues = list(self._subscribers.get(self.channel, []))
+        for subscriber in queues:
+            subscriber.put(message)
+
+    def _listen(self):
+        while True:
+            yield self._queue.get()
+
+    def close(self):
+        """購読をやめる（テストの後始末用）"""
+        with self._subscribers_lock:
+            queues = self._subscribers.get(self.channel, [])
+            if self._queue in queues:
+                queues.remove(self._queue)
+
+
+def user_room(username):
+    """ユーザー個別のルーム名（DM・既読通知用）"""
+    return f'user:{username}'
+
+def post_room(post_id):
+    """投稿ごとのルーム名（コメント通知用）"""
+    return f'post:{post_id}'
+
+def job_room(job_id):
+    """質問ジョブごとのルーム名（完了通知用）"""
+    return f'job:{job_id}'
+
 def init_socketio(app):
-    """SocketIOを初期化"""
+    """SocketIOを初期化
+
+    SOCKETIO_MESSAGE_QUEUE が設定されている場合はメッセージキュー（Redis/Kombu）経由で
+    イベントを配信し、複数ワーカー・複数ノードのどこに接続したクライアントにも届くようにする。
+    'local://' を指定するとプロセス内のキュー（LocalPubSubManager）を使う（テスト用）
+    """
+    message_queue = app.config.get('SOCKETIO_MESSAGE_QUEUE')
+    channel = app.config.get('SOCKETIO_CHANNEL', 'flask-socketio')
+    queue_options = {'message_queue': message_queue, 'channel': channel}
+    if message_queue == LOCAL_MESSAGE_QUEUE:
+        queue_options = {'client_manager': LocalPubSubManager(channel=channel)}
+    if message_queue:
+        logger.info('SocketIO message queue enabled')
+    
     # エラーハンドリングを強化
     socketio.init_app(
         app, 
+        **queue_options,
         cors_allowed_origins="*",
         ping_timeout=60,  # タイムアウト時間を延長
         ping_interval=25,  # ping間隔を調整
@@ -47,7 +125,7 @@ def handle_join(data):
     """特定のルームに参加"""
     username = data.get('username')
     if username:
-        join_room(username)
+        join_room(user_room(username))
         logger.info(f'User {username} joined their room')
 
 @socketio.on('leave')
@@ -55,51 +133,125 @@ def handle_leave(data):
     """特定のルームから退出"""
     username = data.get('username')
     if username:
-        leave_room(username)
+        leave_room(user_room(username))
         logger.info(f'User {username} left their room')
 
+@socketio.on('join_board')
+def handle_join_board():
+    """掲示板の新規投稿・削除通知を受け取るルームに参加"""
+    join_room(BOARD_ROOM)
+
+@socketio.on('join_posts')
+def handle_join_posts(data):
+    """表示中の投稿のコメント通知を受け取るルームに参加"""
+    post_ids = data.get('post_ids') or []
+    for post_id in post_ids[:MAX_POST_ROOMS]:
+        if isinstance(post_id, int):
+            join_room(post_room(post_id))
+
+@socketio.on('leave_posts')
+def handle_leave_posts(data):
+    """表示しなくなった投稿のルームから退出"""
+    post_ids = data.get('post_ids') or []
+    for post_id in post_ids[:MAX_POST_ROOMS]:
+        if isinstance(post_id, int):
+            leave_room(post_room(post_id))
+
+@socketio.on('watch_job')
+def handle_watch_job(data):
+    """質問ジョブの完了通知を受け取るルームに参加"""
+    job_id = data.get('job_id')
+    if job_id:
+        join_room(job_room(job_id))
+
 # 掲示板関連のイベント送信関数
-def emit_new_post(post_data):
-    """新しい投稿があったことを通知"""
+# ペイロードはIDと変更点のみとし、詳細はクライアントがAPIから取得する
+def emit_new_post(post):
+    """新しい投稿があったことを掲示板の閲覧者に通知"""
     try:
-        socketio.emit('new_post', post_data)
-        logger.info(f'Emitted new_post event: post_id={post_data.get("id")}')
+        socketio.emit('new_post', {
+            'id': post.id,
+            'author': post.author,
+            'created_at': post.created_at.isoformat()
+        }, room=BOARD_ROOM)
+        logger.info(f'Emitted new_post event: post_id={post.id}')
     except Exception as e:
         logger.error(f'Error emitting new_post: {str(e)}')
 
-def emit_new_comment(comment_data):
-    """新しいコメントがあったことを通知"""
+def emit_new_comment(comment):
+    """新しいコメントがあったことを投稿のルームに通知"""
     try:
-        socketio.emit('new_comment', comment_data)
-        logger.info(f'Emitted new_comment event: post_id={comment_data.get("post_id")}')
+        socketio.emit('new_comment', {
+            'post_id': comment.post_id,
+            'comment_id': comment.id
+        }, room=post_room(comment.post_id))
+        logger.info(f'Emitted new_comment event: post_id={comment.post_id}')
     except Exception as e:
         logger.error(f'Error emitting new_comment: {str(e)}')
 
 def emit_delete_post(post_id):
     """投稿が削除されたことを通知"""
     try:
-        socketio.emit('delete_post', {'post_id': post_id})
+        socketio.emit('delete_post', {'post_id': post_id}, room=BOARD_ROOM)
+        socketio.close_room(post_room(post_id))
         logger.info(f'Emitted delete_post event: post_id={post_id}')
     except Exception as e:
         logger.error(f'Error emitting delete_post: {str(e)}')
 
+def emit_attachment_updated(attachment):
+    """添付ファイルの保存先やサムネイル等が変わったことを通知（URLが変わるため）"""
+    try:
+        data = {
+            'id': attachment.id,
+            'url': attachment.access_url,
+            'storage_type': attachment.storage_type,
+            'variants': {variant.kind: variant.to_dict() for variant in attachment.variants}
+        }
+        if attachment.message is not None:
+            message = attachment.message
+            for room in {user_room(message.receiver), user_room(message.sender)}:
+                socketio.emit('attachment_updated', data, room=room)
+        else:
+            socketio.emit('attachment_updated', data, room=BOARD_ROOM)
+        logger.info(f'Emitted attachment_updated event: attachment_id={attachment.id}')
+    except Exception as e:
+        logger.error(f'Error emitting attachment_updated: {str(e)}')
+
 # メッセージ関連のイベント送信関数
-def emit_new_message(message_data):
-    """新しいメッセージがあったことを通知"""
+def emit_new_message(message):
+    """新しいメッセージがあったことを送信者・受信者に通知"""
     try:
-        socketio.emit('new_message', message_data)
-        # 受信者のルームにも通知
-        socketio.emit('new_message', message_data, room=message_data['receiver'])
-        logger.info(f'Emitted new_message event to {message_data.get("receiver")}')
+        data = {
+            'id': message.id,
+            'sender': message.sender,
+            'receiver': message.receiver,
+            'created_at': message.created_at.isoformat()
+        }
+        # 受信者と、送信者の他のタブにのみ通知
+        for room in {user_room(message.receiver), user_room(message.sender)}:
+            socketio.emit('new_message', data, room=room)
+        logger.info(f'Emitted new_message event to {message.receiver}')
     except Exception as e:
         logger.error(f'Error emitting new_message: {str(e)}')
 
 def emit_read_messages(data):
-    """メッセージが既読になったことを通知"""
+    """メッセージが既読になったことを送信者に通知"""
     try:
-        socketio.emit('read_messages', data)
-        # 送信者のルームにも通知
-        socketio.emit('read_messages', data, room=data['sender'])
+        # 送信者のルームにのみ通知
+        socketio.emit('read_messages', data, room=user_room(data['sender']))
         logger.info(f'Emitted read_messages event to {data.get("sender")}')
     except Exception as e:
         logger.error(f'Error emitting read_messages: {str(e)}')
+
+# AIアドバイス関連のイベント送信関数
+def emit_ask_job_done(job):
+    """質問ジョブが完了したことを通知（結果はAPIから取得する）"""
+    try:
+        socketio.emit('ask_job_done', {
+            'job_id': job.id,
+            'status': job.status
+        }, room=job_room(job.id))
+        socketio.close_room(job_room(job.id))
+        logger.info(f'Emitted ask_job_done event: job_id={job.id}')
+    except Exception as e:
+        logger.error(f'Error emitting ask_job_done: {str(e)}')
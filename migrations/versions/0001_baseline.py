@@ -0,0 +1,137 @@
+"""ベースライン（マイグレーション導入前のスキーマ）
+
+マイグレーション導入前は db.create_all() と不足カラムの追加でスキーマを作っていたため、
+既存のデータベースには途中までのテーブル・カラムしかない場合がある。
+このリビジョンは存在しないテーブル・カラム・インデックスだけを作成するので、
+新規・既存どちらのデータベースにもそのまま適用できる（stampは不要）。
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 10:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _tables():
+    """導入時点のテーブル定義（テーブル名, カラム, 制約, インデックス）"""
+    return [
+        ('posts', [
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('content', sa.Text(), nullable=False),
+            sa.Column('author', sa.String(length=100), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('updated_at', sa.DateTime(), nullable=True),
+        ], [], []),
+        ('comments', [
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('content', sa.Text(), nullable=False),
+            sa.Column('author', sa.String(length=100), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('post_id', sa.Integer(), sa.ForeignKey('posts.id'), nullable=False),
+        ], [], []),
+        ('messages', [
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('content', sa.Text(), nullable=False),
+            sa.Column('sender', sa.String(length=100), nullable=False),
+            sa.Column('receiver', sa.String(length=100), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('is_read', sa.Boolean(), nullable=True),
+        ], [], [
+            ('ix_messages_sender_receiver_created_at', ['sender', 'receiver', 'created_at'], False),
+            ('ix_messages_receiver_is_read', ['receiver', 'is_read'], False),
+        ]),
+        ('attachments', [
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('filename', sa.String(length=255), nullable=False),
+            sa.Column('file_path', sa.String(length=500), nullable=True),
+            sa.Column('file_type', sa.String(length=100), nullable=True),
+            sa.Column('file_size', sa.Integer(), nullable=True),
+            sa.Column('content_hash', sa.String(length=64), nullable=True),
+            sa.Column('uploaded_at', sa.DateTime(), nullable=True),
+            sa.Column('storage_type', sa.String(length=20), nullable=True),
+            sa.Column('drive_file_id', sa.String(length=100), nullable=True),
+            sa.Column('drive_view_url', sa.String(length=500), nullable=True),
+            sa.Column('post_id', sa.Integer(), sa.ForeignKey('posts.id'), nullable=True),
+            sa.Column('comment_id', sa.Integer(), sa.ForeignKey('comments.id'), nullable=True),
+            sa.Column('message_id', sa.Integer(), sa.ForeignKey('messages.id'), nullable=True),
+        ], [], [
+            ('ix_attachments_content_hash', ['content_hash'], False),
+        ]),
+        ('attachment_variants', [
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('attachment_id', sa.Integer(), sa.ForeignKey('attachments.id'), nullable=False),
+            sa.Column('kind', sa.String(length=20), nullable=False),
+            sa.Column('file_path', sa.String(length=500), nullable=False),
+            sa.Column('file_type', sa.String(length=100), nullable=True),
+            sa.Column('file_size', sa.Integer(), nullable=True),
+            sa.Column('width', sa.Integer(), nullable=True),
+            sa.Column('height', sa.Integer(), nullable=True),
+            sa.Column('content_hash', sa.String(length=64), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+        ], [
+            sa.UniqueConstraint('attachment_id', 'kind', name='uq_attachment_variants_attachment_kind'),
+        ], [
+            ('ix_attachment_variants_attachment_id', ['attachment_id'], False),
+        ]),
+        ('search_documents', [
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('doc_type', sa.String(length=20), nullable=False),
+            sa.Column('doc_id', sa.Integer(), nullable=False),
+            sa.Column('post_id', sa.Integer(), nullable=True),
+            sa.Column('sender', sa.String(length=100), nullable=True),
+            sa.Column('receiver', sa.String(length=100), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('tokens', sa.Text(), nullable=False),
+        ], [
+            sa.UniqueConstraint('doc_type', 'doc_id', name='uq_search_documents_doc'),
+        ], [
+            ('ix_search_documents_post_id', ['post_id'], False),
+        ]),
+        ('file_tombstones', [
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('storage_type', sa.String(length=20), nullable=True),
+            sa.Column('file_path', sa.String(length=500), nullable=True),
+            sa.Column('content_hash', sa.String(length=64), nullable=True),
+            sa.Column('drive_file_id', sa.String(length=100), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('attempts', sa.Integer(), nullable=True),
+            sa.Column('last_error', sa.Text(), nullable=True),
+        ], [], []),
+    ]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    existing_tables = set(inspector.get_table_names())
+
+    for table_name, columns, constraints, indexes in _tables():
+        if table_name not in existing_tables:
+            op.create_table(table_name, *columns, *constraints)
+        else:
+            # 後から追加したカラム（すべてNULL可）が無ければ追加
+            existing_columns = {column['name'] for column in inspector.get_columns(table_name)}
+            for column in columns:
+                if column.name not in existing_columns:
+                    op.add_column(table_name, sa.Column(column.name, column.type, nullable=True))
+
+        existing_indexes = set()
+        if table_name in existing_tables:
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table_name)}
+        for index_name, index_columns, unique in indexes:
+            if index_name not in existing_indexes:
+                op.create_index(index_name, table_name, index_columns, unique=unique)
+
+
+def downgrade():
+    # 何もしない: このリビジョンはマイグレーション導入前から存在したテーブルにも適用されるため、
+    # 取り消しでテーブルを削除すると既存のデータが失われる（downgrade base はバージョンの記録だけを外す）
+    pass
@@ -0,0 +1,63 @@
+"""一覧・削除のクエリ用の複合インデックスを追加
+
+- posts(created_at, id): 投稿一覧（新しい順、キーセットページネーション）
+- comments(post_id, created_at): 投稿ごとのコメント取得と、投稿削除時のコメント検索
+- messages(receiver, sender, created_at): 会話相手一覧・会話履歴のうち自分が受信者の側
+- attachments(post_id) / (comment_id) / (message_id): 添付の一括読み込みと削除
+- attachments(drive_file_id): 削除待ちファイルの参照確認
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 10:30:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_posts_created_at_id', 'posts', ['created_at', 'id']),
+    ('ix_comments_post_id_created_at', 'comments', ['post_id', 'created_at']),
+    ('ix_messages_receiver_sender_created_at', 'messages', ['receiver', 'sender', 'created_at']),
+    ('ix_attachments_post_id', 'attachments', ['post_id']),
+    ('ix_attachments_comment_id', 'attachments', ['comment_id']),
+    ('ix_attachments_message_id', 'attachments', ['message_id']),
+    ('ix_attachments_drive_file_id', 'attachments', ['drive_file_id']),
+]
+
+
+def _drop_invalid_indexes(bind):
+    """途中で失敗した CREATE INDEX CONCURRENTLY が残した無効なインデックスを削除（IF NOT EXISTS で飛ばされないように）"""
+    invalid = bind.execute(sa.text(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE NOT i.indisvalid AND pg_table_is_visible(c.oid) AND c.relname = ANY(:names)"
+    ), {'names': [index_name for index_name, _, _ in INDEXES]}).scalars().all()
+    for index_name in invalid:
+        op.drop_index(index_name, postgresql_concurrently=True, if_exists=True)
+
+
+def upgrade():
+    # PostgreSQLでは書き込みを止めないようCONCURRENTLYで作成する（トランザクション外で実行する必要がある）。
+    # トランザクション外のため途中で失敗すると作成済みのインデックスが残るので、再実行では作成済みのものを飛ばす
+    bind = op.get_bind()
+    with op.get_context().autocommit_block():
+        if bind.dialect.name == 'postgresql':
+            _drop_invalid_indexes(bind)
+        for index_name, table_name, columns in INDEXES:
+            op.create_index(
+                index_name, table_name, columns, unique=False,
+                postgresql_concurrently=True, if_not_exists=True
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for index_name, table_name, _ in reversed(INDEXES):
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
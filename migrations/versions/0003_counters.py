@@ -0,0 +1,93 @@
+"""投稿のコメント数・添付数と会話の集計テーブルを追加
+
+- posts.comment_count / attachment_count: 一覧で件数を表示するための集計（添付数はコメントの添付を含む）
+- conversations: DMの会話ごとの最新メッセージと参加者それぞれの未読件数
+
+既存のデータから集計を埋める（以降は app.services.counters が書き込み時に更新する）
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 13:00:00
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.add_column(sa.Column('comment_count', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('attachment_count', sa.Integer(), nullable=False, server_default='0'))
+
+    op.create_table(
+        'conversations',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_a', sa.String(length=100), nullable=False),
+        sa.Column('user_b', sa.String(length=100), nullable=False),
+        sa.Column('last_message_id', sa.Integer(), sa.ForeignKey('messages.id'), nullable=True),
+        sa.Column('last_at', sa.DateTime(), nullable=True),
+        sa.Column('unread_a', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('unread_b', sa.Integer(), nullable=False, server_default='0'),
+        sa.UniqueConstraint('user_a', 'user_b', name='uq_conversations_users'),
+    )
+    op.create_index('ix_conversations_user_a_last_at', 'conversations', ['user_a', 'last_at'])
+    op.create_index('ix_conversations_user_b_last_at', 'conversations', ['user_b', 'last_at'])
+
+    op.execute(
+        "UPDATE posts SET "
+        "comment_count = (SELECT COUNT(*) FROM comments WHERE comments.post_id = posts.id), "
+        "attachment_count = (SELECT COUNT(*) FROM attachments WHERE attachments.post_id = posts.id "
+        "OR attachments.comment_id IN (SELECT comments.id FROM comments WHERE comments.post_id = posts.id))"
+    )
+
+    # 送信者→受信者の向きごとの最新メッセージと未読件数を、2人の会話ごとにまとめる
+    # （2人の並び順はデータベースの照合順序ではなくPythonの文字列比較で決める）
+    bind = op.get_bind()
+    rows = bind.execute(sa.text(
+        "SELECT sender, receiver, id, created_at, unread FROM ("
+        "SELECT sender, receiver, id, created_at, "
+        "ROW_NUMBER() OVER (PARTITION BY sender, receiver ORDER BY created_at DESC, id DESC) AS rn, "
+        "SUM(CASE WHEN is_read = :false THEN 1 ELSE 0 END) OVER (PARTITION BY sender, receiver) AS unread "
+        "FROM messages) AS ranked WHERE rn = 1"
+    ).columns(created_at=sa.DateTime()), {'false': False})
+
+    conversations = {}
+    for sender, receiver, message_id, created_at, unread in rows:
+        user_a, user_b = (sender, receiver) if sender <= receiver else (receiver, sender)
+        values = conversations.setdefault((user_a, user_b), {
+            'user_a': user_a, 'user_b': user_b, 'last_message_id': None, 'last_at': None,
+            'unread_a': 0, 'unread_b': 0
+        })
+        values['unread_a' if receiver == user_a else 'unread_b'] += int(unread or 0)
+        if values['last_message_id'] is None or (
+            (created_at or datetime.min, message_id) > (values['last_at'] or datetime.min, values['last_message_id'])
+        ):
+            values['last_message_id'] = message_id
+            values['last_at'] = created_at
+
+    if conversations:
+        table = sa.table(
+            'conversations',
+            sa.column('user_a'), sa.column('user_b'), sa.column('last_message_id'),
+            sa.column('last_at', sa.DateTime()), sa.column('unread_a'), sa.column('unread_b')
+        )
+        op.bulk_insert(table, list(conversations.values()))
+
+
+def downgrade():
+    op.drop_index('ix_conversations_user_b_last_at', table_name='conversations')
+    op.drop_index('ix_conversations_user_a_last_at', table_name='conversations')
+    op.drop_table('conversations')
+
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('attachment_count')
+        batch_op.drop_column('comment_count')
@@ -0,0 +1,51 @@
+"""差分の取得用の変更履歴テーブルを追加
+
+- change_versions: 掲示板全体・DMの会話ごとの現在のバージョン（ETagと ?since= の基準）
+- changes: バージョンごとの変更（投稿・メッセージの追加・更新・削除）
+
+既存のデータの履歴は作らない（バージョン0からの差分は、最初の一覧の取得で代わりにする）
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 15:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'change_versions',
+        sa.Column('scope', sa.String(length=20), primary_key=True),
+        sa.Column('scope_key', sa.String(length=201), primary_key=True),
+        sa.Column('version', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('pruned_version', sa.Integer(), nullable=False, server_default='0'),
+    )
+    op.create_table(
+        'changes',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('scope', sa.String(length=20), nullable=False),
+        sa.Column('scope_key', sa.String(length=201), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('item_type', sa.String(length=20), nullable=False),
+        sa.Column('item_id', sa.Integer(), nullable=False),
+        sa.Column('action', sa.String(length=10), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+    )
+    op.create_index('ix_changes_scope_version', 'changes', ['scope', 'scope_key', 'version'])
+    op.create_index('ix_changes_created_at', 'changes', ['created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_changes_created_at', table_name='changes')
+    op.drop_index('ix_changes_scope_version', table_name='changes')
+    op.drop_table('changes')
+    op.drop_table('change_versions')
@@ -0,0 +1,220 @@
+"""
+インデックス追加前後のクエリプランと実行時間の比較
+
+ダミーデータを投入したデータベースで、投稿一覧・会話履歴・会話相手一覧・投稿削除などの
+主要なクエリを、マイグレーション 0001（インデックス追加前）と head（追加後）で実行し、
+クエリプラン（SQLite: EXPLAIN QUERY PLAN / PostgreSQL: EXPLAIN ANALYZE）と実行時間を表示する
+
+使い方:
+    python scripts/benchmark_query_plans.py                      # 一時的なSQLiteで実行
+    python scripts/benchmark_query_plans.py --posts 20000 --messages 100000
+    python scripts/benchmark_query_plans.py --database-url postgresql://...   # 空のデータベースを指定すること
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import and_, case, func, or_
+from app import create_app
+from app.models.db import Attachment, Comment, Message, Post, db, upgrade_schema
+
+# インデックス追加前のリビジョン
+BASE_REVISION = '0001'
+
+# 1回にINSERTする件数
+INSERT_CHUNK = 5000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='対象のデータベース（省略時は一時的なSQLite）')
+    parser.add_argument('--posts', type=int, default=5000, help='投稿の件数')
+    parser.add_argument('--comments-per-post', type=int, default=5, help='投稿あたりの最大コメント数')
+    parser.add_argument('--messages', type=int, default=50000, help='メッセージの件数')
+    parser.add_argument('--users', type=int, default=50, help='ユーザー数')
+    parser.add_argument('--repeat', type=int, default=20, help='実行時間の計測回数')
+    parser.add_argument('--seed', type=int, default=1, help='乱数のシード')
+    return parser.parse_args()
+
+
+def insert_rows(model, rows):
+    for i in range(0, len(rows), INSERT_CHUNK):
+        db.session.execute(db.insert(model), rows[i:i + INSERT_CHUNK])
+    db.session.commit()
+
+
+def seed(args):
+    """ダミーデータを投入"""
+    rng = random.Random(args.seed)
+    users = [f"user{i}" for i in range(args.users)]
+    start = datetime(2024, 1, 1)
+
+    posts = [
+        {'id': i, 'content': f"投稿{i}", 'author': rng.choice(users),
+         'created_at': start + timedelta(minutes=i), 'updated_at': start + timedelta(minutes=i)}
+        for i in range(1, args.posts + 1)
+    ]
+    insert_rows(Post, posts)
+
+    comments = []
+    for post in posts:
+        for _ in range(rng.randint(0, args.comments_per_post)):
+            comments.append({
+                'id': len(comments) + 1, 'content': 'コメント', 'author': rng.choice(users),
+                'post_id': post['id'], 'created_at': post['created_at'] + timedelta(seconds=rng.randint(1, 3600))
+            })
+    insert_rows(Comment, comments)
+
+    messages = []
+    for i in range(1, args.messages + 1):
+        sender, receiver = rng.sample(users, 2)
+        messages.append({
+            'id': i, 'content': f"メッセージ{i}", 'sender': sender, 'receiver': receiver,
+            'created_at': start + timedelta(seconds=i * 30), 'is_read': rng.random() < 0.9
+        })
+    insert_rows(Message, messages)
+
+    # 約2割の投稿・コメント・メッセージに添付ファイル
+    attachments = []
+    targets = ([('post_id', row['id']) for row in posts] +
+               [('comment_id', row['id']) for row in comments] +
+               [('message_id', row['id']) for row in messages])
+    for column, target_id in targets:
+        if rng.random() < 0.2:
+            n = len(attachments) + 1
+            attachments.append({
+                'id': n, 'filename': f"file{n}.png", 'file_type': 'image/png', 'file_size': 1024,
+                'storage_type': 'google_drive', 'drive_file_id': f"drive{n}",
+                'uploaded_at': start, column: target_id
+            })
+    insert_rows(Attachment, attachments)
+
+    print(f"投入: 投稿{len(posts)}件, コメント{len(comments)}件, "
+          f"メッセージ{len(messages)}件, 添付{len(attachments)}件")
+    return users, posts
+
+
+def build_queries(users, posts):
+    """ルートと同じ形のクエリを作成（名前, ステートメント）"""
+    user, other = users[0], users[1]
+    page_ids = [post['id'] for post in posts[-20:]]
+    middle = posts[len(posts) // 2]
+
+    contact = case((Message.sender == user, Message.receiver), else_=Message.sender)
+    ranked = db.select(
+        Message.id.label('message_id'),
+        func.row_number().over(
+            partition_by=contact,
+            order_by=(Message.created_at.desc(), Message.id.desc())
+        ).label('rank')
+    ).where(or_(Message.sender == user, Message.receiver == user)).subquery()
+
+    return [
+        ('投稿一覧（最新ページ）', db.select(Post).order_by(
+            Post.created_at.desc(), Post.id.desc()).limit(21)),
+        ('投稿一覧（カーソル指定）', db.select(Post).where(or_(
+            Post.created_at < middle['created_at'],
+            and_(Post.created_at == middle['created_at'], Post.id < middle['id'])
+        )).order_by(Post.created_at.desc(), Post.id.desc()).limit(21)),
+        ('ページ内のコメント', db.select(Comment).where(Comment.post_id.in_(page_ids))),
+        ('ページ内の投稿の添付', db.select(Attachment).where(Attachment.post_id.in_(page_ids))),
+        ('会話履歴', db.select(Message).where(or_(
+            and_(Message.sender == other, Message.receiver == user),
+            and_(Message.sender == user, Message.receiver == other)
+        )).order_by(Message.created_at.desc(), Message.id.desc()).limit(51)),
+        ('会話相手一覧', db.select(Message).join(
+            ranked, Message.id == ranked.c.message_id
+        ).where(ranked.c.rank == 1).order_by(Message.created_at.desc(), Message.id.desc())),
+        ('未読件数', db.select(func.count(Message.id)).where(
+            Message.receiver == user, Message.is_read == False)),
+        ('投稿削除時の添付', db.select(Attachment.id).where(or_(
+            Attachment.post_id == middle['id'],
+            Attachment.comment_id.in_(db.select(Comment.id).where(Comment.post_id == middle['id']))
+        ))),
+        ('削除待ちDriveファイルの参照確認', db.select(
+            db.select(Attachment.id).where(Attachment.drive_file_id == 'drive1').exists())),
+    ]
+
+
+def explain(stmt):
+    """クエリプランの行を返す"""
+    engine = db.engine
+    sql = str(stmt.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN ANALYZE '
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql(prefix + sql).all()
+    if engine.dialect.name == 'sqlite':
+        return [row[-1] for row in rows]
+    return [row[0] for row in rows]
+
+
+def measure(stmt, repeat):
+    """実行時間の中央値（ミリ秒）"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        db.session.execute(stmt).all()
+        timings.append((time.perf_counter() - started) * 1000)
+        db.session.rollback()
+    return statistics.median(timings)
+
+
+def analyze():
+    """統計情報を更新（プランナーが新しいインデックスを考慮するように）"""
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql('ANALYZE')
+
+
+def run(queries, repeat):
+    analyze()
+    return {name: (explain(stmt), measure(stmt, repeat)) for name, stmt in queries}
+
+
+def main():
+    args = parse_args()
+    tmp_dir = None
+    database_url = args.database_url
+    if not database_url:
+        tmp_dir = tempfile.mkdtemp(prefix='query-plans-')
+        database_url = f"sqlite:///{os.path.join(tmp_dir, 'benchmark.sqlite')}"
+
+    app, _ = create_app({
+        'SQLALCHEMY_DATABASE_URI': database_url,
+        'TESTING': True,
+        'AUTO_MIGRATE': False,
+    })
+
+    with app.app_context():
+        upgrade_schema(BASE_REVISION)
+        users, posts = seed(args)
+        queries = build_queries(users, posts)
+
+        before = run(queries, args.repeat)
+        upgrade_schema()
+        after = run(queries, args.repeat)
+
+        for name, _ in queries:
+            before_plan, before_ms = before[name]
+            after_plan, after_ms = after[name]
+            print(f"\n=== {name}: {before_ms:.2f}ms -> {after_ms:.2f}ms")
+            print('  [前]')
+            for line in before_plan:
+                print(f"    {line}")
+            print('  [後]')
+            for line in after_plan:
+                print(f"    {line}")
+
+    if tmp_dir:
+        os.remove(os.path.join(tmp_dir, 'benchmark.sqlite'))
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import pytest
+
+from app import create_app
+from app.models.db import db
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # ログファイル（logs/）をテストごとの一時ディレクトリに作る
+    monkeypatch.chdir(tmp_path)
+    app, _ = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.sqlite'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'SESSION_BACKEND': 'memory',
+    })
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
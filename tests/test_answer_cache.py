@@ -0,0 +1,74 @@
+from app.services import answer_cache
+from app.services.answer_cache import AnswerCache, make_cache_key, normalize_prompt
+
+
+def key(prompt, model='sonar-pro', temperature=0.7, max_tokens=1024, system_prompt='system'):
+    return make_cache_key(prompt, model, temperature, max_tokens, system_prompt)
+
+
+def test_normalize_prompt():
+    assert normalize_prompt('  ＰＡＲ５で　 ドライバー？ ') == 'par5で ドライバー?'
+    assert normalize_prompt(None) == ''
+
+
+def test_cache_key_ignores_spacing_width_and_case():
+    assert key('Par5 で  ドライバー') == key('ｐａｒ５ で ドライバー ')
+
+
+def test_cache_key_depends_on_model_settings():
+    base = key('question')
+    assert key('question', model='sonar') != base
+    assert key('question', temperature=0.2) != base
+    assert key('question', max_tokens=256) != base
+    assert key('question', system_prompt='other') != base
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(answer_cache.time, 'time', lambda: now[0])
+    cache = AnswerCache(ttl=60)
+    cache.set('k', {'answer': 1})
+
+    now[0] += 59
+    assert cache.get('k') == {'answer': 1}
+    now[0] += 2
+    assert cache.get('k') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = AnswerCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+class FailingBackend:
+    def get(self, key):
+        raise ConnectionError('down')
+
+    def set(self, key, value, timeout=None):
+        raise ConnectionError('down')
+
+
+def test_shared_backend_errors_fall_back_to_memory():
+    cache = AnswerCache(shared=FailingBackend())
+    assert cache.get('k') is None
+    cache.set('k', 1)
+    assert cache.get('k') == 1
+
+
+def test_cache_stats_require_the_stats_token(app, client):
+    assert client.get('/api/ask/cache-stats').status_code == 404
+
+    app.config['STATS_TOKEN'] = 'secret'
+    assert client.get('/api/ask/cache-stats').status_code == 404
+    assert client.get('/api/ask/cache-stats', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    response = client.get('/api/ask/cache-stats', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert response.get_json()['enabled']
@@ -0,0 +1,82 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import llm_scheduler, perplexity
+
+
+def chunk(content=None, usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content else []
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        usage = SimpleNamespace(prompt_tokens=1, completion_tokens=2, total_tokens=3)
+        return FakeStream([chunk('ティーは'), chunk('右狙い'), chunk(usage=usage)])
+
+
+@pytest.fixture
+def fake_client(app, monkeypatch):
+    # スケジューラはプロセス共通のため、テストごとのアプリで作り直す
+    monkeypatch.setattr(llm_scheduler, '_scheduler', None)
+    fake = FakeClient()
+    monkeypatch.setattr(perplexity, 'get_client', lambda: fake)
+    return fake
+
+
+def events(response):
+    return [json.loads(line[6:]) for line in response.get_data(as_text=True).split('\n\n')
+            if line.startswith('data: ')]
+
+
+def test_stream_goes_through_scheduler(client, fake_client):
+    response = client.post('/api/ask/stream', json={'question': '1番ホールの攻め方'})
+
+    payloads = events(response)
+    assert [p['delta'] for p in payloads if 'delta' in p] == ['ティーは', '右狙い']
+    assert payloads[-1]['status'] == 'success'
+    assert fake_client.calls[0]['stream'] is True
+
+    # 回答はキャッシュされ、2回目は上流を呼ばない
+    response = client.post('/api/ask/stream', json={'question': '1番ホールの攻め方'})
+    assert [p['delta'] for p in events(response) if 'delta' in p] == ['ティーは右狙い']
+    assert len(fake_client.calls) == 1
+
+
+def test_stream_falls_back_to_polling_while_queued(app, client, fake_client):
+    app.config['PERPLEXITY_QUEUE_WAIT'] = 0
+    scheduler = llm_scheduler.get_scheduler(app)
+    scheduler.workers = 0
+
+    payloads = events(client.post('/api/ask/stream', json={'question': '2番ホール'}))
+    assert payloads[-1]['status'] == 'queued'
+    job_id = payloads[-1]['job_id']
+    assert client.get(f'/api/ask/jobs/{job_id}').status_code == 202
+
+    scheduler.workers = 1
+    with scheduler._cond:
+        scheduler._ensure_workers()
+    assert scheduler.get_job(job_id).wait(5)
+    response = client.get(f'/api/ask/jobs/{job_id}')
+    assert response.get_json()['answer'] == 'ティーは右狙い'
+    with client.session_transaction() as session:
+        assert session['qa'][0]['a'] == 'ティーは右狙い'
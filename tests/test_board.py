@@ -0,0 +1,16 @@
+import io
+
+
+def test_created_post_matches_get_post(client):
+    response = client.post('/board/api/posts', data={
+        'content': '初投稿',
+        'author': 'alice',
+        'files': (io.BytesIO(b'hello'), 'memo.txt'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 201
+    created = response.get_json()['post']
+    assert created['comments'] == []
+    assert [a['filename'] for a in created['attachments']] == ['memo.txt']
+
+    fetched = client.get(f"/board/api/posts/{created['id']}").get_json()['post']
+    assert created == fetched
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+from app.models.db import Change, db
+from app.services.changes import (
+    BOARD, changes_since, current_version, prune_changes, record_changes, record_post_change
+)
+
+
+def test_changes_since_returns_latest_action_per_item(app):
+    with app.app_context():
+        record_post_change(1)
+        record_post_change(2)
+        record_post_change(1)
+        record_post_change(2, 'delete')
+        db.session.commit()
+
+        version = current_version(BOARD)
+        assert version == 4
+        changes = changes_since(BOARD, '', 0, version)
+        assert changes['upserted'] == [1]
+        assert changes['deleted'] == [2]
+        assert changes['version'] == 4
+        assert not changes['has_more']
+
+        changes = changes_since(BOARD, '', 3, version)
+        assert changes['upserted'] == []
+        assert changes['deleted'] == [2]
+
+
+def test_changes_since_pages_with_has_more(app):
+    with app.app_context():
+        record_changes(BOARD, '', 'post', [1, 2, 3])
+        db.session.commit()
+
+        first = changes_since(BOARD, '', 0, current_version(BOARD), limit=2)
+        assert first['upserted'] == [1, 2]
+        assert first['has_more']
+        rest = changes_since(BOARD, '', first['version'], current_version(BOARD), limit=2)
+        assert rest['upserted'] == [3]
+        assert not rest['has_more']
+
+
+def test_changes_since_requires_reset_after_pruning(app):
+    with app.app_context():
+        record_post_change(1)
+        record_post_change(2)
+        db.session.commit()
+        db.session.execute(db.update(Change).values(created_at=datetime.now() - timedelta(days=30)))
+        db.session.commit()
+        record_post_change(3)
+        db.session.commit()
+
+        assert prune_changes(7 * 24 * 60 * 60) == 2
+        assert changes_since(BOARD, '', 0, current_version(BOARD)) is None
+        assert changes_since(BOARD, '', 2, current_version(BOARD))['upserted'] == [3]
+
+
+def test_post_list_etag_and_since(client):
+    response = client.get('/board/api/posts')
+    etag = response.headers['ETag']
+    version = response.json['version']
+    assert client.get('/board/api/posts', headers={'If-None-Match': etag}).status_code == 304
+
+    client.post('/board/api/posts', data={'content': 'hello', 'author': 'a'})
+    response = client.get('/board/api/posts', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+
+    response = client.get(f'/board/api/posts?since={version}')
+    assert [post['content'] for post in response.json['posts']] == ['hello']
+    assert response.json['deleted'] == []
+    assert response.json['version'] == version + 1
+
+
+def test_post_list_since_returns_410_after_pruning(app, client):
+    client.post('/board/api/posts', data={'content': 'old', 'author': 'a'})
+    with app.app_context():
+        db.session.execute(db.update(Change).values(created_at=datetime.now() - timedelta(days=30)))
+        db.session.commit()
+        prune_changes(7 * 24 * 60 * 60)
+
+    response = client.get('/board/api/posts?since=0')
+    assert response.status_code == 410
+    assert response.json['reset'] is True
+
+
+def test_reading_a_conversation_records_one_change(app, client):
+    for i in range(5):
+        client.post('/messages/api/messages', data={'content': f'm{i}', 'sender': 'a', 'receiver': 'b'})
+    version = client.get('/messages/api/conversations/b?sender=a').json['version']
+
+    client.get('/messages/api/conversations/a?sender=b')
+    response = client.get(f'/messages/api/conversations/b?sender=a&since={version}')
+    assert response.json['messages'] == []
+    assert response.json['read'] == [{'sender': 'a', 'read_up_to': 5}]
+    assert response.json['version'] == version + 1
@@ -0,0 +1,55 @@
+from app.models.db import Attachment, FileTombstone, Post, db
+from app.services.drive_uploader import switch_to_drive
+
+
+def add_post_with_attachments(tmp_path, count):
+    blob = tmp_path / 'blob'
+    blob.write_bytes(b'data')
+    post = Post(content='c', author='alice')
+    db.session.add(post)
+    db.session.flush()
+    attachments = [
+        Attachment(filename='a.jpg', file_path=str(blob), content_hash='h' * 64,
+                   storage_type='local', post_id=post.id)
+        for _ in range(count)
+    ]
+    db.session.add_all(attachments)
+    db.session.commit()
+    return post, attachments
+
+
+def drive_tombstones():
+    return [t.drive_file_id for t in FileTombstone.query.filter_by(storage_type='google_drive')]
+
+
+def test_switches_every_local_attachment_with_the_same_content(app, tmp_path):
+    with app.app_context():
+        _, attachments = add_post_with_attachments(tmp_path, 2)
+
+        targets = switch_to_drive(attachments[0], {'id': 'drive-1', 'webViewLink': 'view'})
+
+        assert sorted(t.id for t in targets) == sorted(a.id for a in attachments)
+        assert {a.drive_file_id for a in Attachment.query} == {'drive-1'}
+        assert drive_tombstones() == []
+
+
+def test_second_upload_of_the_same_content_is_queued_for_deletion(app, tmp_path):
+    with app.app_context():
+        _, attachments = add_post_with_attachments(tmp_path, 2)
+        switch_to_drive(attachments[0], {'id': 'drive-1'})
+
+        # 同じ内容を別のジョブもアップロードしていた
+        assert switch_to_drive(attachments[1], {'id': 'drive-2'}) == []
+        assert {a.drive_file_id for a in Attachment.query} == {'drive-1'}
+        assert drive_tombstones() == ['drive-2']
+
+
+def test_upload_for_a_deleted_attachment_is_queued_for_deletion(app, tmp_path):
+    with app.app_context():
+        _, attachments = add_post_with_attachments(tmp_path, 1)
+        attachment = attachments[0]
+        db.session.execute(db.delete(Attachment).where(Attachment.id == attachment.id))
+        db.session.commit()
+
+        assert switch_to_drive(attachment, {'id': 'drive-1'}) == []
+        assert drive_tombstones() == ['drive-1']
@@ -0,0 +1,135 @@
+import threading
+
+import pytest
+from flask import Flask
+
+from app.services import llm_scheduler
+from app.services.llm_scheduler import LLMScheduler, QueueFull, TokenBucket, current_job
+
+
+@pytest.fixture
+def scheduler():
+    return LLMScheduler(Flask(__name__), workers=1, rate_per_minute=1, burst=1)
+
+
+def test_same_key_is_coalesced_into_one_call(scheduler):
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return 'answer'
+
+    first = scheduler.submit('key', fn)
+    second = scheduler.submit('key', fn)
+    assert second is first
+    assert first.waiters == 2
+
+    release.set()
+    assert first.wait(5)
+    assert first.get() == 'answer'
+    assert calls == [1]
+
+
+def test_callbacks_of_coalesced_callers_are_all_called(scheduler):
+    release = threading.Event()
+    finished = threading.Event()
+    results = []
+
+    def on_done(name):
+        def callback(job):
+            results.append((name, job.result))
+            if len(results) == 2:
+                finished.set()
+        return callback
+
+    # 通知なしで始まったジョブに、通知ありのリクエストが合流する
+    job = scheduler.submit('key', lambda: release.wait(5) and 'answer')
+    scheduler.submit('key', lambda: 'unused', on_done=on_done('a'))
+    scheduler.submit('key', lambda: 'unused', on_done=on_done('b'))
+
+    release.set()
+    assert job.wait(5)
+    assert finished.wait(5)
+    assert sorted(results) == [('a', 'answer'), ('b', 'answer')]
+
+
+def test_finished_key_starts_a_new_job(scheduler):
+    first = scheduler.submit('key', lambda: 1)
+    assert first.wait(5)
+    second = scheduler.submit('key', lambda: 2)
+    assert second is not first
+    assert second.wait(5)
+    assert second.get() == 2
+
+
+def test_failed_job_raises_for_waiters(scheduler):
+    def fn():
+        raise ValueError('boom')
+
+    job = scheduler.submit('key', fn)
+    assert job.wait(5)
+    assert job.status == 'error'
+    with pytest.raises(ValueError):
+        job.get()
+
+
+def test_worker_does_not_spend_rate_tokens(scheduler):
+    # トークンは上流を呼び出す関数が取得する（キャッシュから返すジョブでは消費しない）
+    for key in ('a', 'b', 'c'):
+        assert scheduler.submit(key, lambda: key).wait(5)
+    assert scheduler.bucket.acquire(timeout=0)
+
+
+def test_queue_full():
+    scheduler = LLMScheduler(Flask(__name__), workers=0, max_queue=1)
+    scheduler.submit('a', lambda: 1)
+    with pytest.raises(QueueFull):
+        scheduler.submit('b', lambda: 2)
+
+
+def test_token_bucket_allows_burst_then_waits():
+    bucket = TokenBucket(rate_per_minute=60, burst=2)
+    assert bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+    # 1秒に1トークン補充される
+    assert bucket.acquire(timeout=2)
+
+
+def test_published_chunks_reach_coalesced_callers(scheduler):
+    release = threading.Event()
+
+    def fn():
+        job = current_job()
+        job.publish('a')
+        release.wait(5)
+        job.publish('b')
+        return 'ab'
+
+    first = scheduler.submit('key', fn)
+    # 途中から合流したリクエストも配信済みの断片から受け取る
+    assert next(first.iter_chunks(timeout=5)) == 'a'
+    second = scheduler.submit('key', fn)
+    release.set()
+    assert list(second.iter_chunks(timeout=5)) == ['a', 'b']
+    assert second.finished
+    assert second.get() == 'ab'
+
+
+def test_iter_chunks_stops_while_queued():
+    scheduler = LLMScheduler(Flask(__name__), workers=0)
+    job = scheduler.submit('key', lambda: 1)
+    assert list(job.iter_chunks(timeout=0.05)) == []
+    assert not job.finished
+
+
+def test_rate_limit_is_split_across_worker_processes(monkeypatch):
+    monkeypatch.setattr(llm_scheduler, '_scheduler', None)
+    app = Flask(__name__)
+    app.config.update(WEB_CONCURRENCY=4, PERPLEXITY_RATE_LIMIT=60, PERPLEXITY_RATE_BURST=10)
+
+    bucket = llm_scheduler.get_scheduler(app).bucket
+    assert bucket.rate == 15 / 60.0
+    assert bucket.capacity == 2
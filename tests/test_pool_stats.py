@@ -0,0 +1,8 @@
+def test_pool_stats_require_the_stats_token(app, client):
+    assert client.get('/api/db/pool-stats').status_code == 404
+
+    app.config['STATS_TOKEN'] = 'secret'
+    assert client.get('/api/db/pool-stats', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    response = client.get('/api/db/pool-stats', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert response.get_json()['dialect'] == 'sqlite'
@@ -0,0 +1,17 @@
+from app.services.process_lock import ProcessLock
+
+
+def test_only_one_holder_at_a_time(tmp_path):
+    path = str(tmp_path / 'locks' / 'worker.lock')
+    first = ProcessLock(path)
+    second = ProcessLock(path)
+
+    assert first.acquire(blocking=False)
+    assert not second.acquire(blocking=False)
+    # 取得済みのロックはそのまま
+    assert first.acquire(blocking=False)
+
+    first.release()
+    assert second.acquire(blocking=False)
+    assert second.held
+    second.release()
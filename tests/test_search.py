@@ -0,0 +1,24 @@
+from app.models.db import Message, db
+from app.services.search import index_message
+
+
+def add_message(sender, receiver, content):
+    message = Message(sender=sender, receiver=receiver, content=content)
+    db.session.add(message)
+    db.session.flush()
+    index_message(message)
+    db.session.commit()
+
+
+def test_messages_are_searched_only_for_the_session_user(app, client):
+    with app.app_context():
+        add_message('alice', 'bob', 'ドライバーの練習')
+
+    # クエリパラメータで他人を名乗っても他人のメッセージは検索できない
+    response = client.get('/api/search', query_string={'q': 'ドライバー', 'user': 'alice'})
+    assert response.get_json()['total'] == 0
+
+    with client.session_transaction() as session:
+        session['username'] = 'bob'
+    response = client.get('/api/search', query_string={'q': 'ドライバー'})
+    assert [r['type'] for r in response.get_json()['results']] == ['message']
@@ -0,0 +1,55 @@
+import time
+from unittest import mock
+
+import socketio
+
+from app.socketio_events import LocalPubSubManager, user_room
+
+
+def make_worker(channel):
+    """LocalPubSubManager を使うSocketIOサーバー（ワーカー1つ分）を作る"""
+    manager = LocalPubSubManager(channel=channel)
+    server = socketio.Server(client_manager=manager, async_mode='threading')
+    server._send_eio_packet = mock.MagicMock()
+    manager.initialize()
+    return server, manager
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_emit_reaches_client_on_another_worker():
+    channel = 'test-fanout'
+    sender, sender_manager = make_worker(channel)
+    receiver, receiver_manager = make_worker(channel)
+    try:
+        sid = receiver_manager.connect('eio-bob', '/')
+        receiver_manager.enter_room(sid, '/', user_room('bob'))
+
+        sender.emit('new_message', {'id': 1}, room=user_room('bob'))
+
+        assert wait_for(lambda: receiver._send_eio_packet.called)
+        assert receiver._send_eio_packet.call_args[0][0] == 'eio-bob'
+        assert not sender._send_eio_packet.called
+    finally:
+        sender_manager.close()
+        receiver_manager.close()
+
+
+def test_other_channels_are_isolated():
+    sender, sender_manager = make_worker('test-channel-a')
+    receiver, receiver_manager = make_worker('test-channel-b')
+    try:
+        sid = receiver_manager.connect('eio-bob', '/')
+        receiver_manager.enter_room(sid, '/', user_room('bob'))
+
+        sender.emit('new_message', {'id': 1}, room=user_room('bob'))
+
+        assert not wait_for(lambda: receiver._send_eio_packet.called, timeout=0.3)
+    finally:
+        sender_manager.close()
+        receiver_manager.close()